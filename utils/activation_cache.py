@@ -0,0 +1,386 @@
+"""
+A set of classes and functions for caching the activations of the frozen part of the model, so the experiments
+that freeze (almost) the whole encoder compute it once per text, instead of once per text and epoch:
+FREEZE_ALL_TRANSFORMER_LAYERS trains only the head from the cached encoder features, and
+FREEZE_ALL_TRANSFORMER_LAYERS_EXCEPT_LAST trains only the last transformer block (and the head) from the cached
+inputs of that block.
+Activations are stored in memory-mapped .npy files, keyed by the hash of the frozen weights and of the tokens
+of the split, so they are reused between sessions and never served stale.
+"""
+import os
+from hashlib import blake2b
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+from transformers import DistilBertForSequenceClassification
+from transformers.masking_utils import create_bidirectional_mask
+from transformers.modeling_outputs import SequenceClassifierOutput
+from tqdm import tqdm
+
+from .checkpointing import get_state_dict_hash
+from .constants import ACTIVATION_CACHE_DIR
+from .training_utils import ToxicityDataset, PaddingCollator, LengthGroupedSampler
+
+
+def is_encoder_frozen(model: DistilBertForSequenceClassification) -> bool:
+    """
+    Checks if the whole encoder (embeddings and all the transformer blocks) is frozen, as in the
+    FREEZE_ALL_TRANSFORMER_LAYERS experiment. Then, only the classification head is trained.
+
+    :param model: DistilBertForSequenceClassification. The model to check.
+
+    :return: bool. True if no parameter of the encoder requires gradients.
+    """
+    return not any(param.requires_grad for param in model.distilbert.parameters())
+
+
+def get_first_trainable_layer(model: DistilBertForSequenceClassification) -> int:
+    """
+    Returns the number of transformer blocks frozen before the first trainable one, when the embeddings are frozen
+    too (e.g. 5 in the FREEZE_ALL_TRANSFORMER_LAYERS_EXCEPT_LAST experiment). The input of that block never
+    changes during training, so it can be cached.
+
+    :param model: DistilBertForSequenceClassification. The model to check.
+
+    :return: int. Index of the first transformer block with trainable parameters (the number of blocks if the
+    whole encoder is frozen), or 0 if the embeddings are trainable.
+    """
+    if any(param.requires_grad for param in model.distilbert.embeddings.parameters()):
+        return 0
+    layers = model.distilbert.transformer.layer
+    return next((i for i, layer in enumerate(layers) if any(param.requires_grad for param in layer.parameters())),
+                len(layers))
+
+
+def get_weights_hash(module: torch.nn.Module) -> str:
+    """
+    Returns a hash of all the weights (parameters and buffers) of a module, for using them as a cache key.
+
+    :param module: torch.nn.Module. The module to hash.
+
+    :return: str. The hexadecimal hash of the weights.
+    """
+    return get_state_dict_hash(state_dict=module.state_dict())
+
+
+def get_encoder_features(model: DistilBertForSequenceClassification, dataset: ToxicityDataset,
+                         device: torch.device, batch_size: int = 64,
+                         cache_dir: str = ACTIVATION_CACHE_DIR) -> np.ndarray:
+    """
+    Returns the hidden state of the first token ([CLS]) of the last transformer block for each text of the dataset,
+    which is the input of the classification head (pre_classifier). They are computed only the first time (for
+    these encoder weights and texts), and read from the cache in disk later on.
+    Note that they are computed in evaluation mode, so the (frozen) encoder doesn't apply dropout to them.
+
+    :param model: DistilBertForSequenceClassification. The model, already in the device.
+    :param dataset: ToxicityDataset. The split to compute the features for.
+    :param device: torch.device. Device where the model is placed.
+    :param batch_size: int. Batch size used for computing the features.
+    :param cache_dir: str. Directory where the features are stored.
+
+    :return: np.ndarray. Memory-mapped (read only) array of shape (len(dataset), hidden size) and dtype float32.
+    """
+    features_path = os.path.join(cache_dir, f"features-{_get_cache_key(modules=[model.distilbert], dataset=dataset)}.npy")
+    if not os.path.isfile(features_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, so an interrupted computation never leaves an incomplete cache
+        features = np.lib.format.open_memmap(f"{features_path}.tmp", mode='w+', dtype=np.float32,
+                                             shape=(len(dataset), model.config.dim))
+        for batch_indices, hidden_state, _ in _run_frozen_layers(model=model, dataset=dataset, device=device,
+                                                                 batch_size=batch_size,
+                                                                 desc="Caching encoder features"):
+            features[batch_indices] = hidden_state[:, 0].float().cpu().numpy()
+        features.flush()
+        del features
+        os.replace(f"{features_path}.tmp", features_path)
+
+    return np.load(features_path, mmap_mode='r')
+
+
+def get_layer_inputs(model: DistilBertForSequenceClassification, dataset: ToxicityDataset, device: torch.device,
+                     layer_index: int, batch_size: int = 64,
+                     cache_dir: str = ACTIVATION_CACHE_DIR) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the input hidden states of the transformer block layer_index (that is, the output of the previous
+    one) for each token of each text of the dataset. They are computed only the first time (for these frozen
+    weights and texts), and read from the cache in disk later on.
+    Hidden states are stored in float16 and only for the real tokens (padding is added to each batch when
+    loading them), so the attention mask of each text is given by its number of tokens (the offsets).
+    Note that they are computed in evaluation mode, so the frozen blocks don't apply dropout to them.
+
+    :param model: DistilBertForSequenceClassification. The model, already in the device.
+    :param dataset: ToxicityDataset. The split to compute the hidden states for.
+    :param device: torch.device. Device where the model is placed.
+    :param layer_index: int. Index of the transformer block whose input is cached. The embeddings and all the
+    previous blocks must be frozen (see get_first_trainable_layer).
+    :param batch_size: int. Batch size used for computing the hidden states.
+    :param cache_dir: str. Directory where the hidden states are stored.
+
+    :return: tuple[np.ndarray, np.ndarray]. The memory-mapped (read only) hidden states of all the tokens
+    concatenated, with shape (total tokens, hidden size) and dtype float16, and the offsets (int64,
+    len(dataset) + 1) of each text in them.
+
+    :raises AssertionError: if the layer index is out of range.
+    """
+    layers = model.distilbert.transformer.layer
+    assert 0 < layer_index < len(layers), f"Layer index must be between 1 and {len(layers) - 1}. Got {layer_index}."
+
+    frozen_modules = [model.distilbert.embeddings, *layers[:layer_index]]
+    cache_key = _get_cache_key(modules=frozen_modules, dataset=dataset)
+    hidden_states_path = os.path.join(cache_dir, f"layer{layer_index}-{cache_key}.hidden_states.npy")
+    offsets_path = os.path.join(cache_dir, f"layer{layer_index}-{cache_key}.offsets.npy")
+
+    # The offsets are written last (as the hashes of a TokenizationCache shard), so they mark the cache as complete
+    if not os.path.isfile(offsets_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write both files to a temporary path first, so an interrupted computation never leaves an incomplete cache
+        hidden_states = np.lib.format.open_memmap(f"{hidden_states_path}.tmp", mode='w+', dtype=np.float16,
+                                                  shape=(int(dataset.offsets[-1]), model.config.dim))
+        for batch_indices, hidden_state, lengths in _run_frozen_layers(model=model, dataset=dataset, device=device,
+                                                                       batch_size=batch_size, layer_index=layer_index,
+                                                                       desc=f"Caching inputs of layer {layer_index}"):
+            hidden_state = hidden_state.half().cpu().numpy()
+            # Store only the real tokens of each text, at its own offset
+            for i, idx in enumerate(batch_indices):
+                hidden_states[dataset.offsets[idx]:dataset.offsets[idx + 1]] = hidden_state[i, :lengths[i]]
+        hidden_states.flush()
+        del hidden_states
+        os.replace(f"{hidden_states_path}.tmp", hidden_states_path)
+        with open(f"{offsets_path}.tmp", 'wb') as f:
+            np.save(f, dataset.offsets)
+        os.replace(f"{offsets_path}.tmp", offsets_path)
+
+    return np.load(hidden_states_path, mmap_mode='r'), np.load(offsets_path)
+
+
+class FeatureDataset(Dataset):
+    """
+    Dataset of cached features and their labels. It's indexed by whole batches (lists of indices), which is much
+    faster than indexing texts one by one when each step of the training takes only a few microseconds.
+    """
+
+    def __init__(self, features: np.ndarray, labels: torch.Tensor):
+        """
+        :param features: np.ndarray. The (memory-mapped) features of each text.
+        :param labels: torch.Tensor. The label of each text.
+
+        :raises AssertionError: if the number of features and labels doesn't match.
+        """
+        assert len(features) == len(labels), f"Lengths mismatch. Got {len(features)} features and {len(labels)} labels."
+        self.features, self.labels = features, labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, batch_indices: list[int]) -> dict[str, torch.Tensor]:
+        return {
+            'features': torch.from_numpy(self.features[batch_indices]),
+            'labels': self.labels[batch_indices]
+        }
+
+
+class ClassifierHead(torch.nn.Module):
+    """
+    The classification head of a DistilBertForSequenceClassification (pre_classifier, ReLU, dropout and classifier),
+    taking the cached features as input. Its layers are shared with the given model (not copied), so training the
+    head trains the model, and the model can be saved as usual.
+    """
+
+    def __init__(self, model: DistilBertForSequenceClassification):
+        """
+        :param model: DistilBertForSequenceClassification. The model whose head will be trained.
+        """
+        super().__init__()
+        self.pre_classifier, self.dropout, self.classifier = model.pre_classifier, model.dropout, model.classifier
+
+    def forward(self, features: torch.Tensor) -> SequenceClassifierOutput:
+        # Same operations as DistilBertForSequenceClassification.forward after the encoder
+        pooled_output = self.dropout(torch.nn.functional.relu(self.pre_classifier(features)))
+        return SequenceClassifierOutput(logits=self.classifier(pooled_output))
+
+
+class LayerInputDataset(Dataset):
+    """
+    Dataset of cached (unpadded) hidden states and their labels. As FeatureDataset, it's indexed by whole batches
+    (lists of indices), padding each batch up to its longest text and building its attention mask.
+    """
+
+    def __init__(self, hidden_states: np.ndarray, offsets: np.ndarray, labels: torch.Tensor):
+        """
+        :param hidden_states: np.ndarray. The (memory-mapped) hidden states of all the tokens concatenated.
+        :param offsets: np.ndarray. The offsets of each text in the hidden states array.
+        :param labels: torch.Tensor. The label of each text.
+
+        :raises AssertionError: if the number of texts and labels doesn't match.
+        """
+        assert len(offsets) - 1 == len(labels), f"Lengths mismatch. Got {len(offsets) - 1} texts and " \
+                                                f"{len(labels)} labels."
+        self.hidden_states, self.offsets, self.labels = hidden_states, offsets, labels
+        self.lengths = np.diff(offsets)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, batch_indices: list[int]) -> dict[str, torch.Tensor]:
+        lengths = self.lengths[batch_indices]
+        # Padding positions are masked, so their value doesn't matter (zeros)
+        hidden_states = np.zeros((len(batch_indices), lengths.max(), self.hidden_states.shape[1]), dtype=np.float32)
+        for i, idx in enumerate(batch_indices):
+            hidden_states[i, :lengths[i]] = self.hidden_states[self.offsets[idx]:self.offsets[idx + 1]]
+
+        return {
+            'hidden_states': torch.from_numpy(hidden_states),
+            'attention_mask': torch.from_numpy((np.arange(lengths.max()) < lengths[:, None]).astype(np.int64)),
+            'labels': self.labels[batch_indices]
+        }
+
+
+class PartialEncoder(torch.nn.Module):
+    """
+    The trainable part of a DistilBertForSequenceClassification: its transformer blocks from first_layer on and
+    its classification head, taking the cached inputs of first_layer as input. As in ClassifierHead, its layers
+    are shared with the given model, so training it trains the model.
+    """
+
+    def __init__(self, model: DistilBertForSequenceClassification, first_layer: int):
+        """
+        :param model: DistilBertForSequenceClassification. The model whose last blocks will be trained.
+        :param first_layer: int. Index of the first transformer block to run.
+        """
+        super().__init__()
+        self.config = model.config
+        self.layers = model.distilbert.transformer.layer[first_layer:]
+        self.head = ClassifierHead(model=model)
+
+    def forward(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> SequenceClassifierOutput:
+        # Same operations as DistilBertModel.forward after the embeddings (and the frozen blocks)
+        attention_mask = create_bidirectional_mask(config=self.config, inputs_embeds=hidden_states,
+                                                   attention_mask=attention_mask)
+        for layer in self.layers:
+            hidden_states = layer(hidden_states, attention_mask)
+        return self.head(features=hidden_states[:, 0])
+
+
+class FrozenPrefixModel(torch.nn.Module):
+    """
+    A DistilBertForSequenceClassification that runs its frozen prefix (the embeddings, if they are frozen, and the
+    frozen transformer blocks before the first trainable one) without autograd, and only the rest of the model
+    (a PartialEncoder) with it. For training without the activation cache (e.g. ONLY_FREEZE_EMBEDDINGS), giving
+    the same outputs and gradients as the model itself. Its layers are shared with the given model, so training it
+    trains the model.
+    """
+
+    def __init__(self, model: DistilBertForSequenceClassification):
+        """
+        :param model: DistilBertForSequenceClassification. The model to train, with its frozen layers already set.
+        """
+        super().__init__()
+        self.config = model.config
+        first_trainable_layer = get_first_trainable_layer(model=model)
+        self.embeddings = model.distilbert.embeddings
+        # Trainable embeddings (get_first_trainable_layer is 0 then) must run with autograd, to get their gradients
+        self.frozen_embeddings = not any(param.requires_grad for param in self.embeddings.parameters())
+        self.frozen_layers = model.distilbert.transformer.layer[:first_trainable_layer]
+        self.trainable = PartialEncoder(model=model, first_layer=first_trainable_layer)
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> SequenceClassifierOutput:
+        # Nothing of the frozen prefix needs gradients, so don't record it in the graph. Not inference_mode,
+        # since its output is still saved for the backward of the first trainable block
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.frozen_embeddings):
+            hidden_states = self.embeddings(input_ids)
+        with torch.no_grad():
+            if len(self.frozen_layers) > 0:
+                frozen_mask = create_bidirectional_mask(config=self.config, inputs_embeds=hidden_states,
+                                                        attention_mask=attention_mask)
+                for layer in self.frozen_layers:
+                    hidden_states = layer(hidden_states, frozen_mask)
+        return self.trainable(hidden_states=hidden_states, attention_mask=attention_mask)
+
+
+def get_layer_input_loader(hidden_states: np.ndarray, offsets: np.ndarray, labels: torch.Tensor, batch_size: int,
+                           shuffle: bool) -> DataLoader:
+    """
+    Returns a DataLoader of batches of cached hidden states (with their attention masks and labels), grouped by
+    length as in LengthGroupedSampler, for training a PartialEncoder with process_epoch.
+
+    :param hidden_states: np.ndarray. The (memory-mapped) hidden states of all the tokens concatenated.
+    :param offsets: np.ndarray. The offsets of each text in the hidden states array.
+    :param labels: torch.Tensor. The label of each text.
+    :param batch_size: int. Maximum number of texts of each batch.
+    :param shuffle: bool. Whether to shuffle the batches at the beginning of each epoch.
+
+    :return: DataLoader. The loader, returning dictionaries with the hidden states, the attention mask and the
+    labels of each batch.
+    """
+    dataset = LayerInputDataset(hidden_states=hidden_states, offsets=offsets, labels=labels)
+    # batch_size=None, since the dataset already returns whole batches
+    return DataLoader(dataset, sampler=LengthGroupedSampler(lengths=dataset.lengths, batch_size=batch_size,
+                                                            shuffle=shuffle), batch_size=None)
+
+
+def get_feature_loader(features: np.ndarray, labels: torch.Tensor, batch_size: int, shuffle: bool) -> DataLoader:
+    """
+    Returns a DataLoader of batches of cached features (with their labels), for training a ClassifierHead
+    with process_epoch.
+
+    :param features: np.ndarray. The (memory-mapped) features of each text.
+    :param labels: torch.Tensor. The label of each text.
+    :param batch_size: int. Number of texts of each batch.
+    :param shuffle: bool. Whether to shuffle the texts at the beginning of each epoch.
+
+    :return: DataLoader. The loader, returning dictionaries with the features and the labels of each batch.
+    """
+    dataset = FeatureDataset(features=features, labels=labels)
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    # batch_size=None, since the dataset already returns whole batches
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=False), batch_size=None)
+
+
+def _get_cache_key(modules: list[torch.nn.Module], dataset: ToxicityDataset) -> str:
+    # Frozen weights and tokens of the texts (in their order) determine the cached activations
+    tokens_hash = blake2b(dataset.tokens.tobytes(), digest_size=16)
+    tokens_hash.update(dataset.offsets.tobytes())
+    return f"{get_weights_hash(module=torch.nn.ModuleList(modules))[:16]}-{tokens_hash.hexdigest()[:16]}"
+
+
+class _StopForward(Exception):
+    # Raised by the hook of _run_frozen_layers once the needed hidden states are captured
+    pass
+
+
+def _run_frozen_layers(model: DistilBertForSequenceClassification, dataset: ToxicityDataset, device: torch.device,
+                       batch_size: int, desc: str, layer_index: int|None = None):
+    """
+    Runs the encoder over the whole dataset, in evaluation mode and without gradients, in batches sorted by
+    length (so the padding is minimal). If a layer index is given, it stops right before that block.
+
+    :return: Iterator[tuple[np.ndarray, torch.Tensor, np.ndarray]]. The indices of the texts of each batch, the
+    hidden states (batch size, longest text, hidden size) of the last transformer block (or the input of
+    the block layer_index) and the length of each text.
+    """
+    captured = []
+    def capture_input(module, args):
+        captured.append(args[0])
+        raise _StopForward
+
+    was_training = model.training
+    model.eval()
+    collator = PaddingCollator(pad_token_id=model.config.pad_token_id or 0)
+    hook = model.distilbert.transformer.layer[layer_index].register_forward_pre_hook(capture_input) \
+        if layer_index is not None else None
+    try:
+        with torch.no_grad():
+            for batch_indices in tqdm(LengthGroupedSampler(lengths=dataset.lengths, batch_size=batch_size,
+                                                           shuffle=False), desc=desc):
+                batch = collator([dataset[idx] for idx in batch_indices])
+                try:
+                    captured.append(model.distilbert(input_ids=batch['input_ids'].to(device),
+                                                     attention_mask=batch['attention_mask'].to(device))[0])
+                except _StopForward:
+                    pass
+                yield np.array(batch_indices), captured.pop(), dataset.lengths[batch_indices]
+    finally:
+        if hook is not None:
+            hook.remove()
+        model.train(was_training)
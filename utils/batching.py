@@ -0,0 +1,153 @@
+"""
+A set of functions for building the inference batches from already tokenized texts, and for building
+the results of the inference from the probabilities of each text.
+Texts of similar length are grouped in the same batch, so the padding added to each batch is minimal.
+"""
+import numpy as np
+import pandas as pd
+
+from .constants import TRUE_LABELS, PRED_LABELS, PRED_PROBS, LABEL
+
+
+def get_batches(lengths: np.ndarray, batch_size: int, max_tokens_per_batch: int|None = None) -> list[np.ndarray]:
+    """
+    Groups the indices of the sequences in batches of similar length, using get_token_budget_batches if a token
+    budget is given and get_length_sorted_batches otherwise.
+
+    :param lengths: np.ndarray. The length (in tokens) of each sequence.
+    :param batch_size: int. The maximum number of sequences in each batch (ignored if max_tokens_per_batch is given).
+    :param max_tokens_per_batch: int|None. The maximum number of (padded) tokens in each batch.
+
+    :return: list[np.ndarray]. A list with the indices (referring to the lengths array) of each batch.
+    """
+    if max_tokens_per_batch is None:
+        return get_length_sorted_batches(lengths=lengths, batch_size=batch_size)
+    return get_token_budget_batches(lengths=lengths, max_tokens_per_batch=max_tokens_per_batch)
+
+
+def get_length_sorted_batches(lengths: np.ndarray, batch_size: int) -> list[np.ndarray]:
+    """
+    Groups the indices of the sequences in batches of (at most) batch_size elements, sorting them by their
+    length first. That way, each batch contains sequences of similar length and the padding is minimal.
+
+    :param lengths: np.ndarray. The length (in tokens) of each sequence.
+    :param batch_size: int. The maximum number of sequences in each batch.
+
+    :return: list[np.ndarray]. A list with the indices (referring to the lengths array) of each batch.
+
+    :raises AssertionError: if the batch size is not positive.
+    """
+    assert batch_size > 0, f"Batch size must be positive. Got {batch_size}."
+
+    # Stable sort to keep the original order between sequences of the same length
+    sorted_indices = np.argsort(lengths, kind='stable')
+    return [sorted_indices[start:start + batch_size] for start in range(0, len(sorted_indices), batch_size)]
+
+
+def pad_batch(sequences: list[list[int]|np.ndarray], pad_token_id: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pads a batch of token sequences to the length of its longest sequence.
+
+    :param sequences: list[list[int]|np.ndarray]. The token ids of each sequence of the batch.
+    :param pad_token_id: int. The token id used for padding.
+
+    :return: tuple[np.ndarray, np.ndarray]. The padded input ids and their attention mask, both with
+    shape (batch size, longest sequence length).
+    """
+    max_length = max(len(sequence) for sequence in sequences)
+    input_ids = np.full((len(sequences), max_length), fill_value=pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(sequences), max_length), dtype=np.int64)
+
+    for i, sequence in enumerate(sequences):
+        input_ids[i, :len(sequence)] = sequence
+        attention_mask[i, :len(sequence)] = 1
+
+    return input_ids, attention_mask
+
+
+def get_token_budget_batches(lengths: np.ndarray, max_tokens_per_batch: int) -> list[np.ndarray]:
+    """
+    Groups the indices of the sequences in batches whose padded size (longest sequence x number of rows) stays
+    under max_tokens_per_batch. Sequences are sorted by length first, so short texts are packed in big batches
+    and long texts in small ones, keeping the memory used by each batch roughly constant.
+
+    :param lengths: np.ndarray. The length (in tokens) of each sequence.
+    :param max_tokens_per_batch: int. The maximum number of (padded) tokens in each batch. A sequence longer
+    than the budget is placed alone in its own batch.
+
+    :return: list[np.ndarray]. A list with the indices (referring to the lengths array) of each batch.
+
+    :raises AssertionError: if the token budget is not positive.
+    """
+    assert max_tokens_per_batch > 0, f"Token budget must be positive. Got {max_tokens_per_batch}."
+
+    sorted_indices = np.argsort(lengths, kind='stable')
+    batches, batch_start = [], 0
+    for i, index in enumerate(sorted_indices):
+        # Lengths are sorted in ascending order, so the current sequence is the longest one of the batch
+        if i > batch_start and lengths[index] * (i - batch_start + 1) > max_tokens_per_batch:
+            batches.append(sorted_indices[batch_start:i])
+            batch_start = i
+
+    if batch_start < len(sorted_indices):
+        batches.append(sorted_indices[batch_start:])
+    return batches
+
+
+def get_padding_stats(lengths: np.ndarray, batches: list[np.ndarray]) -> dict[str, int|float]:
+    """
+    Returns the number of real and padding tokens that the given batches would generate, as well as the
+    share of padding tokens over the real ones.
+
+    :param lengths: np.ndarray. The length (in tokens) of each sequence.
+    :param batches: list[np.ndarray]. The indices of the sequences contained in each batch.
+
+    :return: dict[str, int|float]. A dictionary with the following structure:
+    {'batches': int, 'real_tokens': int, 'padded_tokens': int, 'padding_ratio': float}
+    """
+    real_tokens = int(sum(lengths[batch].sum() for batch in batches))
+    padded_tokens = int(sum(lengths[batch].max() * len(batch) for batch in batches)) - real_tokens
+
+    return {
+        'batches': len(batches),
+        'real_tokens': real_tokens,
+        'padded_tokens': padded_tokens,
+        'padding_ratio': padded_tokens / max(real_tokens, 1)
+    }
+
+
+def get_results_by_language(probabilities: np.ndarray, df_by_language: dict[str, pd.DataFrame],
+                            conf_th: float = 0.5) -> dict[str, dict[str, list[int]]]:
+    """
+    Splits the probabilities of the texts of all languages (concatenated in the order of df_by_language) into the
+    results structure returned by predict_with_probabilities.
+
+    :param probabilities: np.ndarray. The probabilities of each class for each text, with shape (texts, 2).
+    :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+    :param conf_th: float. Confidence threshold to use for the predictions if the probabilities are
+    above it, the prediction will be toxic, otherwise it will be non-toxic.
+
+    :return: dict[str, dict[str, list[int]]]. A dictionary with the following structure:
+    {<language>: {'true_labels': list[int], 'pred_labels': list[int], 'pred_probs': list[float, float]}}
+
+    :raises AssertionError: if the number of probabilities doesn't match the number of texts.
+    """
+    assert len(probabilities) == sum(len(lang_dataset) for lang_dataset in df_by_language.values()), \
+        f"Expected one probability pair per text. Got {len(probabilities)}."
+
+    results_by_lang, start = {}, 0
+    for lang, lang_dataset in df_by_language.items():
+        # Texts of each language are contiguous (and in their original order) in the probabilities array
+        lang_probabilities = probabilities[start:start + len(lang_dataset)]
+        start += len(lang_dataset)
+        # Get the predictions by comparing the probabilities with the confidence threshold
+        predictions = np.where(lang_probabilities[:, 1] > conf_th, 1, 0)
+
+        # Store the results for this language
+        results_by_lang[lang] = {
+            TRUE_LABELS: lang_dataset[LABEL].tolist(),
+            PRED_LABELS: list(predictions),
+            PRED_PROBS: list(lang_probabilities)
+        }
+
+    return results_by_lang
@@ -0,0 +1,828 @@
+"""
+A set of functions for measuring the performance (time, memory and throughput) of the different
+inference and training strategies implemented in the utils package.
+Moved here to avoid cluttering the notebooks with code that is not relevant to the analysis.
+"""
+import gc
+import json
+import os
+import multiprocessing
+import resource
+import subprocess
+import sys
+import tracemalloc
+import multiprocessing.synchronize
+from collections import Counter
+from collections.abc import Callable
+from copy import deepcopy
+from time import perf_counter
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+import pandas as pd
+
+from .analysis_utils import get_word_freqs
+from .batching import get_length_sorted_batches, get_token_budget_batches, get_padding_stats
+from .constants import TEXT, LABEL, ORIGIN, TRAIN, MODEL_NAME, SPACY_MODEL, MODEL_MAX_LENGTH, TRUE_LABELS, PRED_LABELS, PRED_PROBS, FP32_BACKEND, INT8_BACKEND
+from .corpus_processing import LemmaStore, get_token_attributes, load_lemma_pipeline, process_corpus
+
+# torch (and the modules that import it) takes seconds to load, so each benchmark imports only what it needs.
+# These are only for the type hints
+if TYPE_CHECKING:
+    import torch
+    from spacy.language import Language
+
+
+def benchmark_batching(model_path: str, tokenizer, df_by_language: dict[str, pd.DataFrame], device: 'torch.device',
+                       batch_size: int = 32, max_tokens_per_batch: int = 16384) -> pd.DataFrame:
+    """
+    Compares the padding overhead and the throughput of three batching strategies over the same texts:
+    fixed-size batches in the original order, fixed-size batches sorted by length and token-budget batches.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param tokenizer: callable. Tokenizer to use for tokenizing the data before feeding it to the model.
+    :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+    :param device: torch.device. Device to use for the model.
+    :param batch_size: int. Batch size of the fixed-size strategies.
+    :param max_tokens_per_batch: int. Token budget of the token-budget strategy.
+
+    :return: pd.DataFrame. One row per strategy, with the number of batches, real and padded tokens, the share of
+    padded tokens over real ones, the elapsed time, the throughput (texts/s) and the peak memory (only on GPU).
+    """
+    import torch
+    from .model_performance_analysis import predict_batches
+    from .model_registry import MODEL_REGISTRY
+    from .tokenization import tokenize_texts, get_sequences
+
+    model = MODEL_REGISTRY.get_model(model_path=model_path, device=device)
+
+    texts = [text for lang_dataset in df_by_language.values() for text in lang_dataset[TEXT].tolist()]
+    tokens, offsets = tokenize_texts(texts=texts, tokenizer=tokenizer, max_length=MODEL_MAX_LENGTH)
+    input_ids, lengths = get_sequences(tokens=tokens, offsets=offsets), np.diff(offsets)
+
+    batches_by_strategy = {
+        'original order': [np.arange(start, min(start + batch_size, len(texts)))
+                           for start in range(0, len(texts), batch_size)],
+        'length sorted': get_length_sorted_batches(lengths=lengths, batch_size=batch_size),
+        'token budget': get_token_budget_batches(lengths=lengths, max_tokens_per_batch=max_tokens_per_batch)
+    }
+
+    rows = []
+    for strategy, batches in batches_by_strategy.items():
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+
+        seconds, _ = _measure(lambda: predict_batches(model=model, input_ids=input_ids, batches=batches,
+                                                      pad_token_id=tokenizer.pad_token_id or 0, device=device,
+                                                      desc=f"Benchmarking {strategy}"), device=device)
+
+        rows.append({'strategy': strategy, **get_padding_stats(lengths=lengths, batches=batches),
+                     'seconds': seconds,
+                     'peak_memory': torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None})
+
+    return _get_report(rows=rows, index='strategy', throughput=('texts_per_second', len(texts)), speedup=False)
+
+
+def benchmark_int8_backend(model_path: str, tokenizer, df_by_language: dict[str, pd.DataFrame],
+                           batch_size: int = 32) -> pd.DataFrame:
+    """
+    Compares the fp32 and the int8 (dynamic quantization) backends on CPU, both in throughput and in how far
+    the quantization moves the accuracy and the precision-recall curve. It's meant to be run over the TEST split.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param tokenizer: callable. Tokenizer to use for tokenizing the data before feeding it to the model.
+    :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+    :param batch_size: int. Batch size to use for the predictions.
+
+    :return: pd.DataFrame. One row per backend, with the elapsed time, the throughput (texts/s) and the speedup
+    over fp32, the accuracy, the area under the precision-recall curve and its optimal threshold, as well as the
+    maximum difference of the toxic probability and the share of predictions that agree with the fp32 ones.
+    """
+    import torch
+    from sklearn.metrics import precision_recall_curve, auc
+    from .model_performance_analysis import predict_with_probabilities
+    from .model_registry import MODEL_REGISTRY
+
+    device, rows, fp32_probs, fp32_labels = torch.device('cpu'), [], None, None
+    for backend in (FP32_BACKEND, INT8_BACKEND):
+        # Load (or quantize) the model before starting the timer, to measure only the inference
+        MODEL_REGISTRY.get_model(model_path=model_path, device=device, backend=backend)
+
+        seconds, results_by_lang = _measure(lambda: predict_with_probabilities(model_path=model_path,
+                                                                               tokenizer=tokenizer,
+                                                                               df_by_language=df_by_language,
+                                                                               device=device, batch_size=batch_size,
+                                                                               backend=backend))
+
+        true_labels = np.concatenate([results[TRUE_LABELS] for results in results_by_lang.values()])
+        pred_labels = np.concatenate([results[PRED_LABELS] for results in results_by_lang.values()])
+        toxic_probs = np.concatenate([np.array(results[PRED_PROBS])[:, 1] for results in results_by_lang.values()])
+        precision, recall, thresholds = precision_recall_curve(true_labels, toxic_probs)
+        # Same optimal threshold criteria as in plot_combined_precision_recall_curve
+        optimal_idx = np.argmax(np.sqrt(precision * recall))
+
+        if fp32_probs is None:
+            fp32_probs, fp32_labels = toxic_probs, pred_labels
+
+        rows.append({'backend': backend, 'seconds': seconds, 'accuracy': np.mean(true_labels == pred_labels),
+                     'pr_auc': auc(recall, precision), 'optimal_threshold': thresholds[min(optimal_idx, len(thresholds) - 1)],
+                     'max_toxic_prob_diff': np.abs(toxic_probs - fp32_probs).max(),
+                     'label_agreement': np.mean(pred_labels == fp32_labels)})
+
+    return _get_report(rows=rows, index='backend', throughput=('texts_per_second', len(fp32_probs)))
+
+
+def benchmark_parallel_scaling(model_path: str, tokenizer, df_by_language: dict[str, pd.DataFrame],
+                               worker_counts: tuple[int, ...] = (1, 2, 4, 8), threads_per_worker: int = 1,
+                               batch_size: int = 32, backend: str = FP32_BACKEND) -> pd.DataFrame:
+    """
+    Measures how the multi-process CPU inference (ShardedPredictor) scales as the number of workers grows.
+    Workers are started and warmed up before starting the timer, so only the inference is measured.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param tokenizer: callable. Tokenizer to use for tokenizing the data before feeding it to the model.
+    :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+    :param worker_counts: tuple[int, ...]. Numbers of workers to test. The first one is the baseline.
+    :param threads_per_worker: int. Number of torch threads of each worker.
+    :param batch_size: int. Batch size to use for the predictions.
+    :param backend: str. FP32_BACKEND or INT8_BACKEND.
+
+    :return: pd.DataFrame. One row per number of workers, with the elapsed time, the throughput (texts/s), the
+    speedup over the baseline and the scaling efficiency (speedup divided by the relative number of workers).
+    """
+    from .parallel_inference import ShardedPredictor
+
+    num_texts, rows = sum(len(lang_dataset) for lang_dataset in df_by_language.values()), []
+    for num_workers in worker_counts:
+        with ShardedPredictor(model_path=model_path, tokenizer=tokenizer, num_workers=num_workers,
+                              threads_per_worker=threads_per_worker, batch_size=batch_size,
+                              backend=backend) as predictor:
+            seconds, _ = _measure(lambda: predictor.predict(df_by_language=df_by_language))
+        rows.append({'workers': num_workers, 'seconds': seconds})
+
+    report = _get_report(rows=rows, index='workers', throughput=('texts_per_second', num_texts))
+    report['efficiency'] = report['speedup'] / (report.index / worker_counts[0])
+    return report
+
+
+def benchmark_tokenization(texts: list[str], tokenizer, worker_counts: tuple[int, ...] = (2, 4),
+                           max_length: int = MODEL_MAX_LENGTH) -> pd.DataFrame:
+    """
+    Compares the throughput of tokenizing a split as ToxicityDataset used to (calling the tokenizer once per
+    text, padding each one to max_length) with the batched fast tokenizer of tokenize_texts, in this process and
+    across several worker processes. All of them produce the same padded input ids and attention masks.
+
+    :param texts: list[str]. The texts to tokenize (e.g. the TEXT column of the training split).
+    :param tokenizer: callable. Tokenizer to use for tokenizing the texts.
+    :param worker_counts: tuple[int, ...]. Numbers of worker processes to test for tokenize_texts.
+    :param max_length: int. Maximum number of tokens of each text.
+
+    :return: pd.DataFrame. One row per strategy, with the elapsed time, the throughput (rows/s) and the speedup
+    over the per-text loop.
+    """
+    import torch
+    from .tokenization import get_fast_tokenizer, tokenize_texts, pad_sequences
+
+    def per_text_loop():
+        for text in texts:
+            tokenizer(text, add_special_tokens=True, max_length=max_length, padding='max_length', truncation=True,
+                      return_tensors='pt')
+
+    def batched(num_workers: int):
+        tokens, offsets = tokenize_texts(texts=texts, tokenizer=tokenizer, max_length=max_length,
+                                         num_workers=num_workers)
+        input_ids, attention_mask = pad_sequences(tokens=tokens, offsets=offsets, length=max_length,
+                                                  pad_token_id=tokenizer.pad_token_id or 0)
+        torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
+
+    strategies = {'per-text loop': per_text_loop, 'batched fast tokenizer': lambda: batched(num_workers=1),
+                  **{f"batched fast tokenizer ({num_workers} workers)": lambda num_workers=num_workers:
+                     batched(num_workers=num_workers) for num_workers in worker_counts}}
+    # Convert the tokenizer to its fast version before starting the timers, it's only done once
+    get_fast_tokenizer(tokenizer=tokenizer, max_length=max_length)
+
+    rows = [{'strategy': strategy, 'seconds': _measure(tokenize)[0]} for strategy, tokenize in strategies.items()]
+    return _get_report(rows=rows, index='strategy', throughput=('rows_per_second', len(texts)))
+
+
+def benchmark_dynamic_padding(model: 'torch.nn.Module', dataframe: pd.DataFrame, tokenizer, device: 'torch.device',
+                              batch_size: int = 64, loss_fn: 'torch.nn.Module|None' = None) -> pd.DataFrame:
+    """
+    Measures one training epoch (process_epoch) over the given split (e.g. TRAIN) padding every text to
+    MODEL_MAX_LENGTH, as it was done before, against padding each batch only to its longest text, both with
+    shuffled batches and with the length-grouped ones of LengthGroupedSampler. The model is restored after each
+    run, so every strategy starts from the same weights.
+
+    :param model: torch.nn.Module. Model to train, already in the device (and with its frozen layers set).
+    :param dataframe: pd.DataFrame. Data split with "text" and "label" columns.
+    :param tokenizer: callable. Tokenizer to use for tokenizing the texts.
+    :param device: torch.device. Device where the model is placed.
+    :param batch_size: int. Batch size to use for the training.
+    :param loss_fn: torch.nn.Module|None. Loss function. Plain cross entropy by default.
+
+    :return: pd.DataFrame. One row per strategy, with the epoch time, the throughput (real tokens/s), the speedup
+    over the max length padding, the real (not padding) and padded tokens processed and the share of padded tokens
+    over real ones.
+    """
+    import torch
+    from torch.utils.data import DataLoader
+    from .training_utils import ToxicityDataset, PaddingCollator, LengthGroupedSampler, process_epoch, \
+        get_trainable_parameters
+
+    dataset = ToxicityDataset(dataframe=dataframe, tokenizer=tokenizer)
+    pad_token_id, loss_fn = tokenizer.pad_token_id or 0, loss_fn or torch.nn.CrossEntropyLoss()
+
+    fixed_length_collator = PaddingCollator(pad_token_id=pad_token_id, length=MODEL_MAX_LENGTH)
+    dynamic_collator = PaddingCollator(pad_token_id=pad_token_id)
+    loader_kwargs_by_strategy = {
+        'max length padding': {'collate_fn': fixed_length_collator, 'batch_size': batch_size, 'shuffle': True},
+        'dynamic padding': {'collate_fn': dynamic_collator, 'batch_size': batch_size, 'shuffle': True},
+        'dynamic padding + length grouped': {'collate_fn': dynamic_collator,
+                                             'batch_sampler': LengthGroupedSampler(lengths=dataset.lengths,
+                                                                                   batch_size=batch_size)}
+    }
+
+    initial_state, real_tokens, rows = deepcopy(model.state_dict()), int(dataset.lengths.sum()), []
+    for strategy, loader_kwargs in loader_kwargs_by_strategy.items():
+        # Count the (padded) tokens of each batch as they are built
+        padded_tokens, collate_fn = [], loader_kwargs.pop('collate_fn')
+        def collate_and_count(items, collate_fn=collate_fn):
+            batch = collate_fn(items)
+            padded_tokens.append(batch['input_ids'].numel())
+            return batch
+        loader = DataLoader(dataset, collate_fn=collate_and_count, **loader_kwargs)
+
+        optimizer = torch.optim.AdamW(get_trainable_parameters(model=model), lr=5e-5)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lambda _: 1.)
+        seconds, _ = _measure(lambda: process_epoch(model=model, data_loader=loader, loss_fn=loss_fn, device=device,
+                                                    mode='train', optimizer=optimizer, scheduler=scheduler),
+                              device=device)
+        model.load_state_dict(initial_state)
+
+        rows.append({'strategy': strategy, 'epoch_seconds': seconds, 'real_tokens': real_tokens,
+                     'padded_tokens': sum(padded_tokens) - real_tokens,
+                     'padding_ratio': (sum(padded_tokens) - real_tokens) / max(real_tokens, 1)})
+
+    return _get_report(rows=rows, index='strategy', seconds_column='epoch_seconds',
+                       throughput=('tokens_per_second', real_tokens))
+
+
+def benchmark_activation_cache(model: 'torch.nn.Module', dataframe: pd.DataFrame, tokenizer, device: 'torch.device',
+                               batch_size: int = 64, loss_fn: 'torch.nn.Module|None' = None) -> pd.DataFrame:
+    """
+    Measures one training epoch (process_epoch) over the given split (e.g. TRAIN) running the whole model, against
+    running only its trainable part from the cached activations of the frozen one: the encoder features if the
+    whole encoder is frozen (FREEZE_ALL_TRANSFORMER_LAYERS) or the inputs of the first trainable block otherwise
+    (e.g. FREEZE_ALL_TRANSFORMER_LAYERS_EXCEPT_LAST). The model is restored after each run, so both start from
+    the same weights. Both use length-grouped batches with dynamic padding.
+
+    :param model: torch.nn.Module. Model to train, already in the device and with its frozen layers set. At least
+    the embeddings and the first transformer block must be frozen.
+    :param dataframe: pd.DataFrame. Data split with "text" and "label" columns.
+    :param tokenizer: callable. Tokenizer to use for tokenizing the texts.
+    :param device: torch.device. Device where the model is placed.
+    :param batch_size: int. Batch size to use for the training.
+    :param loss_fn: torch.nn.Module|None. Loss function. Plain cross entropy by default.
+
+    :return: pd.DataFrame. One row per strategy, with the time needed for building the cache (zero if it was
+    already built), the epoch time, the speedup over the whole model and the disk footprint of the cache.
+
+    :raises AssertionError: if no transformer block is frozen.
+    """
+    import torch
+    from torch.utils.data import DataLoader
+    from .activation_cache import is_encoder_frozen, get_first_trainable_layer, get_encoder_features, \
+        get_feature_loader, ClassifierHead, get_layer_inputs, get_layer_input_loader, PartialEncoder
+    from .training_utils import ToxicityDataset, PaddingCollator, LengthGroupedSampler, process_epoch, \
+        get_trainable_parameters
+
+    first_trainable_layer = get_first_trainable_layer(model=model)
+    assert first_trainable_layer > 0, "The embeddings and, at least, the first transformer block must be frozen."
+    dataset = ToxicityDataset(dataframe=dataframe, tokenizer=tokenizer)
+    loss_fn = loss_fn or torch.nn.CrossEntropyLoss()
+
+    def build_cache():
+        if is_encoder_frozen(model=model):
+            features = get_encoder_features(model=model, dataset=dataset, device=device, batch_size=batch_size)
+            cached_loader = get_feature_loader(features=features, labels=dataset.labels, batch_size=batch_size,
+                                               shuffle=True)
+            return ClassifierHead(model=model), cached_loader, [features.filename]
+        hidden_states, offsets = get_layer_inputs(model=model, dataset=dataset, device=device,
+                                                  layer_index=first_trainable_layer, batch_size=batch_size)
+        cached_loader = get_layer_input_loader(hidden_states=hidden_states, offsets=offsets, labels=dataset.labels,
+                                               batch_size=batch_size, shuffle=True)
+        return PartialEncoder(model=model, first_layer=first_trainable_layer), cached_loader, \
+            [hidden_states.filename, hidden_states.filename.replace('.hidden_states.npy', '.offsets.npy')]
+    cache_seconds, (cached_model, cached_loader, cache_files) = _measure(build_cache, device=device)
+
+    full_loader = DataLoader(dataset, collate_fn=PaddingCollator(pad_token_id=tokenizer.pad_token_id or 0),
+                             batch_sampler=LengthGroupedSampler(lengths=dataset.lengths, batch_size=batch_size))
+    cached_strategy = 'cached features (head only)' if is_encoder_frozen(model=model) else \
+        f"cached inputs of layer {first_trainable_layer}"
+    runs = {'whole model': (model, full_loader, 0.), cached_strategy: (cached_model, cached_loader, cache_seconds)}
+
+    initial_state, rows = deepcopy(model.state_dict()), []
+    for strategy, (trained_model, loader, build_seconds) in runs.items():
+        optimizer = torch.optim.AdamW(get_trainable_parameters(model=model), lr=5e-5)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lambda _: 1.)
+        seconds, _ = _measure(lambda: process_epoch(model=trained_model, data_loader=loader, loss_fn=loss_fn,
+                                                    device=device, mode='train', optimizer=optimizer,
+                                                    scheduler=scheduler), device=device)
+        model.load_state_dict(initial_state)
+
+        rows.append({'strategy': strategy, 'cache_build_seconds': build_seconds, 'epoch_seconds': seconds,
+                     'disk_bytes': sum(os.path.getsize(path) for path in cache_files) if build_seconds else 0})
+
+    return _get_report(rows=rows, index='strategy', seconds_column='epoch_seconds')
+
+
+def benchmark_frozen_prefix(model: 'torch.nn.Module', dataframe: pd.DataFrame, tokenizer, device: 'torch.device',
+                            batch_size: int = 64, loss_fn: 'torch.nn.Module|None' = None) -> pd.DataFrame:
+    """
+    Compares training the model as is (with AdamW over all its parameters) against training it through a
+    FrozenPrefixModel (no autograd in the frozen prefix, AdamW only over the trainable parameters). For each
+    one, measures the activations saved for the backward pass of the longest batch, the peak memory of the
+    device (only for CUDA) and the time of one epoch. The model is restored after each run.
+
+    :param model: torch.nn.Module. Model to train, already in the device and with its frozen layers set.
+    :param dataframe: pd.DataFrame. Data split with "text" and "label" columns.
+    :param tokenizer: callable. Tokenizer to use for tokenizing the texts.
+    :param device: torch.device. Device where the model is placed.
+    :param batch_size: int. Batch size to use for the training.
+    :param loss_fn: torch.nn.Module|None. Loss function. Plain cross entropy by default.
+
+    :return: pd.DataFrame. One row per strategy, with the saved activations (bytes), the peak device memory
+    (bytes, NaN if not in CUDA), the epoch time and its speedup.
+    """
+    import torch
+    from torch.utils.data import DataLoader
+    from .activation_cache import FrozenPrefixModel
+    from .training_utils import ToxicityDataset, PaddingCollator, LengthGroupedSampler, process_epoch, \
+        get_trainable_parameters
+
+    dataset = ToxicityDataset(dataframe=dataframe, tokenizer=tokenizer)
+    collator = PaddingCollator(pad_token_id=tokenizer.pad_token_id or 0)
+    loader = DataLoader(dataset, collate_fn=collator,
+                        batch_sampler=LengthGroupedSampler(lengths=dataset.lengths, batch_size=batch_size))
+    # The longest batch, the one that sets the memory needed
+    longest_batch = collator([dataset[idx] for idx in np.argsort(-dataset.lengths, kind='stable')[:batch_size]])
+    loss_fn = loss_fn or torch.nn.CrossEntropyLoss()
+
+    runs = {'autograd through the whole model': (model, model.parameters()),
+            'frozen prefix without autograd': (FrozenPrefixModel(model=model), get_trainable_parameters(model=model))}
+    initial_state, rows = deepcopy(model.state_dict()), []
+    for strategy, (trained_model, params) in runs.items():
+        optimizer = torch.optim.AdamW(params, lr=5e-5)
+        scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lambda _: 1.)
+
+        # Size of every tensor that autograd keeps for the backward pass
+        saved_bytes = []
+        trained_model.train()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        with torch.autograd.graph.saved_tensors_hooks(lambda tensor: saved_bytes.append(tensor.nbytes) or tensor,
+                                                      lambda tensor: tensor):
+            outputs = trained_model(**{key: value.to(device) for key, value in longest_batch.items() if key != 'labels'})
+            loss = loss_fn(outputs.logits, longest_batch['labels'].to(device))
+        loss.backward()
+        optimizer.zero_grad()
+        peak_memory = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else np.nan
+
+        seconds, _ = _measure(lambda: process_epoch(model=trained_model, data_loader=loader, loss_fn=loss_fn,
+                                                    device=device, mode='train', optimizer=optimizer,
+                                                    scheduler=scheduler), device=device)
+        model.load_state_dict(initial_state)
+
+        rows.append({'strategy': strategy, 'saved_activation_bytes': sum(saved_bytes),
+                     'peak_device_memory_bytes': peak_memory, 'epoch_seconds': seconds})
+
+    return _get_report(rows=rows, index='strategy', seconds_column='epoch_seconds')
+
+
+def benchmark_metrics_sync(model: 'torch.nn.Module', dataframe: pd.DataFrame, tokenizer, device: 'torch.device',
+                           batch_size: int = 64, sync_every: tuple[int, ...] = (1, 10, 50), repeats: int = 3,
+                           loss_fn: 'torch.nn.Module|None' = None) -> pd.DataFrame:
+    """
+    Measures the overhead of reading the metrics from the device during an epoch (see MetricsAccumulator), by
+    timing evaluation epochs (process_epoch) syncing them every 1 step (as reading them at each batch does) or
+    every few steps. Evaluation is used since its steps are the shortest, so the sync overhead is the most visible.
+
+    :param model: torch.nn.Module. Model to evaluate, already in the device.
+    :param dataframe: pd.DataFrame. Data split with "text" and "label" columns.
+    :param tokenizer: callable. Tokenizer to use for tokenizing the texts.
+    :param device: torch.device. Device where the model is placed.
+    :param batch_size: int. Batch size to use for the evaluation.
+    :param sync_every: tuple[int, ...]. Steps between syncs to compare. The first one is the baseline.
+    :param repeats: int. Number of epochs run for each value (the fastest one is kept).
+    :param loss_fn: torch.nn.Module|None. Loss function. Plain cross entropy by default.
+
+    :return: pd.DataFrame. One row per sync_every value, with the number of syncs, the epoch time, the speedup
+    over the baseline and the accuracy and loss obtained (which must be the same for all of them).
+    """
+    import torch
+    from torch.utils.data import DataLoader
+    from .training_utils import ToxicityDataset, PaddingCollator, LengthGroupedSampler, process_epoch
+
+    dataset = ToxicityDataset(dataframe=dataframe, tokenizer=tokenizer)
+    loader = DataLoader(dataset, collate_fn=PaddingCollator(pad_token_id=tokenizer.pad_token_id or 0),
+                        batch_sampler=LengthGroupedSampler(lengths=dataset.lengths, batch_size=batch_size,
+                                                           shuffle=False))
+    loss_fn = loss_fn or torch.nn.CrossEntropyLoss()
+
+    rows = []
+    for steps in sync_every:
+        seconds, (accuracy, mean_loss) = _measure(lambda: process_epoch(model=model, data_loader=loader,
+                                                                        loss_fn=loss_fn, device=device, mode='eval',
+                                                                        sync_every=steps), repeats=repeats)
+        rows.append({'sync_every': steps, 'syncs': -(-len(loader) // steps), 'epoch_seconds': seconds,
+                     'accuracy': accuracy, 'mean_loss': mean_loss})
+
+    return _get_report(rows=rows, index='sync_every', seconds_column='epoch_seconds')
+
+
+def benchmark_checkpoint_loading(model_path: str, worker_counts: tuple[int, ...] = (1, 8)) -> pd.DataFrame:
+    """
+    Compares loading a checkpoint in several processes at once (as ShardedPredictor does) by unpickling a copy
+    of it in each process (torch.load of the .pt file, the previous behaviour) against memory-mapping its
+    safetensors version and assigning it to the model (MODEL_REGISTRY). Memory is measured with all the processes
+    alive, as their resident memory (RSS, counting shared pages in every process) and their proportional set
+    size (PSS, splitting shared pages between the processes that map them, so its total is the real memory used).
+    Linux only, since memory is read from /proc.
+
+    :param model_path: str. Path to the model's state dict (.pt file). Its safetensors version is written next
+    to it if it doesn't exist.
+    :param worker_counts: tuple[int, ...]. Number of processes loading the checkpoint at the same time.
+
+    :return: pd.DataFrame. One row per format and number of processes, with the mean load time (from building
+    the model until its weights are ready), the mean RSS of each process and the total PSS of all of them.
+    """
+    from .checkpointing import SAFETENSORS_EXTENSION, convert_to_safetensors
+
+    safetensors_path = os.path.splitext(model_path)[0] + SAFETENSORS_EXTENSION
+    if not os.path.isfile(safetensors_path):
+        safetensors_path = convert_to_safetensors(model_path=model_path)
+
+    context, rows = multiprocessing.get_context('spawn'), []
+    for checkpoint_format, path in (('pickle (.pt, copied)', model_path),
+                                    ('safetensors (memory-mapped)', safetensors_path)):
+        for num_workers in worker_counts:
+            all_loaded, results = context.Barrier(num_workers + 1), context.Queue()
+            workers = [context.Process(target=_load_checkpoint_worker, args=(path, all_loaded, results))
+                       for _ in range(num_workers)]
+            for worker in workers:
+                worker.start()
+            # Workers measure their memory once all of them have loaded the model, and wait until all are measured
+            all_loaded.wait()
+            measures = [results.get() for _ in workers]
+            all_loaded.wait()
+            for worker in workers:
+                worker.join()
+
+            load_seconds, rss, pss = zip(*measures)
+            rows.append({'format': checkpoint_format, 'processes': num_workers,
+                         'mean_load_seconds': np.mean(load_seconds), 'mean_rss_bytes': np.mean(rss),
+                         'total_pss_bytes': np.sum(pss)})
+
+    return _get_report(rows=rows, index=['format', 'processes'], seconds_column='mean_load_seconds', speedup=False)
+
+
+def benchmark_model_construction(model_path: str, repeats: int = 3) -> pd.DataFrame:
+    """
+    Compares building the model for inference by loading the pretrained weights of MODEL_NAME and then
+    overwriting them with the checkpoint (the previous behaviour), against building it in the meta device from
+    the config.json of the checkpoint and assigning the checkpoint's weights to it (MODEL_REGISTRY). Each build
+    runs in a fresh process, so its peak memory (max RSS) and its startup time are not affected by the others.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param repeats: int. Number of processes run for each strategy (the mean is reported).
+
+    :return: pd.DataFrame. One row per strategy, with the mean time needed for building the model, its speedup
+    over the pretrained weights and the mean peak RSS of the process.
+    """
+    context, rows = multiprocessing.get_context('spawn'), []
+    for strategy, from_pretrained in (('pretrained weights + load_state_dict', True),
+                                      ('meta device + assign (MODEL_REGISTRY)', False)):
+        measures = []
+        for _ in range(repeats):
+            results = context.Queue()
+            worker = context.Process(target=_build_model_worker, args=(model_path, from_pretrained, results))
+            worker.start()
+            measures.append(results.get())
+            worker.join()
+
+        build_seconds, peak_rss = zip(*measures)
+        rows.append({'strategy': strategy, 'mean_build_seconds': np.mean(build_seconds),
+                     'mean_peak_rss_bytes': np.mean(peak_rss)})
+
+    return _get_report(rows=rows, index='strategy', seconds_column='mean_build_seconds')
+
+
+def benchmark_import_time(modules: tuple[str, ...] = ('score', 'parallel_inference', 'model_performance_analysis',
+                                                      'onnx_backend', 'training_utils', 'analysis_utils',
+                                                      'model_performance_visualization', 'analysis_visualization'),
+                          heavy_dependencies: tuple[str, ...] = ('torch', 'transformers', 'onnxruntime', 'sklearn',
+                                                                 'matplotlib', 'IPython', 'spacy'),
+                          repeats: int = 3) -> pd.DataFrame:
+    """
+    Measures the time needed for importing each entry point of the utils package in a fresh Python process
+    (so nothing is already imported), and which heavy dependencies each one loads.
+
+    :param modules: tuple[str, ...]. Modules of the utils package to import.
+    :param heavy_dependencies: tuple[str, ...]. Top-level packages to check in sys.modules after the import.
+    :param repeats: int. Number of processes run for each module (the fastest one is kept).
+
+    :return: pd.DataFrame. One row per module, with its import time and the heavy dependencies it loaded.
+    """
+    code = "import json, sys, time; start = time.perf_counter(); import {module}; " \
+           "seconds = time.perf_counter() - start; " \
+           "print(json.dumps([seconds, [name for name in {heavy_dependencies} if name in sys.modules]]))"
+    # Same import paths as this process, so the package is found however it was imported (e.g. from a notebook)
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(path for path in sys.path if path)}
+
+    rows = []
+    for module in modules:
+        timings = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, '-c', code.format(module=f"{__package__}.{module}",
+                                                                       heavy_dependencies=list(heavy_dependencies))],
+                                    env=env, cwd=os.getcwd(), capture_output=True, text=True, check=True).stdout
+            seconds, loaded_dependencies = json.loads(output.strip().splitlines()[-1])
+            timings.append(seconds)
+        rows.append({'module': module, 'import_seconds': min(timings),
+                     'heavy_dependencies': ', '.join(loaded_dependencies)})
+
+    return _get_report(rows=rows, index='module', seconds_column='import_seconds', speedup=False)
+
+
+def benchmark_corpus_processing(nlp: 'Language', dataframe: pd.DataFrame, batch_size: int = 256,
+                                process_counts: tuple[int, ...] = (2, 4)) -> pd.DataFrame:
+    """
+    Compares the throughput of processing a split with the spaCy pipeline as the word analysis used to (calling
+    nlp once per row of DataFrame.iterrows) with the batched nlp.pipe of corpus_processing.process_corpus, in
+    this process and across several worker processes.
+
+    :param nlp: Language. The spaCy pipeline (e.g. spacy.load(SPACY_MODEL)).
+    :param dataframe: pd.DataFrame. The split to process, with "text", "label" and "origin" columns.
+    :param batch_size: int. Number of texts processed together by nlp.pipe.
+    :param process_counts: tuple[int, ...]. Numbers of worker processes to test for nlp.pipe.
+
+    :return: pd.DataFrame. One row per strategy, with the elapsed time, the throughput (docs/s) and the speedup
+    over the iterrows loop.
+    """
+    def iterrows_loop():
+        for _, entry in dataframe[[TEXT, LABEL, ORIGIN]].iterrows():
+            nlp(entry[TEXT])
+
+    strategies = {'iterrows loop': iterrows_loop,
+                  **{f"nlp.pipe ({n_process} processes)": lambda n_process=n_process:
+                     process_corpus(nlp=nlp, dataframes={TRAIN: dataframe}, batch_size=batch_size,
+                                    n_process=n_process) for n_process in (1, *process_counts)}}
+
+    rows = [{'strategy': strategy, 'seconds': _measure(process)[0]} for strategy, process in strategies.items()]
+    return _get_report(rows=rows, index='strategy', throughput=('docs_per_second', len(dataframe)))
+
+
+def benchmark_lemma_profile(dataframe: pd.DataFrame, model_name: str = SPACY_MODEL,
+                            batch_size: int = 256) -> pd.DataFrame:
+    """
+    Compares the full spaCy pipeline with its lemma profile (see corpus_processing.load_lemma_pipeline) when
+    processing a split for the word analysis. Each pipeline is loaded in a fresh process, so the memory of one
+    doesn't count in the other.
+
+    :param dataframe: pd.DataFrame. The split to process, with "text", "label" and "origin" columns.
+    :param model_name: str. Name (or path) of the spaCy pipeline.
+    :param batch_size: int. Number of texts processed together by nlp.pipe.
+
+    :return: pd.DataFrame. One row per profile, with its components, the time for loading it, the latency per
+    document, the memory taken by the pipeline and its Docs (peak resident memory of the process over the memory
+    before loading it) and whether its word frequencies (get_word_freqs) are the same as the full pipeline ones.
+
+    :raises AssertionError: if the word frequencies of the lemma profile differ from the full pipeline ones.
+    """
+    rows, word_freqs = [], {}
+    for profile, lemma_profile in (('full pipeline', False), ('lemma profile', True)):
+        results = multiprocessing.get_context('spawn').Queue()
+        worker = multiprocessing.get_context('spawn').Process(target=_process_corpus_worker,
+                                                               args=(model_name, lemma_profile, dataframe,
+                                                                     batch_size, results))
+        worker.start()
+        components, load_seconds, process_seconds, memory, word_freqs[profile] = results.get()
+        worker.join()
+        rows.append({'profile': profile, 'components': ', '.join(components), 'load_seconds': load_seconds,
+                     'ms_per_doc': process_seconds / len(dataframe) * 1000, 'memory_bytes': memory,
+                     'same_word_freqs': word_freqs[profile] == word_freqs['full pipeline']})
+
+    assert rows[-1]['same_word_freqs'], "Word frequencies of the lemma profile differ from the full pipeline ones."
+    return _get_report(rows=rows, index='profile', seconds_column='load_seconds', speedup=False)
+
+
+def benchmark_lemma_store(nlp: 'Language', dataframe: pd.DataFrame, batch_size: int = 256) -> pd.DataFrame:
+    """
+    Compares the memory taken by the processed corpus when keeping every spaCy Doc and when reducing them to a
+    LemmaStore (see corpus_processing.process_corpus), and the time for counting their word frequencies.
+
+    :param nlp: Language. The spaCy pipeline (e.g. load_lemma_pipeline(SPACY_MODEL)).
+    :param dataframe: pd.DataFrame. The split to process, with "text", "label" and "origin" columns.
+    :param batch_size: int. Number of texts processed together by nlp.pipe.
+
+    :return: pd.DataFrame. One row per representation, with the memory allocated for it (traced by tracemalloc,
+    including the Docs internals and the string table), the reduction over keeping the Docs, the time for
+    counting the word frequencies and whether they are the same as the ones of the Docs.
+
+    :raises AssertionError: if the word frequencies of the LemmaStore differ from the ones of the Docs.
+    """
+    rows, word_freqs = [], {}
+    for representation, keep_docs in (('spaCy Docs', True), ('LemmaStore', False)):
+        gc.collect()
+        tracemalloc.start()
+        processed_words = process_corpus(nlp=nlp, dataframes={TRAIN: dataframe}, batch_size=batch_size,
+                                         keep_docs=keep_docs)
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        seconds, word_freqs[representation] = _measure(lambda: get_word_freqs(processed_words=processed_words))
+        rows.append({'representation': representation, 'memory_bytes': memory,
+                     'memory_reduction': rows[0]['memory_bytes'] / memory if rows else 1.,
+                     'count_seconds': seconds,
+                     'same_word_freqs': word_freqs[representation] == word_freqs['spaCy Docs']})
+        del processed_words
+
+    assert rows[-1]['same_word_freqs'], "Word frequencies of the LemmaStore differ from the ones of the Docs."
+    return _get_report(rows=rows, index='representation', seconds_column='count_seconds', speedup=False)
+
+
+def benchmark_word_freqs(nlp: 'Language', dataframe: pd.DataFrame, batch_size: int = 256,
+                         repeats: int = 3) -> pd.DataFrame:
+    """
+    Compares the throughput of counting the word frequencies of a processed split as get_word_freqs used to
+    (a Counter fed by a generator over every token, reading its lemma and flags one by one) with the vectorized
+    counting of get_word_freqs, over the Docs and over their LemmaStore.
+
+    :param nlp: Language. The spaCy pipeline (e.g. load_lemma_pipeline(SPACY_MODEL)).
+    :param dataframe: pd.DataFrame. The split to process, with "text", "label" and "origin" columns.
+    :param batch_size: int. Number of texts processed together by nlp.pipe.
+    :param repeats: int. Number of times each strategy is run (the fastest one is kept).
+
+    :return: pd.DataFrame. One row per strategy, with the elapsed time, the throughput (tokens/s), the speedup
+    over the per-token generator and whether the word frequencies (and the order of their ties) are the same.
+
+    :raises AssertionError: if the word frequencies of any strategy differ from the per-token generator ones.
+    """
+    docs_by_group = process_corpus(nlp=nlp, dataframes={TRAIN: dataframe}, batch_size=batch_size,
+                                   keep_docs=True)[TRAIN]
+    stores_by_group = {label: {origin: LemmaStore.from_token_attributes(
+                                   token_attributes=[get_token_attributes(docs=[doc]) for doc in docs],
+                                   strings=nlp.vocab.strings)
+                               for origin, docs in docs_by_origin.items()}
+                       for label, docs_by_origin in docs_by_group.items()}
+    tokens = sum(len(doc) for docs_by_origin in docs_by_group.values() for docs in docs_by_origin.values()
+                 for doc in docs)
+
+    def per_token_generator():
+        return {label: {origin: Counter(word.lemma_.lower() for doc in docs for word in doc
+                                        if not word.is_stop and not word.is_punct and not word.is_space)
+                        for origin, docs in docs_by_origin.items()}
+                for label, docs_by_origin in docs_by_group.items()}
+
+    strategies = {'per-token generator': per_token_generator,
+                  'vectorized (Docs)': lambda: get_word_freqs(processed_words=docs_by_group),
+                  'vectorized (LemmaStore)': lambda: get_word_freqs(processed_words=stores_by_group)}
+
+    rows, word_freqs = [], {}
+    for strategy, count in strategies.items():
+        seconds, word_freqs[strategy] = _measure(count, repeats=repeats)
+        # Same counts and same order (the ties of most_common depend on it)
+        same_word_freqs = all(list(word_freqs[strategy][label][origin].items()) ==
+                              list(word_freqs['per-token generator'][label][origin].items())
+                              for label in docs_by_group for origin in docs_by_group[label])
+        rows.append({'strategy': strategy, 'seconds': seconds, 'same_word_freqs': same_word_freqs})
+
+    assert all(row['same_word_freqs'] for row in rows), "Word frequencies differ from the per-token generator ones."
+    return _get_report(rows=rows, index='strategy', throughput=('tokens_per_second', tokens))
+
+
+# ------------------------------- AUXILIARY FUNCTIONS ---------------------------------------------
+
+def _measure(function: Callable[[], Any], repeats: int = 1, device: 'torch.device|None' = None) -> tuple[float, Any]:
+    """
+    Times a function. If it runs in a CUDA device, its pending kernels are waited for before starting and before
+    stopping the timer, since they run asynchronously.
+
+    :param function: Callable[[], Any]. Function to time, without arguments.
+    :param repeats: int. Number of times it's run (the fastest one is kept).
+    :param device: torch.device|None. Device where the function runs. None for CPU only functions.
+
+    :return: tuple[float, Any]. The elapsed seconds of the fastest run and the result of the last one.
+    """
+    def synchronize():
+        if device is not None and device.type == 'cuda':
+            import torch
+            torch.cuda.synchronize(device)
+
+    timings, result = [], None
+    for _ in range(repeats):
+        synchronize()
+        start = perf_counter()
+        result = function()
+        synchronize()
+        timings.append(perf_counter() - start)
+    return min(timings), result
+
+
+def _get_report(rows: list[dict], index: str|list[str], seconds_column: str = 'seconds',
+                throughput: tuple[str, int]|None = None, speedup: bool = True) -> pd.DataFrame:
+    """
+    Builds the table of a benchmark, adding the throughput and the speedup of each row next to its time.
+
+    :param rows: list[dict]. One dict per row, with the index column(s) and the elapsed seconds.
+    :param index: str|list[str]. Column(s) that identify each row.
+    :param seconds_column: str. Column with the elapsed seconds.
+    :param throughput: tuple[str, int]|None. Name of the throughput column and number of items processed in each
+    row (e.g. ('texts_per_second', len(texts))). None for not adding it.
+    :param speedup: bool. Whether to add the speedup of each row over the first one (the baseline).
+
+    :return: pd.DataFrame. The table of the benchmark, indexed by the given column(s).
+    """
+    report = pd.DataFrame(rows).set_index(index)
+    position = report.columns.get_loc(seconds_column) + 1
+    if throughput is not None:
+        name, items = throughput
+        report.insert(position, name, items / report[seconds_column])
+        position += 1
+    if speedup:
+        report.insert(position, 'speedup', report[seconds_column].iloc[0] / report[seconds_column])
+    return report
+
+
+# ------------------------------- WORKER FUNCTIONS ---------------------------------------------
+
+def _load_checkpoint_worker(model_path: str, all_loaded: multiprocessing.synchronize.Barrier,
+                            results: multiprocessing.Queue):
+    import torch
+    from transformers import DistilBertForSequenceClassification
+    from .checkpointing import SAFETENSORS_EXTENSION
+    from .model_registry import MODEL_REGISTRY
+
+    torch.set_num_threads(1)
+    start = perf_counter()
+    if model_path.endswith(SAFETENSORS_EXTENSION):
+        model = MODEL_REGISTRY.get_model(model_path=model_path, device=torch.device('cpu'))
+    else:
+        model = DistilBertForSequenceClassification.from_pretrained(MODEL_NAME, num_labels=2,
+                                                                    ignore_mismatched_sizes=True)
+        model.load_state_dict(torch.load(model_path, map_location='cpu', weights_only=True))
+    load_seconds = perf_counter() - start
+
+    # Read every weight (as the first prediction does), so all the pages of the checkpoint are mapped
+    with torch.no_grad():
+        for param in model.parameters():
+            param.sum()
+
+    all_loaded.wait()
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        # Lines like "Rss:   123456 kB"
+        memory = {name.rstrip(':'): int(value) * 1024 for name, value, *_ in (line.split() for line in f)
+                  if name in ('Rss:', 'Pss:')}
+    results.put((load_seconds, memory['Rss'], memory['Pss']))
+    all_loaded.wait()
+
+
+def _build_model_worker(model_path: str, from_pretrained: bool, results: multiprocessing.Queue):
+    import torch
+    from transformers import DistilBertForSequenceClassification
+    from .checkpointing import load_state_dict_file
+    from .model_registry import MODEL_REGISTRY
+
+    torch.set_num_threads(1)
+    start = perf_counter()
+    if from_pretrained:
+        model = DistilBertForSequenceClassification.from_pretrained(MODEL_NAME, num_labels=2,
+                                                                    ignore_mismatched_sizes=True)
+        model.load_state_dict(load_state_dict_file(path=model_path))
+    else:
+        model = MODEL_REGISTRY.get_model(model_path=model_path, device=torch.device('cpu'))
+    build_seconds = perf_counter() - start
+    # Peak resident memory of the process (in KB in Linux)
+    results.put((build_seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+
+def _process_corpus_worker(model_name: str, lemma_profile: bool, dataframe: pd.DataFrame, batch_size: int,
+                           results: multiprocessing.Queue):
+    # Resident memory before loading the pipeline (second field of statm, in pages)
+    with open('/proc/self/statm', 'r') as f:
+        memory_before = int(f.read().split()[1]) * resource.getpagesize()
+    start = perf_counter()
+    if lemma_profile:
+        nlp = load_lemma_pipeline(model_name=model_name)
+    else:
+        import spacy
+        nlp = spacy.load(model_name)
+    load_seconds = perf_counter() - start
+
+    start = perf_counter()
+    processed_words = process_corpus(nlp=nlp, dataframes={TRAIN: dataframe}, batch_size=batch_size)
+    process_seconds = perf_counter() - start
+    # Peak resident memory of the process (in KB in Linux), while the pipeline and all the Docs are in memory
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - memory_before
+    results.put((list(nlp.pipe_names), load_seconds, process_seconds, memory, get_word_freqs(processed_words)))
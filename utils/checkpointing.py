@@ -0,0 +1,282 @@
+"""
+A set of classes and functions for saving the training checkpoints without stopping the training. The weights
+are copied to CPU memory (a quick copy, without moving the model out of its device) and written to disk by a
+background thread while the next epoch runs. Every file is written to a temporary path and then renamed, so
+a crash (or a Colab disconnection) in the middle of a write never leaves a torn checkpoint.
+When most of the model is frozen, checkpoints can also be saved as deltas: only the trainable parameters, plus
+the name and the hash of the (frozen) base weights they must be applied to.
+Checkpoints are written as safetensors: loading them memory-maps the file instead of unpickling it, so it's
+almost instant, runs no code from the file and several processes reading the same checkpoint share its pages.
+"""
+import json
+import os
+import queue
+import threading
+from hashlib import blake2b
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from .constants import BEST_MODEL, LEGACY_BEST_MODEL
+
+SAFETENSORS_EXTENSION = '.safetensors'
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes state dicts and JSON files in a background thread, in the same order they were submitted (so the
+    metrics.json of an epoch is never written before the checkpoints of that epoch). Errors of the background
+    thread are raised by the next call to any of its methods.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._write_loop, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def save_state_dict(self, state_dict: dict[str, torch.Tensor], path: str):
+        """
+        Snapshots the given state dict to CPU memory and queues its writing. It returns as soon as the
+        snapshot is taken, so the model can be trained again right away.
+
+        :param state_dict: dict[str, torch.Tensor]. The state dict to save (in any device).
+        :param path: str. Path of the file to write. Its extension sets the format (see save_state_dict_file).
+        """
+        self._raise_error()
+        snapshot = get_cpu_snapshot(state_dict=state_dict)
+        self._queue.put((_write_state_dict, (snapshot, path, _record_copies(state_dict=state_dict), None)))
+
+    def save_delta(self, model: torch.nn.Module, path: str, base_model: str, base_hash: str):
+        """
+        Same as save_state_dict, but saving only the trainable parameters of the model (see load_delta_checkpoint).
+
+        :param model: torch.nn.Module. The model to save, with its frozen layers set.
+        :param path: str. Path of the .safetensors file to write. The base model and hash go in its metadata.
+        :param base_model: str. Name (or path) of the pretrained model the frozen weights come from.
+        :param base_hash: str. Hash of the frozen weights (see get_base_hash). It's not computed here, since
+        hashing the whole model at every epoch would take longer than saving it.
+
+        :raises AssertionError: if the path is not a .safetensors file.
+        """
+        self._raise_error()
+        assert path.endswith(SAFETENSORS_EXTENSION), f"Deltas are saved as {SAFETENSORS_EXTENSION}. Got {path}."
+        delta = get_delta_state_dict(model=model)
+        self._queue.put((_write_state_dict, (get_cpu_snapshot(state_dict=delta), path,
+                                             _record_copies(state_dict=delta),
+                                             {'base_model': base_model, 'base_hash': base_hash})))
+
+    def save_json(self, content: dict, path: str):
+        """
+        Queues the writing of a JSON file (e.g. the metrics), after all the checkpoints already queued.
+
+        :param content: dict. JSON-serializable content. It's copied, so it can be modified right away.
+        :param path: str. Path of the .json file to write.
+        """
+        self._raise_error()
+        self._queue.put((_write_json, (json.loads(json.dumps(content)), path)))
+
+    def wait(self):
+        """
+        Blocks until every queued file is written.
+
+        :raises Exception: the first error raised while writing, if any.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Waits for the queued files and stops the background thread. The writer can't be used afterwards.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _write_loop(self):
+        while (task := self._queue.get()) is not None:
+            write_fn, args = task
+            try:
+                # After an error, skip the rest of files, to not write a metrics.json pointing to missing weights
+                if self._error is None:
+                    write_fn(*args)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+        self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+
+def get_cpu_snapshot(state_dict: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+    """
+    Returns a copy of the state dict in CPU memory, that's not modified when the model keeps training. Copies from
+    CUDA are asynchronous (to pinned memory), so they must be synchronized before reading the snapshot.
+
+    :param state_dict: dict[str, torch.Tensor]. The state dict to copy (in any device).
+
+    :return: dict[str, torch.Tensor]. The copied state dict, with the same keys, in CPU memory.
+    """
+    return {key: tensor.detach().to('cpu', non_blocking=True) if tensor.is_cuda else tensor.detach().clone()
+            for key, tensor in state_dict.items()}
+
+
+def save_state_dict_file(state_dict: dict[str, torch.Tensor], path: str, metadata: dict[str, str]|None = None):
+    """
+    Atomically writes a state dict (in CPU memory) to disk, as safetensors if the path ends with .safetensors or
+    pickled with torch.save otherwise.
+
+    :param state_dict: dict[str, torch.Tensor]. The state dict to write.
+    :param path: str. Path of the file to write.
+    :param metadata: dict[str, str]|None. Metadata stored in the header (only for safetensors).
+
+    :raises AssertionError: if metadata is given for a file that is not safetensors.
+    """
+    if path.endswith(SAFETENSORS_EXTENSION):
+        # safetensors only stores contiguous tensors
+        save_file({key: tensor.contiguous() for key, tensor in state_dict.items()}, f"{path}.tmp",
+                  metadata=metadata)
+    else:
+        assert metadata is None, f"Metadata can only be stored in {SAFETENSORS_EXTENSION} files. Got {path}."
+        torch.save(state_dict, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def load_state_dict_file(path: str) -> dict[str, torch.Tensor]:
+    """
+    Reads a state dict from disk without copying it: safetensors and .pt files (through torch.load with mmap)
+    are memory-mapped, so their tensors are read lazily from the page cache, which is shared by all the
+    processes loading the same file. Load it with model.load_state_dict(..., assign=True) to keep it zero-copy.
+    Pickled .pt files are read with weights_only, so they can't run arbitrary code either.
+
+    :param path: str. Path of the .safetensors or .pt file.
+
+    :return: dict[str, torch.Tensor]. The state dict, in CPU memory.
+    """
+    if path.endswith(SAFETENSORS_EXTENSION):
+        return load_file(path, device='cpu')
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+
+def convert_to_safetensors(model_path: str) -> str:
+    """
+    Writes a copy of a .pt checkpoint (e.g. a best_model.pt of an older experiment) as safetensors, next to it.
+
+    :param model_path: str. Path of the .pt state dict.
+
+    :return: str. Path of the .safetensors copy.
+
+    :raises AssertionError: if the model path is not a file.
+    """
+    assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+    safetensors_path = os.path.splitext(model_path)[0] + SAFETENSORS_EXTENSION
+    save_state_dict_file(state_dict=load_state_dict_file(path=model_path), path=safetensors_path)
+    return safetensors_path
+
+
+def get_best_model_path(checkpoint_dir: str) -> str:
+    """
+    Returns the path of the best model of an experiment. Older experiments only saved it as best_model.pt, so
+    if that's the only one found, it's converted to safetensors first (only once, the copy is kept next to it).
+
+    :param checkpoint_dir: str. Checkpoint directory of the experiment.
+
+    :return: str. Path of the best model (best_model.safetensors). It may not exist if the experiment has no best
+    model yet.
+    """
+    best_model_path = os.path.join(checkpoint_dir, BEST_MODEL)
+    legacy_best_model_path = os.path.join(checkpoint_dir, LEGACY_BEST_MODEL)
+    if not os.path.isfile(best_model_path) and os.path.isfile(legacy_best_model_path):
+        best_model_path = convert_to_safetensors(model_path=legacy_best_model_path)
+    return best_model_path
+
+
+def get_delta_state_dict(model: torch.nn.Module) -> dict[str, torch.Tensor]:
+    """
+    Returns the part of the state dict of the model that is trained (the parameters with requires_grad).
+
+    :param model: torch.nn.Module. The model, with its frozen layers set.
+
+    :return: dict[str, torch.Tensor]. The trainable parameters, by their state dict key.
+    """
+    return {name: param for name, param in model.named_parameters() if param.requires_grad}
+
+
+def get_base_hash(model: torch.nn.Module, delta_keys: set[str]|None = None) -> str:
+    """
+    Returns a hash of the weights of the model that are not part of its delta (see get_delta_state_dict).
+
+    :param model: torch.nn.Module. The model to hash.
+    :param delta_keys: set[str]|None. Keys of the delta. If None, the trainable parameters of the model.
+
+    :return: str. The hexadecimal hash of the base weights.
+    """
+    if delta_keys is None:
+        delta_keys = set(get_delta_state_dict(model=model))
+    return get_state_dict_hash(state_dict={key: tensor for key, tensor in model.state_dict().items()
+                                           if key not in delta_keys})
+
+
+def get_state_dict_hash(state_dict: dict[str, torch.Tensor]) -> str:
+    """
+    Returns a hash of the names and the content of all the tensors of a state dict.
+
+    :param state_dict: dict[str, torch.Tensor]. The state dict to hash.
+
+    :return: str. The hexadecimal hash of the tensors.
+    """
+    weights_hash = blake2b(digest_size=16)
+    for name, tensor in sorted(state_dict.items()):
+        weights_hash.update(name.encode('utf-8'))
+        weights_hash.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return weights_hash.hexdigest()
+
+
+def load_delta_checkpoint(model: torch.nn.Module, path: str) -> torch.nn.Module:
+    """
+    Loads a delta checkpoint (.safetensors saved with AsyncCheckpointWriter.save_delta) into a model built from its base
+    weights, e.g. DistilBertForSequenceClassification.from_pretrained(base_model, ...).
+
+    :param model: torch.nn.Module. The model with the base weights. It's modified in place.
+    :param path: str. Path of the delta checkpoint.
+
+    :return: torch.nn.Module. The same model, with the trained parameters of the checkpoint.
+
+    :raises AssertionError: if the base weights of the model are not the ones the delta was trained from, or if
+    the delta contains keys that are not in the model.
+    """
+    with safe_open(path, framework='pt') as f:
+        metadata = f.metadata()
+    delta = load_state_dict_file(path=path)
+    base_hash = get_base_hash(model=model, delta_keys=set(delta))
+    assert base_hash == metadata['base_hash'], f"The delta {path} was trained from other base weights " \
+                                               f"({metadata['base_model']}, hash {metadata['base_hash']})."
+    unexpected_keys = model.load_state_dict(delta, strict=False).unexpected_keys
+    assert not unexpected_keys, f"Keys of {path} not found in the model: {unexpected_keys}"
+    return model
+
+
+def _record_copies(state_dict: dict[str, torch.Tensor]) -> torch.cuda.Event|None:
+    # Device to host copies are asynchronous, record when they are finished so the thread waits for them
+    if not any(tensor.is_cuda for tensor in state_dict.values()):
+        return None
+    copied = torch.cuda.Event()
+    copied.record()
+    return copied
+
+
+def _write_state_dict(state_dict: dict[str, torch.Tensor], path: str, copied: torch.cuda.Event|None,
+                      metadata: dict[str, str]|None):
+    if copied is not None:
+        copied.synchronize()
+    save_state_dict_file(state_dict=state_dict, path=path, metadata=metadata)
+
+
+def _write_json(content: dict, path: str):
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(content, f)
+    os.replace(f"{path}.tmp", path)
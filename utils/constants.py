@@ -14,6 +14,7 @@ TWITTER, NEWS = 'twitter', 'news-articles'
 
 # Dataset columns
 ID, TEXT, LABEL, ORIGIN = 'id','text','label','origin'
+PROBABILITY = 'probability'
 ID_TYPE, ENGLISH, FRENCH = 'id-type','english','french'
 
 # Regex
@@ -39,6 +40,15 @@ TRUE_LABELS, PRED_LABELS, PRED_PROBS = 'true_labels', 'pred_labels', 'pred_probs
 MODEL_NAME = 'lxyuan/distilbert-base-multilingual-cased-sentiments-student'
 MODEL_MAX_LENGTH = 512
 
+# spaCy pipeline used for the word analysis
+SPACY_MODEL = 'es_core_news_lg'
+
+# Maximum memory (in bytes) that the models kept warm by the model registry can occupy
+MODEL_REGISTRY_MEMORY_BUDGET = 4 * 1024 ** 3
+
+# Inference backends
+FP32_BACKEND, INT8_BACKEND, ONNX_BACKEND = 'fp32', 'int8', 'onnx'
+
 # Experiment names
 ONLY_FREEZE_EMBEDDINGS = 'only_freeze_embeddings'
 FREEZE_ALL_TRANSFORMER_LAYERS_EXCEPT_LAST = 'freeze_all_transformer_layers_except_last'
@@ -52,10 +62,25 @@ CHECKPOINT_PATHS = {
     FREEZE_ALL_TRANSFORMER_LAYERS: os.path.join(CHECKPOINTS_PARENT_DIR, FREEZE_ALL_TRANSFORMER_LAYERS)
 }
 
+# Cache Paths (in Drive too, so they are kept between sessions). Set the TOXICITY_ANALYSIS_CACHE_DIR environment
+# variable (before importing the package) to store them elsewhere, e.g. an absolute path for scripts and workers
+CACHE_PARENT_DIR = os.environ.get(f"{REPO_NAME.upper()}_CACHE_DIR", os.path.join(CHECKPOINTS_PARENT_DIR, 'cache'))
+TOKENIZATION_CACHE_DIR = os.path.join(CACHE_PARENT_DIR, 'tokenization')
+ACTIVATION_CACHE_DIR = os.path.join(CACHE_PARENT_DIR, 'activations')
+CORPUS_CACHE_DIR = os.path.join(CACHE_PARENT_DIR, 'corpora')  # spaCy Docs of the word analysis
+
 # File Names
 METRICS_JSON_FILE = 'metrics.json'
 FULL_MODEL_LAST, MODEL_LAST = 'full_model_last.pt', 'model_last.pt'
-BEST_MODEL = 'best_model.pt'
+MODEL_CONFIG_FILE = 'config.json'  # Architecture of the checkpoints of an experiment, for building them offline
+TOKENIZER_CONFIG_FILE = 'tokenizer_config.json'  # Saved with the tokenizer, next to the checkpoints, for scoring offline
+BEST_MODEL = 'best_model.safetensors'  # Memory-mapped when loaded
+LEGACY_BEST_MODEL = 'best_model.pt'  # Saved by older experiments (see checkpointing.get_best_model_path)
+# Trainable parameters only, applied over the pretrained weights (see checkpointing.load_delta_checkpoint)
+MODEL_LAST_DELTA = 'model_last.delta.safetensors'
+INT8_MODEL_SUFFIX = '.int8.pt'  # Dynamic-quantized state dict, saved next to its source checkpoint (appended to its name)
+ONNX_MODEL_SUFFIX, ONNX_TOKENIZER_SUFFIX = '.onnx', '.tokenizer.json'  # ONNX graph and its tokenizer, same place
+SCORE_PROGRESS_FILE, SCORE_SHARD_NAME = 'progress.json', 'part-{:05d}.csv'  # Batch scoring (utils.score) output
 
 
 TRAIN_LOSS_HIST, TRAIN_ACC_HIST = 'train_loss_hist', 'train_acc_hist'
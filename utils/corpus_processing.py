@@ -0,0 +1,318 @@
+"""
+The ingestion stage of the word analysis: texts of each data split are processed by the spaCy pipeline and the
+resulting Docs are grouped by label and origin, in the {split: {label: {origin: [Doc, ...]}}} structure consumed
+by analysis_utils.get_word_freqs.
+Texts are streamed through nlp.pipe, which runs each component over whole batches of texts (instead of one text
+at a time) and can spread the batches across several worker processes.
+The word analysis only reads the lemma and the stop word, punctuation and space flags of each token, so the
+pipeline can be loaded with the lemma profile (see load_lemma_pipeline), without the components that don't
+produce them, and each Doc can be reduced to those attributes as soon as it's processed (see LemmaStore).
+The processed Docs can also be cached on disk (see load_corpus), so they are not processed again in every session.
+"""
+import os
+from collections import Counter
+from hashlib import blake2b
+from typing import TYPE_CHECKING, Iterator
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from .constants import TEXT, LABEL, ORIGIN, TOXIC, NON_TOXIC, TWITTER, NEWS, SPACY_MODEL, CORPUS_CACHE_DIR
+
+if TYPE_CHECKING:
+    # spaCy takes a few seconds to import, it's only needed for the annotations (the pipeline is given)
+    from spacy.language import Language
+    from spacy.strings import StringStore
+    from spacy.tokens import Doc, DocBin
+
+# Components of the spaCy pipelines that the lemmas don't depend on: the dependency parser, the named entity
+# recognizer and the sentence segmenter (disabled by default). The lemmatizer only needs the part of speech and
+# the morphology (tok2vec -> morphologizer -> attribute_ruler). Stop words, punctuation and spaces are lexical
+# attributes, set by the tokenizer
+LEMMA_PROFILE_EXCLUDED_COMPONENTS = ('parser', 'ner', 'senter')
+
+# Bits of the flags of each token in a LemmaStore
+IS_STOP_FLAG, IS_PUNCT_FLAG, IS_SPACE_FLAG = 1, 2, 4
+
+
+class LemmaStore:
+    """
+    Compact version of a list of Docs, with only what the word analysis reads: the hash of the lemma of every
+    token (uint64, the same hashes as in the StringStore of spaCy) and its stop word, punctuation and space
+    flags (uint8, see IS_STOP_FLAG), for all the Docs concatenated, and the offsets (int64) where each Doc
+    starts. Keeping every Doc pins its tokens, tensors and morphology, which take over an order of magnitude
+    more memory. The lemma strings are in a table shared by all the stores of a corpus, so each one is kept once.
+    """
+
+    def __init__(self, lemmas: np.ndarray, flags: np.ndarray, offsets: np.ndarray, strings: dict[int, str]):
+        """
+        :param lemmas: np.ndarray. The lemma hash of every token of the Docs, concatenated (uint64).
+        :param flags: np.ndarray. The flags of every token of the Docs, concatenated (uint8).
+        :param offsets: np.ndarray. The offsets (int64, number of Docs + 1) of each Doc in the tokens arrays.
+        The tokens of Doc i are lemmas[offsets[i]:offsets[i + 1]].
+        :param strings: dict[int, str]. The table with the string of each lemma hash (at least the ones used).
+
+        :raises AssertionError: if the lengths of the arrays don't match.
+        """
+        assert len(lemmas) == len(flags) == offsets[-1], f"Lengths mismatch. Got {len(lemmas)} lemmas, " \
+                                                         f"{len(flags)} flags and {offsets[-1]} tokens."
+        self.lemmas, self.flags, self.offsets, self.strings = lemmas, flags, offsets, strings
+
+    @classmethod
+    def from_token_attributes(cls, token_attributes: list[tuple[np.ndarray, np.ndarray]],
+                              strings: dict[int, str]) -> 'LemmaStore':
+        """
+        Builds the store from the attributes of each Doc (as returned by get_token_attributes([doc])).
+
+        :param token_attributes: list[tuple[np.ndarray, np.ndarray]]. The lemma hashes and flags of each Doc.
+        :param strings: dict[int, str]. The table with the string of each lemma hash.
+
+        :return: LemmaStore. The store of all the Docs, in the same order.
+        """
+        offsets = np.zeros(len(token_attributes) + 1, dtype=np.int64)
+        np.cumsum([len(lemmas) for lemmas, _ in token_attributes], out=offsets[1:])
+        lemmas = np.concatenate([lemmas for lemmas, _ in token_attributes] or [np.zeros(0, dtype=np.uint64)])
+        flags = np.concatenate([flags for _, flags in token_attributes] or [np.zeros(0, dtype=np.uint8)])
+        return cls(lemmas=lemmas, flags=flags, offsets=offsets, strings=strings)
+
+    def __len__(self):
+        # Number of Docs, as the list of Docs it replaces
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory taken by the arrays of the store (the shared string table is not included).
+        """
+        return self.lemmas.nbytes + self.flags.nbytes + self.offsets.nbytes
+
+    def get_word_freqs(self) -> Counter:
+        """
+        Counts the number of occurrences of each lemma (lowercased), avoiding stopwords, punctuation and spaces.
+        Lemmas are counted by their hash, so only the distinct ones are converted to strings.
+
+        :return: Counter. The number of occurrences of each lemma, in order of first appearance (the same Counter
+        as the one of the Docs, even for the ties of most_common).
+        """
+        return count_lemmas(lemmas=self.lemmas, flags=self.flags, strings=self.strings)
+
+
+def count_lemmas(lemmas: np.ndarray, flags: np.ndarray, strings: 'dict[int, str]|StringStore') -> Counter:
+    """
+    Counts the number of occurrences of each lemma (lowercased) of a sequence of tokens, avoiding stopwords,
+    punctuation and spaces. The relevant tokens are selected with a mask and counted by their lemma hash (unique
+    hashes and a bincount of their positions), so only the distinct lemmas are converted to strings.
+
+    :param lemmas: np.ndarray. The lemma hash of each token (uint64).
+    :param flags: np.ndarray. The flags of each token (uint8, see IS_STOP_FLAG).
+    :param strings: dict[int, str]|StringStore. The table (or the StringStore of spaCy) with the string of each
+    lemma hash.
+
+    :return: Counter. The number of occurrences of each lemma, in order of first appearance (the same Counter
+    as counting the lemmas token by token, even for the ties of most_common).
+    """
+    relevant_lemmas = lemmas[flags == 0]
+    lemma_hashes, first_positions, inverse = np.unique(relevant_lemmas, return_index=True, return_inverse=True)
+    counts = np.bincount(inverse.reshape(-1), minlength=len(lemma_hashes))
+
+    order = np.argsort(first_positions, kind='stable')
+    words, counts = [strings[lemma_hash].lower() for lemma_hash in lemma_hashes[order].tolist()], counts[order].tolist()
+    if len(set(words)) == len(words):
+        return Counter(dict(zip(words, counts)))
+    # Different lemmas can be the same once lowercased (e.g. at the start of a sentence), they are merged
+    word_freqs = Counter()
+    for word, count in zip(words, counts):
+        word_freqs[word] += count
+    return word_freqs
+
+
+def get_token_attributes(docs: list['Doc']) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Extracts the attributes of the tokens of some Docs that the word analysis reads, as arrays (Doc.to_array,
+    without creating a Token object per token). The flags are combined once for the tokens of all the Docs, so
+    it's faster to extract many Docs at a time than one by one.
+
+    :param docs: list[Doc]. The processed Docs.
+
+    :return: tuple[np.ndarray, np.ndarray]. The lemma hash (uint64) and the flags (uint8, see IS_STOP_FLAG) of
+    each token of the Docs, concatenated.
+    """
+    from spacy.attrs import LEMMA, IS_STOP, IS_PUNCT, IS_SPACE
+
+    attributes = np.concatenate([doc.to_array([LEMMA, IS_STOP, IS_PUNCT, IS_SPACE]).reshape(-1, 4) for doc in docs]
+                                or [np.zeros((0, 4), dtype=np.uint64)])
+    flags = (attributes[:, 1] * IS_STOP_FLAG | attributes[:, 2] * IS_PUNCT_FLAG |
+             attributes[:, 3] * IS_SPACE_FLAG).astype(np.uint8)
+    return attributes[:, 0].copy(), flags
+
+
+def load_lemma_pipeline(model_name: str = SPACY_MODEL) -> 'Language':
+    """
+    Loads the lemma profile of a spaCy pipeline: the pipeline without the components excluded by
+    LEMMA_PROFILE_EXCLUDED_COMPONENTS, which are never loaded (so they don't take memory nor time). The parser
+    is the most expensive component of the pipeline. The word vectors are kept, since they are features of the
+    tok2vec layer that the morphologizer (and so the lemmatizer) depends on.
+    Lemmas of the Spanish lemmatizer only depend on the parser (through the sentence starts) for their casing,
+    so the lowercased word frequencies of get_word_freqs are the same as with the full pipeline.
+
+    :param model_name: str. Name (or path) of the spaCy pipeline.
+
+    :return: Language. The pipeline, with only the tokenizer and the components needed for the lemmas.
+
+    :raises AssertionError: if the pipeline has no lemmatizer.
+    """
+    # spaCy takes a few seconds to import, only load it when the pipeline is needed
+    import spacy
+
+    nlp = spacy.load(model_name, exclude=list(LEMMA_PROFILE_EXCLUDED_COMPONENTS))
+    assert 'lemmatizer' in nlp.pipe_names, f"Pipeline {model_name} has no lemmatizer. Got {nlp.pipe_names}."
+    return nlp
+
+
+def process_corpus(nlp: 'Language', dataframes: dict[str, pd.DataFrame], batch_size: int = 256,
+                   n_process: int = 1,
+                   keep_docs: bool = False) -> dict[str, dict[str, dict[str, LemmaStore|list['Doc']]]]:
+    """
+    Processes the texts of every data split with the spaCy pipeline, grouping the Docs by label and origin. By
+    default, each Doc is reduced to its lemmas and flags as soon as it's processed, and the Docs of each group are
+    stored as a LemmaStore, all of them sharing the same string table.
+
+    :param nlp: Language. The spaCy pipeline (e.g. load_lemma_pipeline(SPACY_MODEL) or spacy.load(SPACY_MODEL)).
+    :param dataframes: dict[str, pd.DataFrame]. The dataframe of each data split (e.g. {TRAIN: df_train_val,
+    TEST: df_test}), with "text", "label" and "origin" columns.
+    :param batch_size: int. Number of texts processed together by each component of the pipeline.
+    :param n_process: int. Number of worker processes. With 1, texts are processed in this process. Starting the
+    workers (each one with its own copy of the pipeline) takes a while, so it only pays off for big splits.
+    :param keep_docs: bool. If True, the Docs are kept as they are (for analyses that need other attributes).
+
+    :return: dict[str, dict[str, dict[str, LemmaStore|list[Doc]]]]. The LemmaStore (or the list of Docs) of each
+    split, by label (TOXIC or NON_TOXIC) and origin (TWITTER or NEWS), in the same order as in their dataframe.
+
+    :raises AssertionError: if the batch size or the number of processes are not positive, if any label or
+    origin is not one of the expected values, or if any text is lost while processing.
+    """
+    assert batch_size > 0 and n_process > 0, f"Batch size and number of processes must be positive. " \
+                                             f"Got {batch_size} and {n_process}."
+
+    processed_words, strings = {}, {}
+    for data_split, dataset in dataframes.items():
+        _check_labels_and_origins(dataset=dataset)
+        # nlp.pipe yields the Docs in the same order as the texts, even when using several processes
+        docs = nlp.pipe(dataset[TEXT].tolist(), batch_size=batch_size, n_process=n_process)
+        processed_words[data_split] = _group_docs(docs=docs, dataset=dataset, data_split=data_split,
+                                                  string_store=nlp.vocab.strings, strings=strings, keep_docs=keep_docs)
+
+    return processed_words
+
+
+def load_corpus(dataframes: dict[str, pd.DataFrame], model_name: str = SPACY_MODEL, lemma_profile: bool = True,
+                batch_size: int = 256, n_process: int = 1, keep_docs: bool = False,
+                cache_dir: str = CORPUS_CACHE_DIR) -> dict[str, dict[str, dict[str, LemmaStore|list['Doc']]]]:
+    """
+    Same as process_corpus, but the processed Docs of each split are cached on disk (as a DocBin), keyed by the
+    content of the split and the name, version and components of the pipeline. Unchanged splits are read back
+    from the cache instead of being processed again, and the pipeline (which takes a while to load) is only
+    loaded if some split is not cached. Cached Docs are decoded one by one while they are grouped, so they are
+    never all in memory at the same time (unless keep_docs is set).
+
+    :param dataframes: dict[str, pd.DataFrame]. The dataframe of each data split (e.g. {TRAIN: df_train_val,
+    TEST: df_test}), with "text", "label" and "origin" columns.
+    :param model_name: str. Name (or path) of the spaCy pipeline.
+    :param lemma_profile: bool. If True, the pipeline is loaded with load_lemma_pipeline (otherwise, complete).
+    :param batch_size: int. Number of texts processed together by each component of the pipeline.
+    :param n_process: int. Number of worker processes (see process_corpus).
+    :param keep_docs: bool. If True, the Docs are kept as they are, instead of reduced to a LemmaStore.
+    :param cache_dir: str. Directory where the processed Docs are stored. It's created when first needed.
+
+    :return: dict[str, dict[str, dict[str, LemmaStore|list[Doc]]]]. The same as process_corpus.
+
+    :raises AssertionError: if the batch size or the number of processes are not positive, if any label or
+    origin is not one of the expected values, or if any text is lost while processing.
+    """
+    assert batch_size > 0 and n_process > 0, f"Batch size and number of processes must be positive. " \
+                                             f"Got {batch_size} and {n_process}."
+    # spaCy takes a few seconds to import, only load it when the corpus is needed
+    import spacy
+    from spacy.tokens import DocBin
+
+    # The version is read from the meta of the pipeline, without loading it
+    meta = spacy.util.get_model_meta(model_name if os.path.isdir(model_name) else
+                                     spacy.util.get_package_path(model_name))
+    pipeline_id = f"{meta['lang']}_{meta['name']}-{meta['version']}-spacy{spacy.__version__}-" \
+                  f"{'lemma' if lemma_profile else 'full'}"
+    # Cached Docs only need the strings and the lexical attributes (stop words...) of the language
+    vocab, nlp = spacy.blank(meta['lang']).vocab, None
+
+    processed_words, strings = {}, {}
+    for data_split, dataset in dataframes.items():
+        _check_labels_and_origins(dataset=dataset)
+        texts = dataset[TEXT].tolist()
+        # The Docs only depend on the texts (in their order), labels and origins are only used for grouping them
+        texts_hash = blake2b(digest_size=16)
+        for text in texts:
+            texts_hash.update(text.encode('utf-8'))
+            texts_hash.update(b'\0')
+        doc_bin_path = os.path.join(cache_dir, f"{pipeline_id}-{texts_hash.hexdigest()[:16]}.spacy")
+
+        if os.path.isfile(doc_bin_path):
+            docs, string_store, doc_bin = DocBin().from_disk(doc_bin_path).get_docs(vocab), vocab.strings, None
+        else:
+            if nlp is None:
+                nlp = load_lemma_pipeline(model_name=model_name) if lemma_profile else spacy.load(model_name)
+            doc_bin = DocBin(store_user_data=False)
+            docs = _add_to_doc_bin(docs=nlp.pipe(texts, batch_size=batch_size, n_process=n_process),
+                                   doc_bin=doc_bin)
+            string_store = nlp.vocab.strings
+
+        processed_words[data_split] = _group_docs(docs=docs, dataset=dataset, data_split=data_split,
+                                                  string_store=string_store, strings=strings, keep_docs=keep_docs)
+
+        if doc_bin is not None:
+            # Written to a temporary file and renamed, so an interrupted write never leaves a torn cache file
+            os.makedirs(cache_dir, exist_ok=True)
+            doc_bin.to_disk(f"{doc_bin_path}.tmp")
+            os.replace(f"{doc_bin_path}.tmp", doc_bin_path)
+
+    return processed_words
+
+
+def _check_labels_and_origins(dataset: pd.DataFrame):
+    # Assert label and origin values are as expected (for the whole split, before processing anything)
+    assert dataset[LABEL].isin([0, 1]).all(), \
+        f"Label variable must be either 0 or 1. Got {sorted(set(dataset[LABEL]) - {0, 1})}."
+    assert dataset[ORIGIN].isin([TWITTER, NEWS]).all(), f"Origin variable must be either {TWITTER} or {NEWS}."
+
+
+def _add_to_doc_bin(docs: Iterator['Doc'], doc_bin: 'DocBin') -> Iterator['Doc']:
+    # Serializes the Docs while they are consumed, so they don't need to be kept for caching them
+    for doc in docs:
+        doc_bin.add(doc)
+        yield doc
+
+
+def _group_docs(docs: Iterator['Doc'], dataset: pd.DataFrame, data_split: str, string_store: 'StringStore',
+                strings: dict[int, str], keep_docs: bool) -> dict[str, dict[str, LemmaStore|list['Doc']]]:
+    grouped_docs = {label: {origin: [] for origin in (TWITTER, NEWS)} for label in (TOXIC, NON_TOXIC)}
+    for doc, label, origin in tqdm(zip(docs, dataset[LABEL].tolist(), dataset[ORIGIN].tolist()),
+                                   desc=f'Processing words ({data_split})', total=len(dataset)):
+        # Store each processed text in their correct location according to their label / origin
+        grouped_docs[TOXIC if label == 1 else NON_TOXIC][origin].append(
+            doc if keep_docs else get_token_attributes(docs=[doc]))
+
+    if not keep_docs:
+        # Add the strings of the new lemmas to the shared table (the Docs are gone, but not their strings)
+        for docs_by_label in grouped_docs.values():
+            for origin, token_attributes in docs_by_label.items():
+                docs_by_label[origin] = LemmaStore.from_token_attributes(token_attributes=token_attributes,
+                                                                         strings=strings)
+                strings.update((lemma_hash, string_store[lemma_hash])
+                               for lemma_hash in np.unique(docs_by_label[origin].lemmas).tolist()
+                               if lemma_hash not in strings)
+
+    # Finally, assert that the data split has the expected number of Docs
+    total_entries = sum(len(docs_by_origin) for docs_by_label in grouped_docs.values()
+                        for docs_by_origin in docs_by_label.values())
+    assert total_entries == len(dataset), f"Number of entries not matching. Expected: {len(dataset)}. " \
+                                          f"Got: {total_entries}"
+    return grouped_docs
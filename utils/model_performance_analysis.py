@@ -1,341 +1,225 @@
 """
-A set of functions that are used for analysis visualization of the model performance.
-Moved here to avoid cluttering the notebooks with code that is not relevant for the performance analysis.
+A set of functions that are used for getting the predictions of the fine-tuned models, for the performance analysis
+and for scoring new data. Plots and notebook widgets of the analysis are in model_performance_visualization, so
+importing the prediction path (e.g. from a headless scoring worker) doesn't load matplotlib nor IPython.
 """
 import os
-import pandas as pd
-from matplotlib import pyplot as plt
-from transformers import DistilBertForSequenceClassification, DistilBertTokenizer
+from collections.abc import Iterable, Iterator
+from itertools import islice
+from typing import TYPE_CHECKING
 
-from sklearn.metrics import precision_recall_curve, auc
-from .constants import NON_TOXIC, TOXIC, TRUE_LABELS, PRED_LABELS, PRED_PROBS, MODEL_NAME, MODEL_MAX_LENGTH,\
-     TEXT, LABEL
-from copy import deepcopy
 import numpy as np
-from sklearn.metrics import confusion_matrix
-from torch.utils.data import DataLoader
+import pandas as pd
 import torch
 from tqdm import tqdm
-from IPython.display import HTML
+
+from .constants import TRUE_LABELS, PRED_LABELS, PRED_PROBS, MODEL_MAX_LENGTH, TEXT, FP32_BACKEND, ONNX_BACKEND, \
+    ID, LABEL
+from .batching import get_batches, get_results_by_language, pad_batch
+from .model_registry import MODEL_REGISTRY
+from .tokenization import tokenize_texts, get_sequences
+from .tokenization_cache import TokenizationCache
+
+# Only for the type hints, transformers is imported by MODEL_REGISTRY when the first model is built
+if TYPE_CHECKING:
+    from transformers import DistilBertTokenizer
 
 # ------------------------------- PREDICTION FUNCTIONS ---------------------------------------------
-def predict_with_probabilities(model_path: str, tokenizer: DistilBertTokenizer,
+def predict_with_probabilities(model_path: str, tokenizer: 'DistilBertTokenizer',
                                df_by_language: dict[str, pd.DataFrame], device: torch.device,
-                               batch_size: int = 32, conf_th: float = 0.5) -> dict[str, dict[str, list[int]]]:
+                               batch_size: int = 32, conf_th: float = 0.5,
+                               max_tokens_per_batch: int|None = None, backend: str = FP32_BACKEND,
+                               cache: TokenizationCache|None = None) -> dict[str, dict[str, list[int]]]:
     """
     Execute the prediction over the given dataframes divided by language, returning a dictionary
-    containing the true and predicted labels for each language as well as the predicted probabilities
+    containing the true and predicted labels for each language as well as the predicted probabilities.
+    Texts of all languages are batched together by their tokenized length, to minimize the padding,
+    and the results are restored to the original order of each language.
 
-    :param model_path: str. Path to the model's directory (.pt file)
+    :param model_path: str. Path to the model's directory (.safetensors or .pt file)
     :param tokenizer: callable. Tokenizer to use for tokenizing the data before feeding it to the model.
     :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
     :param device: torch.device. Device to use for the model.
     :param batch_size: int. Batch size to use for the predictions.
     :param conf_th: float. Confidence threshold to use for the predictions if the probabilities are
     above it, the prediction will be toxic, otherwise it will be non-toxic.
+    :param max_tokens_per_batch: int|None. If given, batch_size is ignored and the batches are packed so that
+    their padded size (longest text x number of texts) stays under this number of tokens.
+    :param backend: str. FP32_BACKEND to run the model as it was trained, INT8_BACKEND to run it with its linear
+    layers dynamically quantized to int8 (CPU only, much faster on machines without GPU) or ONNX_BACKEND to run
+    its ONNX graph through onnxruntime (CPU only, the device is ignored). The graph is exported next to the
+    checkpoint the first time it's needed.
+    :param cache: TokenizationCache|None. Cache to read the tokens from (e.g. TOKENIZATION_CACHE), storing the
+    new ones. It can't be used with ONNX_BACKEND, which tokenizes with its own exported tokenizer. If None, texts
+    are always tokenized.
 
     :return: dict[str, dict[str, list[int]]]. A dictionary with the following structure:
     {<language>: {'true_labels': list[int], 'pred_labels': list[int], 'pred_probs': list[float, float]}}
 
-    :raises AssertionError: if the model path is not a file.
+    :raises AssertionError: if the model path is not a file, or if a cache is given for ONNX_BACKEND.
     """
 
-    def tokenize_batch(batch):
-        return tokenizer(batch, padding=True, truncation=True, max_length=MODEL_MAX_LENGTH, return_tensors="pt").to(device)
-
     assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
 
-    # Load the model
-    model = DistilBertForSequenceClassification.from_pretrained(MODEL_NAME, num_labels=2,
-                                                                ignore_mismatched_sizes=True)
-    # Move the model to the device
-    model = model.to(device)
-
-    state_dict = torch.load(model_path, map_location=device)
-    # Update the model's state dictionary
-    model.load_state_dict(state_dict)
-
-    # Just to make sure, put it in evaluation mode
-    model.eval()
-
-    results_by_lang = {}
-    with torch.no_grad():
-        for lang, lang_dataset in df_by_language.items():
-            # Create a data loader for creating the batches already tokenized and in the device
-            data_loader = DataLoader(lang_dataset[TEXT].tolist(), batch_size=batch_size, shuffle=False,
-                                     collate_fn=tokenize_batch)
-            # Create the lists for storing the predictions and probabilities
-            pred_labels, pred_probs = [], []
-            true_labels = lang_dataset[LABEL].tolist()
-
-            for batch in tqdm(data_loader, desc=f"Predicting for {lang.title()}", total=len(data_loader)):
-                # Execute the inference and get the logits
-                logits = model(**batch).logits
-                # Execute softmax to get the probabilities (detach them and cast them to numpy)
-                probabilities = torch.nn.functional.softmax(logits, dim=1).detach().cpu().numpy()
-                # Get the predictions by comparing the probabilities with the confidence threshold
-                predictions = np.where(probabilities[:, 1] > conf_th, 1, 0)
-                # Add the predictions and probabilities to the results
-                pred_probs.extend(list(probabilities))
-                pred_labels.extend(list(predictions))
-
-            # Store the results for this language
-            results_by_lang[lang] = {
-                TRUE_LABELS: true_labels,
-                PRED_LABELS: pred_labels,
-                PRED_PROBS: pred_probs
-            }
-
-    return results_by_lang
-
-# ------------------------------- VISUALIZATION FUNCTIONS ---------------------------------------------
-
-def show_confusion_matrix(labels_and_predictions_by_lang: dict[str, dict[str, list[int]|list[float, float]]]):
+    if backend == ONNX_BACKEND:
+        assert cache is None, f"{ONNX_BACKEND} backend tokenizes with its exported tokenizer, it can't use a cache"
+        # Only the ONNX backend needs onnxruntime
+        from .onnx_backend import get_or_export_onnx, predict_with_onnx
+        # Export it (again) if it's missing or the checkpoint was updated after the last export
+        onnx_path = get_or_export_onnx(model_path=model_path, tokenizer=tokenizer)
+        return predict_with_onnx(onnx_path=onnx_path, df_by_language=df_by_language, batch_size=batch_size,
+                                 conf_th=conf_th, max_tokens_per_batch=max_tokens_per_batch)
+
+    # Get the model from the registry. It's only built the first time, later calls reuse it
+    # (already in the device and in evaluation mode)
+    model = MODEL_REGISTRY.get_model(model_path=model_path, device=device, backend=backend)
+
+    # Put the texts of all languages together, so the batches can be built by length independently
+    # of their language. One long news article would pad a whole batch of short tweets otherwise
+    texts = [text for lang_dataset in df_by_language.values() for text in lang_dataset[TEXT].tolist()]
+    # Tokenize without padding, it is added later to each batch (only up to its longest text)
+    if cache is not None:
+        tokens, offsets = cache.tokenize(texts=texts, tokenizer=tokenizer, max_length=MODEL_MAX_LENGTH)
+    else:
+        tokens, offsets = tokenize_texts(texts=texts, tokenizer=tokenizer, max_length=MODEL_MAX_LENGTH)
+    input_ids = get_sequences(tokens=tokens, offsets=offsets)
+    batches = get_batches(lengths=np.diff(offsets), batch_size=batch_size, max_tokens_per_batch=max_tokens_per_batch)
+
+    # Probabilities of all texts, in their original order
+    probabilities = predict_batches(model=model, input_ids=input_ids, batches=batches,
+                                    pad_token_id=tokenizer.pad_token_id or 0, device=device,
+                                    desc=f"Predicting for {', '.join(lang.title() for lang in df_by_language)}")
+
+    return get_results_by_language(probabilities=probabilities, df_by_language=df_by_language, conf_th=conf_th)
+
+
+def predict_batches(model: torch.nn.Module, input_ids: list[list[int]], batches: list[np.ndarray],
+                    pad_token_id: int, device: torch.device, desc: str|None = "Predicting") -> np.ndarray:
     """
-    Show a 2x2 plot layout each one containing the confusion matrix for a language, except for the
-    last one which contains the confusion matrix for all languages combined.
+    Execute the inference over the given batches of already tokenized (and not padded) texts, returning the
+    probabilities of each text in their original order.
 
-    :param labels_and_predictions_by_lang: dict[str, dict[str, list[int]|list[float, float]]. A dictionary containing
-    the true and predicted labels for each language. The keys of the outer dictionary are the
-    languages and the keys of the inner dictionaries are the true and predicted labels (also probabilities will
-    be there if generated by predict_with_probabilities but they will be ignored).
+    :param model: torch.nn.Module. Model to use for the predictions, already in the device and in evaluation mode.
+    :param input_ids: list[list[int]]. The token ids of each text.
+    :param batches: list[np.ndarray]. The indices (referring to input_ids) of the texts contained in each batch.
+    :param pad_token_id: int. The token id used for padding each batch up to its longest text.
+    :param device: torch.device. Device where the model is placed.
+    :param desc: str|None. Description shown in the progress bar. If None, the progress bar is not shown.
 
-    :raises AssertionError: if the number of languages is not 4 or if the number of true and
-    predicted labels is not the same.
+    :return: np.ndarray. The probabilities of each class for each text, with shape (len(input_ids), 2).
     """
-
-    total_labels = {
-        TRUE_LABELS: [],
-        PRED_LABELS: [],
-    }
-
-    for lang, labels in labels_and_predictions_by_lang.items():
-        total_labels[TRUE_LABELS].extend(labels[TRUE_LABELS])
-        total_labels[PRED_LABELS].extend(labels[PRED_LABELS])
-
-    assert len(total_labels[TRUE_LABELS]) == len(total_labels[PRED_LABELS]),  \
-            f"Expected true and pred labels to have the same size. " \
-            f"{len(total_labels['true_labels'])} != {len(total_labels['pred_labels'])}"
-
-    labels_and_predictions_by_lang = {**deepcopy(labels_and_predictions_by_lang),
-                                      "all languages": total_labels}
-
-    assert len(labels_and_predictions_by_lang) == 2*2, f"Expected 4 language entries, " \
-                                                       f"got {list(labels_and_predictions_by_lang.values())}"
-    # Make a 2x2 grid
-    fig, axes = plt.subplots(nrows=2, ncols=2, figsize=(13, 8))
-    for i, (lang, values) in enumerate(labels_and_predictions_by_lang.items()):
-        true, preds = values[TRUE_LABELS], values[PRED_LABELS]
-        cm = confusion_matrix(y_true=true, y_pred=preds, normalize='true')
-        # Remove the last row and cast it to percentage
-        cm = cm*100
-        ax = axes[i // 2, i % 2]
-        ax.matshow(cm, cmap=plt.cm.Purples)
-        # Calculate accuracy
-        accuracy = np.mean(np.array(true) == np.array(preds)) * 100
-        ax.set_title(f"{lang.title()} - Accuracy: {round(accuracy, ndigits=2)}%")
-        ax.set_xlabel('True Labels')
-        ax.set_ylabel('Predicted Labels')
-        ax.set_xticks([0, 1], [NON_TOXIC, TOXIC])
-        ax.set_yticks([0, 1], [NON_TOXIC, TOXIC])
-
-        for i in range(cm.shape[0]):
-            for j in range(cm.shape[1]):
-                # Add the percentage to the cell
-                ax.text(x=j, y=i, s=f"{round(cm[i, j], ndigits=1)}%",
-                        ha='center', va='center', color='black')
-
-    plt.tight_layout(pad=2)
-    plt.show()
-
-def plot_training_curves(train_accs: list[float], train_losses: list[float],
-                         val_accs: list[float], val_losses: list[float]):
+    probabilities = np.zeros((len(input_ids), 2), dtype=np.float32)
+    with torch.no_grad():
+        for batch_indices in tqdm(batches, desc=desc, disable=desc is None):
+            batch_input_ids, batch_attention_mask = pad_batch(sequences=[input_ids[i] for i in batch_indices],
+                                                              pad_token_id=pad_token_id)
+            # Execute the inference and get the logits
+            logits = model(input_ids=torch.from_numpy(batch_input_ids).to(device),
+                           attention_mask=torch.from_numpy(batch_attention_mask).to(device)).logits
+            # Execute softmax to get the probabilities (detach them and cast them to numpy) and
+            # scatter them back to the original position of each text
+            probabilities[batch_indices] = torch.nn.functional.softmax(logits, dim=1).detach().cpu().numpy()
+
+    return probabilities
+
+
+def predict_stream(model_path: str, tokenizer: 'DistilBertTokenizer', chunks: Iterable[str|pd.DataFrame],
+                   device: torch.device, batch_size: int = 32, conf_th: float = 0.5,
+                   max_tokens_per_batch: int|None = None, backend: str = FP32_BACKEND,
+                   window_size: int = 4096) -> Iterator[dict[str, list]]:
     """
-    Plot the training curves for accuracy and loss comparing training and validation sets.
+    Streaming version of predict_with_probabilities, for scoring inputs that don't fit in memory. Texts are read
+    from the given iterator in windows of (at most) window_size texts, each window is batched by length and
+    predicted, and its results are yielded as soon as it finishes. So the memory used is constant, no matter
+    how many texts are read. For example, for scoring a huge CSV by chunks:
 
-    :param train_accs: list[float]. Training accuracies for each epoch
-    :param train_losses: list[float]. Training losses for each epoch
-    :param val_accs: list[float]. Validation accuracies for each epoch
-    :param val_losses: list[float]. Validation losses for each epoch
+        for results in predict_stream(model_path=..., tokenizer=tokenizer, device=device,
+                                      chunks=pd.read_csv(path, chunksize=10000)):
+            ...
 
-    :raises AssertionError: if training and validation accuracies or losses have different lengths
-    """
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param tokenizer: callable. Tokenizer to use for tokenizing the data before feeding it to the model.
+    :param chunks: Iterable[str|pd.DataFrame]. An iterator of texts, or of dataframes (as the chunks returned by
+    pd.read_csv with chunksize) with a TEXT column and, optionally, ID and LABEL columns.
+    :param device: torch.device. Device to use for the model.
+    :param batch_size: int. Batch size to use for the predictions.
+    :param conf_th: float. Confidence threshold to use for the predictions if the probabilities are
+    above it, the prediction will be toxic, otherwise it will be non-toxic.
+    :param max_tokens_per_batch: int|None. If given, batch_size is ignored and the batches are packed so that
+    their padded size (longest text x number of texts) stays under this number of tokens.
+    :param backend: str. FP32_BACKEND, INT8_BACKEND or ONNX_BACKEND (see predict_with_probabilities).
+    :param window_size: int. Maximum number of texts held in memory (and batched together) at once. Dataframe
+    chunks bigger than it are split, smaller ones are predicted by themselves.
 
-    assert len(train_accs) == len(val_accs), f"Training and validation accuracies must have the same length, " \
-                                                f"got {len(train_accs)} and {len(val_accs)}"
-    assert len(train_losses) == len(val_losses), f"Training and validation losses must have the same length, " \
-                                                    f"got {len(train_losses)} and {len(val_losses)}"
-    # Create figure with two subplots: one for accuracy and one for loss
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 5))
-
-    for ax, title, train_data, val_data in zip((ax1, ax2), ('Accuracy', 'Loss'), (train_accs, train_losses),
-                                     (val_accs, val_losses)):
-        # Plot the curves
-        ax.plot(train_data, label=f"Training {title}")
-        ax.plot(val_data, label=f"Validation {title}")
-        # Set the title and labels
-        ax.set_title(f'Training and Validation {title}')
-        ax.set_xlabel('Epoch')
-        ax.set_ylabel(title)
-        ax.legend()
-
-    # Show the plot
-    plt.tight_layout()
-    plt.show()
-
-def plot_combined_precision_recall_curve(results_by_lang: dict[str, dict[str, list[int]|list[float, float]]]):
-    """
-    Plot the combined precision-recall curve for all languages together, and indicate the optimal threshold.
+    :return: Iterator[dict[str, list]]. One dictionary per window, in the input order, with the same structure
+    as each language of predict_with_probabilities: {'pred_labels': list[int], 'pred_probs': list[float, float]},
+    plus 'true_labels' and 'id' (list) if the dataframe chunks contain them.
 
-    :param results_by_lang: dict[str, dict[str, list[int]|list[float, float]]]. A dictionary containing
-    the true labels, predicted labels, and predicted probabilities for each language.
-    """
-    total_true_labels, total_pred_probs = [], []
-
-    # Accumulate true labels and predicted (toxic)probabilities from all languages
-    for lang, data in results_by_lang.items():
-        total_true_labels.extend(data[TRUE_LABELS])
-        total_pred_probs.extend([toxic_prob for non_toxic_prob, toxic_prob in data[PRED_PROBS]])  # Probability of being toxic
-
-    # Calculate precision, recall, and thresholds
-    precision, recall, thresholds = precision_recall_curve(total_true_labels, total_pred_probs)
-    pr_auc = auc(recall, precision)
-
-    # Find the optimal threshold
-    optimal_idx = np.argmax(np.sqrt(precision * recall))
-    optimal_threshold = thresholds[optimal_idx]
-
-    # Plotting
-    plt.figure(figsize=(10, 6))
-    plt.plot(recall, precision, label=f'PR curve (area = {pr_auc:.2f})')
-    plt.scatter(recall[optimal_idx], precision[optimal_idx], marker='o', color='red',
-                label=f'Optimal threshold: {optimal_threshold:.2f}')
-    plt.xlabel('Recall')
-    plt.ylabel('Precision')
-    plt.title('Precision-Recall curve')
-    plt.legend()
-    plt.grid(True)
-    plt.show()
-
-
-def find_top_failures(dataset_by_language: dict[str, pd.DataFrame],
-                      matches_by_language: dict[str, dict[str, list]],
-                      top_failures: int = 5) -> dict[str, dict[str, list[dict[str, int|str|float]]]]:
+    :raises AssertionError: if the model path is not a file or if the window size is not positive.
     """
-    Get the top 5 failures for each language and each label, sorted by confidence.
-    :param dataset_by_language: dict[str, pd.DataFrame]. A dictionary containing dataframes for each language. They must
-    contain a column named TEXT.
-    :param matches_by_language: dict[str, dict[str, list[int]|list[float, float]]]. A dictionary containing
-    the true labels, predicted labels, and predicted probabilities for each language.
-
-    :return: dict[str, dict[str, list[dict[str, int|str|float]]]]. A dictionary with the following structure:
-                {<language>: { 'False TOXIC':
-                        [{'true_label': int, 'pred_label': int, 'confidence': float, 'text': str}, ...],
-                            'False NON-TOXIC':
-                        [{'true_label': int, 'pred_label': int, 'confidence': float, 'text': str}, ...]}}
-    """
-    top_failures_by_language = {}
-
-    for lang, test_set in dataset_by_language.items():
-        true_labels = matches_by_language[lang][TRUE_LABELS]
-        pred_labels = matches_by_language[lang][PRED_LABELS]
-        pred_probs = matches_by_language[lang][PRED_PROBS]
-
-        failures_false_toxic, failures_false_nontoxic = [], []
-
-        for i, (true_label, pred_label, prob) in enumerate(zip(true_labels, pred_labels, pred_probs)):
-            if true_label != pred_label:
-                confidence = max(prob)  # Confidence of the predicted label
-                text = test_set.iloc[i][TEXT]
-                failure_info = {'true_label': true_label, 'pred_label': pred_label, 'confidence': confidence, 'text': text}
-
-                if true_label == 0:  # False TOXIC
-                    failures_false_toxic.append(failure_info)
-                else:  # False NON-TOXIC
-                    failures_false_nontoxic.append(failure_info)
-
-        # Sort and take top failures for each category
-        top_failures_false_toxic = sorted(failures_false_toxic, key=lambda x: x['confidence'], reverse=True)[:top_failures]
-        top_failures_false_nontoxic = sorted(failures_false_nontoxic, key=lambda x: x['confidence'], reverse=True)[:top_failures]
-
-        top_failures_by_language[lang] = {f'False {TOXIC}': top_failures_false_toxic, f'False {NON_TOXIC}': top_failures_false_nontoxic}
+    assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+    assert window_size > 0, f"Window size must be positive. Got {window_size}."
+
+    if backend == ONNX_BACKEND:
+        # Only the ONNX backend needs onnxruntime
+        from .onnx_backend import get_or_export_onnx, load_onnx_model, predict_onnx_batches
+        # Export it (again) if it's missing or the checkpoint was updated after the last export
+        onnx_path = get_or_export_onnx(model_path=model_path, tokenizer=tokenizer)
+        session, onnx_tokenizer, pad_token_id = load_onnx_model(onnx_path=onnx_path)
+    else:
+        model = MODEL_REGISTRY.get_model(model_path=model_path, device=device, backend=backend)
+        pad_token_id = tokenizer.pad_token_id or 0
+
+    with tqdm(desc="Predicting stream", unit=" texts") as progress:
+        for window in _get_windows(chunks=chunks, window_size=window_size):
+            texts = window[TEXT].tolist()
+            # Same as predict_with_probabilities, but only over the texts of the current window
+            if backend == ONNX_BACKEND:
+                input_ids = [encoding.ids for encoding in onnx_tokenizer.encode_batch(texts)]
+            else:
+                tokens, offsets = tokenize_texts(texts=texts, tokenizer=tokenizer, max_length=MODEL_MAX_LENGTH)
+                input_ids = get_sequences(tokens=tokens, offsets=offsets)
+            batches = get_batches(lengths=np.array([len(ids) for ids in input_ids]), batch_size=batch_size,
+                                  max_tokens_per_batch=max_tokens_per_batch)
+
+            if backend == ONNX_BACKEND:
+                probabilities = predict_onnx_batches(session=session, input_ids=input_ids, batches=batches,
+                                                     pad_token_id=pad_token_id, desc=None)
+            else:
+                probabilities = predict_batches(model=model, input_ids=input_ids, batches=batches,
+                                                pad_token_id=pad_token_id, device=device, desc=None)
+
+            results = {
+                PRED_LABELS: list(np.where(probabilities[:, 1] > conf_th, 1, 0)),
+                PRED_PROBS: list(probabilities)
+            }
+            # Keep the labels and the ids of the texts if they were given, so the results can be matched back
+            if LABEL in window:
+                results[TRUE_LABELS] = window[LABEL].tolist()
+            if ID in window:
+                results[ID] = window[ID].tolist()
 
-    return top_failures_by_language
+            progress.update(len(texts))
+            yield results
 
-def visualize_top_failures(top_failures_by_language: dict[str, dict[str, list[dict[str, int|str|float]]]]) -> HTML:
-    """
-    Visualize the top failures for each language and each label, sorted by confidence.
 
-    :param top_failures_by_language: dict[str, dict[str, list[dict[str, int|str|float]]]]. A dictionary with the following structure:
-                {<language>: { 'False TOXIC':
-                        [{'true_label': int, 'pred_label': int, 'confidence': float, 'text': str}, ...],
-                            'False NON-TOXIC':
-                        [{'true_label': int, 'pred_label': int, 'confidence': float, 'text': str}, ...]}}.
-                returned by find_top_failures.
-
-    :return: IPython.display.HTML. An HTML object containing the visualization that can be displayed in a notebook.
-    """
-    style = """
-    <style>
-    .material-card {
-        box-shadow: 0 4px 8px 0 rgba(0,0,0,0.2);
-        transition: 0.3s;
-        border-radius: 10px;
-        padding: 15px;
-        margin-bottom: 20px;
-        background-color: #fff;
-    }
-
-    .card-title {
-        color: #06c2c2;
-        font-size: 18px;
-        margin-bottom: 10px;
-        font-weight: bold;
-    }
-
-    .card-content {
-        color: #333;
-    }
-
-    .language-section {
-        margin-bottom: 30px;
-    }
-
-    .label-section {
-        margin-bottom: 20px;
-    }
-
-    .section-title {
-        color: #333;
-        font-size: 22px;
-        margin-bottom: 15px;
-        font-weight: bold;
-    }
-    </style>
+def _get_windows(chunks: Iterable[str|pd.DataFrame], window_size: int) -> Iterator[pd.DataFrame]:
     """
-    cards_html = ""
+    Regroups an iterator of texts or of dataframe chunks into non-empty dataframes of at most window_size rows.
 
-    for lang, failure_categories in top_failures_by_language.items():
-        cards_html += f"<div class='language-section'><h2 class='section-title'>{lang.title()}</h2>"
+    :param chunks: Iterable[str|pd.DataFrame]. An iterator of texts or of dataframes with a TEXT column.
+    :param window_size: int. Maximum number of rows of each window.
 
-        for category, failures in failure_categories.items():
-            cards_html += f"<div class='label-section'><h3 class='section-title'>{category}</h3>"
+    :return: Iterator[pd.DataFrame]. The windows, in the input order.
 
-            for failure in failures:
-                confidence = failure['confidence']
-                text = failure['text']
-                true = TOXIC if failure['true_label'] == 1 else NON_TOXIC
-                pred = TOXIC if failure['pred_label'] == 1 else NON_TOXIC
-
-                cards_html += f"""
-                <div class="material-card">
-                    <div class="card-title">Failed with conf: {confidence:.2f}. True: {true}. Pred:{pred} </div>
-                    <div class="card-content">{text}</div>
-                </div>
-                """
-
-            cards_html += "</div>"  # Close label-section
-        cards_html += "</div>"  # Close language-section
-
-    # Combine the styles and HTML, then display it
-    return HTML(style + cards_html)
+    :raises AssertionError: if a dataframe chunk has no TEXT column.
+    """
+    chunks = iter(chunks)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            # An iterator of texts, take the current one along with the next window_size - 1
+            yield pd.DataFrame({TEXT: [chunk, *islice(chunks, window_size - 1)]})
+        else:
+            assert TEXT in chunk, f"Expected a {TEXT} column in the dataframe chunks. Got {list(chunk.columns)}."
+            for start in range(0, len(chunk), window_size):
+                yield chunk.iloc[start:start + window_size]
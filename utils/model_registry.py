@@ -0,0 +1,256 @@
+"""
+A process-wide registry of fine-tuned models, used for avoiding rebuilding the model every time that a
+checkpoint is evaluated. Models are kept warm (already in their device and in evaluation mode) and they are
+evicted in LRU order when the registry exceeds its memory budget.
+"""
+import os
+import uuid
+from collections import OrderedDict
+from time import perf_counter
+from typing import TYPE_CHECKING
+from warnings import warn
+
+import torch
+from torch.ao.quantization import quantize_dynamic
+
+from .checkpointing import load_state_dict_file
+from .constants import MODEL_NAME, MODEL_REGISTRY_MEMORY_BUDGET, FP32_BACKEND, INT8_BACKEND, INT8_MODEL_SUFFIX, \
+    MODEL_CONFIG_FILE
+
+# transformers takes seconds to import, it's only imported when the first model is built
+if TYPE_CHECKING:
+    from transformers import DistilBertConfig, DistilBertForSequenceClassification
+
+
+class ModelRegistry:
+    """
+    LRU cache of models keyed by (checkpoint path, checkpoint mtime and size, device, dtype, backend). If the checkpoint
+    file changes in disk (e.g. a new best_model.pt is saved during training), its key changes too, so the stale
+    model is never served.
+    """
+
+    def __init__(self, memory_budget: int = MODEL_REGISTRY_MEMORY_BUDGET):
+        """
+        :param memory_budget: int. Maximum number of bytes (parameters and buffers) that the cached models can
+        occupy. The most recently used model is always kept, even if it exceeds the budget by itself.
+        """
+        assert memory_budget > 0, f"Memory budget must be positive. Got {memory_budget}."
+        self.memory_budget = memory_budget
+
+        # Cached models and their sizes, from least to most recently used
+        self._models, self._model_sizes = OrderedDict(), {}
+
+        # Metrics to report
+        self.cold_load_times, self.warm_hit_times = [], []
+        self.evictions = 0
+
+    def get_model(self, model_path: str, device: torch.device, dtype: torch.dtype = torch.float32,
+                  backend: str = FP32_BACKEND) -> 'DistilBertForSequenceClassification':
+        """
+        Returns the model stored at model_path, already in the given device and dtype and in evaluation mode.
+        It's only built from scratch the first time it's requested (or after being evicted).
+
+        :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+        :param device: torch.device. Device where the model must be placed.
+        :param dtype: torch.dtype. Data type of the model's parameters (ignored by the int8 backend).
+        :param backend: str. FP32_BACKEND for the model as it was trained or INT8_BACKEND for its linear layers
+        dynamically quantized to int8 (CPU only). The quantized model is cached in disk next to the checkpoint.
+
+        :return: DistilBertForSequenceClassification. The model, ready for inference.
+
+        :raises AssertionError: if the model path is not a file, if the backend is unknown or if the int8 backend
+        is requested for a device other than CPU.
+        """
+        start = perf_counter()
+        assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+        assert backend in (FP32_BACKEND, INT8_BACKEND), f"Backend must be {FP32_BACKEND} or {INT8_BACKEND}. " \
+                                                        f"Got {backend}."
+        assert backend != INT8_BACKEND or torch.device(device).type == 'cpu', \
+            f"The {INT8_BACKEND} backend only runs on CPU. Got device {device}."
+
+        key = self._get_key(model_path=model_path, device=device, dtype=dtype, backend=backend)
+
+        if key in self._models:  # Warm hit
+            self._models.move_to_end(key)
+            self.warm_hit_times.append(perf_counter() - start)
+            return self._models[key]
+
+        # Drop outdated versions (other mtime or size) of this same checkpoint, they will never be requested again
+        for outdated_key in [cached_key for cached_key in self._models
+                             if cached_key[0] == key[0] and cached_key[1:3] != key[1:3]]:
+            self._evict(key=outdated_key)
+
+        if backend == INT8_BACKEND:
+            model = self._load_int8_model(model_path=model_path)
+        else:
+            model = self._load_model(model_path=model_path, device=device, dtype=dtype)
+        self._models[key] = model
+        self._model_sizes[key] = self._get_model_size(model=model)
+
+        # Evict the least recently used models until the budget is satisfied (always keeping the new one)
+        while sum(self._model_sizes.values()) > self.memory_budget and len(self._models) > 1:
+            self._evict(key=next(iter(self._models)))
+
+        self.cold_load_times.append(perf_counter() - start)
+        return model
+
+    def stats(self) -> dict[str, int|float]:
+        """
+        Returns the usage metrics of the registry: number of cold loads and warm hits with their mean latency
+        (in seconds), number of evictions and current memory usage (in bytes).
+
+        :return: dict[str, int|float]. The metrics of the registry.
+        """
+        return {
+            'cold_loads': len(self.cold_load_times),
+            'mean_cold_load_time': sum(self.cold_load_times) / max(len(self.cold_load_times), 1),
+            'warm_hits': len(self.warm_hit_times),
+            'mean_warm_hit_time': sum(self.warm_hit_times) / max(len(self.warm_hit_times), 1),
+            'evictions': self.evictions,
+            'cached_models': len(self._models),
+            'cached_bytes': sum(self._model_sizes.values())
+        }
+
+    def clear(self):
+        """
+        Removes all the cached models from the registry.
+        """
+        for key in list(self._models):
+            self._evict(key=key)
+
+    @staticmethod
+    def _get_key(model_path: str, device: torch.device, dtype: torch.dtype, backend: str) -> tuple:
+        return (os.path.abspath(model_path), *_get_file_version(path=model_path), str(device),
+                str(dtype) if backend == FP32_BACKEND else None, backend)
+
+    @staticmethod
+    def _get_model_size(model: torch.nn.Module) -> int:
+        # Quantized linear layers keep their weights packed outside of the parameters, but they are still
+        # in the state dict (as tuples of tensors)
+        tensors = [value for values in model.state_dict().values()
+                   for value in (values if isinstance(values, tuple) else (values,)) if torch.is_tensor(value)]
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    @staticmethod
+    def _load_model(model_path: str, device: torch.device,
+                    dtype: torch.dtype) -> 'DistilBertForSequenceClassification':
+        from transformers import DistilBertForSequenceClassification
+
+        # Build the architecture with the fine-tuning head (two labels) in the meta device, without allocating
+        # (nor initializing) any weight, since all of them are going to be replaced by the checkpoint's
+        with torch.device('meta'):
+            model = DistilBertForSequenceClassification(get_model_config(model_path=model_path))
+        # Fill the model's state dictionary. The checkpoint is memory-mapped and assigned (not copied) to the
+        # model, so processes loading the same checkpoint in CPU share its memory
+        model.load_state_dict(load_state_dict_file(path=model_path), assign=True)
+        # The position ids are the only tensor that is not in the checkpoint (non-persistent buffer)
+        model.distilbert.embeddings.register_buffer(
+            'position_ids', torch.arange(model.config.max_position_embeddings).expand((1, -1)), persistent=False)
+        assert not any(tensor.is_meta for tensor in (*model.parameters(), *model.buffers())), \
+            f"Some weights of the model are missing in {model_path}"
+
+        # Move it to the target device and put it in evaluation mode
+        return model.to(device=device, dtype=dtype).eval()
+
+    @classmethod
+    def _load_int8_model(cls, model_path: str) -> 'DistilBertForSequenceClassification':
+        # Named after the whole file name, so the .pt and the .safetensors versions of a checkpoint (e.g. a legacy
+        # best_model.pt and its converted copy) don't overwrite each other's artifact
+        int8_model_path = model_path + INT8_MODEL_SUFFIX
+        source_version = _get_file_version(path=model_path)
+
+        # Reuse the quantized artifact if it was generated from this same version of the checkpoint. It only
+        # holds tensors (never a pickled module), so it's loaded with weights_only. Any artifact that can't be
+        # used (truncated, of an older format that pickled the whole model, without some key...) is generated again
+        if os.path.isfile(int8_model_path):
+            try:
+                int8_checkpoint = torch.load(int8_model_path, map_location='cpu', weights_only=True)
+                if tuple(int8_checkpoint['source_version']) == source_version:
+                    model = cls._build_int8_model(model_path=model_path)
+                    model.load_state_dict(int8_checkpoint['state_dict'])
+                    return model.eval()
+            except Exception as error:
+                warn(f"Quantizing {model_path} again, its int8 artifact can't be loaded ({type(error).__name__})")
+
+        # Replace the linear layers (the vast majority of DistilBERT's computation) by their dynamic int8
+        # version: weights are quantized once and activations are quantized on the fly at each forward
+        model = quantize_dynamic(cls._load_model(model_path=model_path, device=torch.device('cpu'),
+                                                 dtype=torch.float32),
+                                 qconfig_spec={torch.nn.Linear}, dtype=torch.qint8)
+
+        # Write to a temporary file first, so an interrupted save never leaves a corrupted artifact. Its name is
+        # unique, so processes (or sessions) quantizing the same checkpoint at once don't overwrite each other's
+        tmp_path = f"{int8_model_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        torch.save({'source_version': list(source_version), 'state_dict': model.state_dict()}, tmp_path)
+        os.replace(tmp_path, int8_model_path)
+        return model
+
+    @staticmethod
+    def _build_int8_model(model_path: str) -> 'DistilBertForSequenceClassification':
+        from transformers import DistilBertForSequenceClassification
+
+        # Build the architecture without initializing it (its weights are going to be replaced by the quantized
+        # ones). Weights are zeroed before quantizing, so the observers never see uninitialized memory
+        with torch.device('meta'):
+            model = DistilBertForSequenceClassification(get_model_config(model_path=model_path))
+        model = model.to_empty(device='cpu')
+        with torch.no_grad():
+            for parameter in model.parameters():
+                parameter.zero_()
+        # The position ids are not in the state dict (non-persistent buffer)
+        model.distilbert.embeddings.register_buffer(
+            'position_ids', torch.arange(model.config.max_position_embeddings).expand((1, -1)), persistent=False)
+        # Same quantization as the artifact, so its packed weights match the quantized layers
+        return quantize_dynamic(model, qconfig_spec={torch.nn.Linear}, dtype=torch.qint8)
+
+    def _evict(self, key: tuple):
+        del self._models[key], self._model_sizes[key]
+        self.evictions += 1
+        # Give the memory back to the device if it was a GPU
+        if torch.cuda.is_available() and key[3].startswith('cuda'):
+            torch.cuda.empty_cache()
+
+
+def get_model_config(model_path: str) -> 'DistilBertConfig':
+    """
+    Returns the configuration of the model of a checkpoint: the config.json saved next to it (see the training
+    section of the notebook) or, for older checkpoints without it, the one of MODEL_NAME with two labels (which
+    is read from the HuggingFace cache, or downloaded, but without the weights).
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+
+    :return: DistilBertConfig. The configuration of the model.
+    """
+    from transformers import DistilBertConfig
+
+    config_path = os.path.join(os.path.dirname(model_path), MODEL_CONFIG_FILE)
+    if os.path.isfile(config_path):
+        return DistilBertConfig.from_json_file(config_path)
+    return DistilBertConfig.from_pretrained(MODEL_NAME, num_labels=2)
+
+
+def prepare_int8_model(model_path: str) -> str:
+    """
+    Makes sure the int8 artifact of a checkpoint (see ModelRegistry.get_model) exists and is up to date,
+    quantizing the checkpoint if it's not. Call it before starting several processes that use the int8 backend,
+    so they only load the artifact instead of all of them quantizing the same checkpoint at once.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+
+    :return: str. Path to the int8 artifact.
+
+    :raises AssertionError: if the model path is not a file.
+    """
+    assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+    ModelRegistry._load_int8_model(model_path=model_path)
+    return model_path + INT8_MODEL_SUFFIX
+
+
+def _get_file_version(path: str) -> tuple[int, int]:
+    # Modification time and size identify the version of a checkpoint without reading it
+    file_stats = os.stat(path)
+    return file_stats.st_mtime_ns, file_stats.st_size
+
+
+# Shared by all the prediction functions of the process
+MODEL_REGISTRY = ModelRegistry()
@@ -0,0 +1,246 @@
+"""
+A set of functions for exporting the fine-tuned checkpoints to ONNX and running them through onnxruntime on CPU.
+The runtime side only depends on numpy, tokenizers and onnxruntime, so scoring workers don't need to install
+(nor import) torch or transformers. Only the export and the parity check need them.
+"""
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import onnxruntime
+from tokenizers import Tokenizer
+from tqdm import tqdm
+
+from .batching import get_batches, get_results_by_language, pad_batch
+from .constants import PRED_PROBS, TEXT, MODEL_MAX_LENGTH, ONNX_MODEL_SUFFIX, ONNX_TOKENIZER_SUFFIX
+from .tokenization import get_fast_tokenizer
+
+# Opened inference sessions, keyed by (path, mtime) so a re-exported graph is never served stale
+_sessions = {}
+
+
+def get_onnx_paths(model_path: str) -> tuple[str, str]:
+    """
+    Returns the paths of the ONNX graph and of its tokenizer for a given checkpoint. Both are stored next to it,
+    named after its whole file name, so the .pt and the .safetensors versions of a checkpoint don't share them.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+
+    :return: tuple[str, str]. The paths of the ONNX graph and of the tokenizer (tokenizers JSON format).
+    """
+    return model_path + ONNX_MODEL_SUFFIX, model_path + ONNX_TOKENIZER_SUFFIX
+
+
+def is_onnx_export_current(model_path: str) -> bool:
+    """
+    Checks if a checkpoint has an up-to-date ONNX export: both the graph and its tokenizer exist, and the graph was
+    exported after the last time the checkpoint was written.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+
+    :return: bool. True if the export can be used as it is, False if it must be exported (again).
+    """
+    onnx_path, tokenizer_path = get_onnx_paths(model_path=model_path)
+    return (os.path.isfile(onnx_path) and os.path.isfile(tokenizer_path) and
+            os.path.getmtime(onnx_path) >= os.path.getmtime(model_path))
+
+
+def get_or_export_onnx(model_path: str, tokenizer=None) -> str:
+    """
+    Returns the ONNX graph of a checkpoint, exporting it first (see export_to_onnx) if it's missing, if its
+    tokenizer is missing or if the checkpoint was updated after the last export.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param tokenizer: callable|None. Tokenizer used during the training of the model. Only needed for exporting,
+    so it can be None if the export is known to be up to date (see is_onnx_export_current).
+
+    :return: str. Path to the ONNX graph. Its tokenizer is next to it.
+
+    :raises AssertionError: if the model path is not a file, or if the graph must be exported and no tokenizer
+    is given.
+    """
+    assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+    if is_onnx_export_current(model_path=model_path):
+        return get_onnx_paths(model_path=model_path)[0]
+    assert tokenizer is not None, f"{model_path} must be exported to ONNX, but no tokenizer was given"
+    return export_to_onnx(model_path=model_path, tokenizer=tokenizer)
+
+
+def export_to_onnx(model_path: str, tokenizer, opset_version: int = 18) -> str:
+    """
+    Exports the given checkpoint (for example, the best_model.safetensors of any of the CHECKPOINT_PATHS) to an ONNX graph
+    with dynamic batch and sequence axes. It takes input_ids and attention_mask (int64) and returns the logits.
+    The tokenizer is saved next to it, so the graph can be run without transformers.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param tokenizer: callable. Tokenizer used during the training of the model.
+    :param opset_version: int. ONNX opset to export to.
+
+    :return: str. Path to the exported ONNX graph.
+
+    :raises AssertionError: if the model path is not a file.
+    """
+    # Only the export needs torch and transformers
+    import torch
+    from .model_registry import MODEL_REGISTRY
+
+    assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+    onnx_path, tokenizer_path = get_onnx_paths(model_path=model_path)
+
+    class LogitsOnly(torch.nn.Module):
+        # Plain tensors in and out, instead of HuggingFace's dictionaries
+        def __init__(self, model: torch.nn.Module):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+    model = MODEL_REGISTRY.get_model(model_path=model_path, device=torch.device('cpu'))
+    # Texts of different lengths, so the traced example has padding
+    example = tokenizer(["Texto de ejemplo", "Otro texto de ejemplo algo más largo"], padding=True,
+                        return_tensors='pt')
+    batch_dim, sequence_dim = torch.export.Dim('batch'), torch.export.Dim('sequence', max=MODEL_MAX_LENGTH)
+
+    # Write to a temporary file first, so an interrupted export never leaves a corrupted graph. Its name is unique,
+    # so processes (or sessions) exporting the same checkpoint at once don't overwrite each other's
+    tmp_path = f"{onnx_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    torch.onnx.export(LogitsOnly(model=model), (example['input_ids'], example['attention_mask']),
+                      tmp_path, input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                      dynamic_shapes={'input_ids': {0: batch_dim, 1: sequence_dim},
+                                      'attention_mask': {0: batch_dim, 1: sequence_dim}},
+                      opset_version=opset_version, external_data=False, dynamo=True)
+    os.replace(tmp_path, onnx_path)
+
+    # Save the Rust tokenizer (converting it if it was a Python one) with truncation. Padding is enabled only
+    # for storing the padding token id in the JSON (it's disabled again when loaded)
+    fast_tokenizer = Tokenizer.from_str(get_fast_tokenizer(tokenizer=tokenizer, max_length=MODEL_MAX_LENGTH).to_str())
+    fast_tokenizer.enable_padding(pad_id=tokenizer.pad_token_id or 0, pad_token=tokenizer.pad_token)
+    tmp_path = f"{tokenizer_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    fast_tokenizer.save(tmp_path)
+    os.replace(tmp_path, tokenizer_path)
+
+    return onnx_path
+
+
+def predict_with_onnx(onnx_path: str, df_by_language: dict[str, pd.DataFrame], batch_size: int = 32,
+                      conf_th: float = 0.5, max_tokens_per_batch: int|None = None,
+                      num_threads: int|None = None) -> dict[str, dict[str, list[int]]]:
+    """
+    Same as predict_with_probabilities, but running an ONNX graph exported by export_to_onnx through onnxruntime.
+
+    :param onnx_path: str. Path to the ONNX graph. Its tokenizer must be next to it (as saved by export_to_onnx).
+    :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+    :param batch_size: int. Batch size to use for the predictions.
+    :param conf_th: float. Confidence threshold to use for the predictions if the probabilities are
+    above it, the prediction will be toxic, otherwise it will be non-toxic.
+    :param max_tokens_per_batch: int|None. If given, batch_size is ignored and the batches are packed so that
+    their padded size (longest text x number of texts) stays under this number of tokens.
+    :param num_threads: int|None. Number of intra-op threads of onnxruntime. All cores by default.
+
+    :return: dict[str, dict[str, list[int]]]. A dictionary with the following structure:
+    {<language>: {'true_labels': list[int], 'pred_labels': list[int], 'pred_probs': list[float, float]}}
+
+    :raises AssertionError: if the ONNX graph or its tokenizer are not files.
+    """
+    session, tokenizer, pad_token_id = load_onnx_model(onnx_path=onnx_path, num_threads=num_threads)
+
+    # Batch the texts of all languages together by length, as in predict_with_probabilities
+    texts = [text for lang_dataset in df_by_language.values() for text in lang_dataset[TEXT].tolist()]
+    input_ids = [encoding.ids for encoding in tokenizer.encode_batch(texts)]
+    batches = get_batches(lengths=np.array([len(ids) for ids in input_ids]), batch_size=batch_size,
+                          max_tokens_per_batch=max_tokens_per_batch)
+
+    probabilities = predict_onnx_batches(session=session, input_ids=input_ids, batches=batches,
+                                         pad_token_id=pad_token_id,
+                                         desc=f"Predicting for {', '.join(lang.title() for lang in df_by_language)}")
+
+    return get_results_by_language(probabilities=probabilities, df_by_language=df_by_language, conf_th=conf_th)
+
+
+def load_onnx_model(onnx_path: str, num_threads: int|None = None) -> tuple[onnxruntime.InferenceSession, Tokenizer, int]:
+    """
+    Opens (or reuses, if it was already opened) the inference session of an ONNX graph, along with its tokenizer.
+
+    :param onnx_path: str. Path to the ONNX graph. Its tokenizer must be next to it (as saved by export_to_onnx).
+    :param num_threads: int|None. Number of intra-op threads of onnxruntime. All cores by default.
+
+    :return: tuple[onnxruntime.InferenceSession, Tokenizer, int]. The inference session, the tokenizer (without
+    padding, it's applied per batch) and the padding token id.
+
+    :raises AssertionError: if the ONNX graph or its tokenizer are not files.
+    """
+    tokenizer_path = os.path.splitext(onnx_path)[0] + ONNX_TOKENIZER_SUFFIX
+    assert os.path.isfile(onnx_path), f"ONNX path {onnx_path} is not a file"
+    assert os.path.isfile(tokenizer_path), f"Tokenizer path {tokenizer_path} is not a file"
+
+    key = (os.path.abspath(onnx_path), os.stat(onnx_path).st_mtime_ns, num_threads)
+    if key not in _sessions:
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        session = onnxruntime.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+        tokenizer = Tokenizer.from_file(tokenizer_path)
+        pad_token_id = tokenizer.padding['pad_id'] if tokenizer.padding is not None else 0
+        tokenizer.no_padding()
+        _sessions[key] = session, tokenizer, pad_token_id
+
+    return _sessions[key]
+
+
+def predict_onnx_batches(session: onnxruntime.InferenceSession, input_ids: list[list[int]],
+                         batches: list[np.ndarray], pad_token_id: int, desc: str|None = "Predicting") -> np.ndarray:
+    """
+    Same as predict_batches, but running an onnxruntime inference session.
+
+    :param session: onnxruntime.InferenceSession. Session of a graph exported by export_to_onnx.
+    :param input_ids: list[list[int]]. The token ids of each text.
+    :param batches: list[np.ndarray]. The indices (referring to input_ids) of the texts contained in each batch.
+    :param pad_token_id: int. The token id used for padding each batch up to its longest text.
+    :param desc: str|None. Description shown in the progress bar. If None, the progress bar is not shown.
+
+    :return: np.ndarray. The probabilities of each class for each text, with shape (len(input_ids), 2).
+    """
+    probabilities = np.zeros((len(input_ids), 2), dtype=np.float32)
+    for batch_indices in tqdm(batches, desc=desc, disable=desc is None):
+        batch_input_ids, batch_attention_mask = pad_batch(sequences=[input_ids[i] for i in batch_indices],
+                                                          pad_token_id=pad_token_id)
+        logits = session.run(['logits'], {'input_ids': batch_input_ids, 'attention_mask': batch_attention_mask})[0]
+        # Numerically stable softmax
+        exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities[batch_indices] = exp_logits / exp_logits.sum(axis=1, keepdims=True)
+
+    return probabilities
+
+
+def check_onnx_parity(model_path: str, tokenizer, df_by_language: dict[str, pd.DataFrame],
+                      atol: float = 1e-4) -> float:
+    """
+    Checks that the ONNX graph exported from a checkpoint predicts the same probabilities as the checkpoint
+    itself run through PyTorch (fp32, CPU), within a tolerance.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file). Its ONNX graph is exported
+    first if it's not up to date.
+    :param tokenizer: callable. Tokenizer used during the training of the model.
+    :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+    :param atol: float. Maximum absolute difference allowed between the probabilities of both backends.
+
+    :return: float. The maximum absolute difference found between the probabilities of both backends.
+
+    :raises AssertionError: if the difference is above the tolerance.
+    """
+    # Only the parity check needs torch and transformers
+    import torch
+    from .model_performance_analysis import predict_with_probabilities
+
+    torch_results = predict_with_probabilities(model_path=model_path, tokenizer=tokenizer,
+                                               df_by_language=df_by_language, device=torch.device('cpu'))
+    onnx_results = predict_with_onnx(onnx_path=get_or_export_onnx(model_path=model_path, tokenizer=tokenizer),
+                                     df_by_language=df_by_language)
+
+    max_diff = max((np.abs(np.array(torch_results[lang][PRED_PROBS]) - np.array(onnx_results[lang][PRED_PROBS])).max()
+                    for lang in df_by_language if len(df_by_language[lang]) > 0), default=0.)
+    assert max_diff <= atol, f"ONNX probabilities differ from PyTorch ones by {max_diff} (tolerance {atol})"
+    return float(max_diff)
@@ -0,0 +1,216 @@
+"""
+Multi-process inference on CPU. The texts are sharded across several worker processes, each one holding its own
+copy of the model and a pinned (small) number of threads, which scales much better on many-core machines than
+torch intra-op threading at small batch sizes. Results are merged back in the original order.
+"""
+import os
+import multiprocessing
+import multiprocessing.synchronize
+import threading
+
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from .batching import get_batches, get_results_by_language
+from .constants import TEXT, MODEL_MAX_LENGTH, FP32_BACKEND, INT8_BACKEND
+from .model_performance_analysis import predict_batches
+from .model_registry import MODEL_REGISTRY, prepare_int8_model
+from .tokenization import get_sequences, tokenize_texts
+from .tokenization_cache import TokenizationCache
+
+# Model of each worker process (and its tokenizer's padding token), loaded once by _init_worker, the error
+# raised while loading it (if any) and the barrier where all the workers wait for each other to be ready
+_worker_model, _worker_pad_token_id, _worker_error, _all_workers_ready = None, 0, None, None
+
+
+class ShardedPredictor:
+    """
+    Pool of worker processes, each one with a warm copy of the model, ready to predict. Use it as a
+    context manager, so the workers are always terminated:
+
+        with ShardedPredictor(model_path=..., tokenizer=tokenizer, num_workers=8) as predictor:
+            results_by_lang = predictor.predict(df_by_language=test_set_by_lang)
+    """
+
+    def __init__(self, model_path: str, tokenizer, num_workers: int|None = None, threads_per_worker: int = 1,
+                 batch_size: int = 32, max_tokens_per_batch: int|None = None, backend: str = FP32_BACKEND,
+                 batches_per_shard: int = 4, cache: TokenizationCache|None = None, load_timeout: float = 600.):
+        """
+        :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+        :param tokenizer: callable. Tokenizer to use for tokenizing the data before feeding it to the model.
+        :param num_workers: int|None. Number of worker processes (each one loads a copy of the model). If None,
+        one per threads_per_worker cores of the machine, so the workers don't oversubscribe the CPU.
+        :param threads_per_worker: int. Number of torch threads of each worker.
+        :param batch_size: int. Batch size to use for the predictions.
+        :param max_tokens_per_batch: int|None. If given, batch_size is ignored and the batches are packed so that
+        their padded size (longest text x number of texts) stays under this number of tokens.
+        :param backend: str. FP32_BACKEND or INT8_BACKEND (see predict_with_probabilities).
+        :param batches_per_shard: int. Number of batches sent to a worker at once. Small shards balance the load
+        better between workers, big shards reduce the communication overhead.
+        :param cache: TokenizationCache|None. Cache to read the tokens from (e.g. TOKENIZATION_CACHE), storing the
+        new ones. If None, texts are always tokenized.
+        :param load_timeout: float. Maximum number of seconds to wait for all the workers to load their model.
+
+        :raises AssertionError: if the model path is not a file, if the backend is not a torch one or if the
+        number of workers or threads is not positive.
+        :raises TimeoutError: if the workers didn't load their model in load_timeout seconds.
+        :raises Exception: the error raised by a worker while loading its model, if any.
+        """
+        assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+        assert backend in (FP32_BACKEND, INT8_BACKEND), f"Backend must be {FP32_BACKEND} or {INT8_BACKEND}. " \
+                                                        f"Got {backend}."
+        assert threads_per_worker > 0, f"Threads per worker must be positive. Got {threads_per_worker}."
+        # Resolved at each call (not at import time), from the cores left for each worker
+        if num_workers is None:
+            num_workers = max((os.cpu_count() or 1) // threads_per_worker, 1)
+        assert num_workers > 0, f"Number of workers must be positive. Got {num_workers}."
+
+        self.tokenizer, self.num_workers = tokenizer, num_workers
+        self.batch_size, self.max_tokens_per_batch = batch_size, max_tokens_per_batch
+        self.batches_per_shard, self.cache = batches_per_shard, cache
+
+        if backend == INT8_BACKEND:
+            # Quantize (and cache) the model once here, so the workers only load it. Otherwise all of them would
+            # quantize it at the same time when it's not cached yet
+            prepare_int8_model(model_path=model_path)
+
+        # Spawn (instead of fork) to avoid inheriting the threads of the main process' torch
+        context = multiprocessing.get_context('spawn')
+        all_workers_ready = context.Barrier(num_workers)
+        self._pool = context.Pool(processes=num_workers, initializer=_init_worker,
+                                  initargs=(model_path, backend, threads_per_worker,
+                                            tokenizer.pad_token_id or 0, all_workers_ready))
+        # Wait until every worker has loaded its model, so the first prediction is not slowed down by it. Each
+        # worker takes one of these tasks (they wait for each other inside), and returns its loading error, if any
+        try:
+            load_errors = self._pool.map_async(_wait_until_ready, [load_timeout] * num_workers,
+                                               chunksize=1).get(timeout=load_timeout)
+        except multiprocessing.TimeoutError:
+            self.close()
+            raise TimeoutError(f"Workers didn't load {model_path} in {load_timeout} seconds")
+        load_errors = [error for error in load_errors if error is not None]
+        if len(load_errors) > 0:
+            self.close()
+            # Report the original error, not the broken barrier of the workers that were waiting for it
+            raise next((error for error in load_errors if not isinstance(error, threading.BrokenBarrierError)),
+                       load_errors[0])
+
+    def predict(self, df_by_language: dict[str, pd.DataFrame], conf_th: float = 0.5) -> dict[str, dict[str, list[int]]]:
+        """
+        Same as predict_with_probabilities, but distributing the batches across the worker processes.
+
+        :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+        :param conf_th: float. Confidence threshold to use for the predictions if the probabilities are
+        above it, the prediction will be toxic, otherwise it will be non-toxic.
+
+        :return: dict[str, dict[str, list[int]]]. A dictionary with the following structure:
+        {<language>: {'true_labels': list[int], 'pred_labels': list[int], 'pred_probs': list[float, float]}}
+        """
+        texts = [text for lang_dataset in df_by_language.values() for text in lang_dataset[TEXT].tolist()]
+        if self.cache is not None:
+            tokens, offsets = self.cache.tokenize(texts=texts, tokenizer=self.tokenizer, max_length=MODEL_MAX_LENGTH)
+        else:
+            tokens, offsets = tokenize_texts(texts=texts, tokenizer=self.tokenizer, max_length=MODEL_MAX_LENGTH)
+        input_ids = get_sequences(tokens=tokens, offsets=offsets)
+        batches = get_batches(lengths=np.diff(offsets), batch_size=self.batch_size,
+                              max_tokens_per_batch=self.max_tokens_per_batch)
+
+        # Each shard is a group of consecutive (length-sorted) batches with the token ids of their texts
+        shards = []
+        for start in range(0, len(batches), self.batches_per_shard):
+            shard_batches = batches[start:start + self.batches_per_shard]
+            shard_indices = np.concatenate(shard_batches)
+            # Batches of the shard are referred to the shard's own texts
+            local_batches = np.split(np.arange(len(shard_indices)), np.cumsum([len(b) for b in shard_batches])[:-1])
+            shards.append((shard_indices, [input_ids[i] for i in shard_indices], local_batches))
+
+        probabilities = np.zeros((len(texts), 2), dtype=np.float32)
+        # Shards are consumed as workers get free, and scattered back to the original position of their texts
+        for shard_indices, shard_probabilities in tqdm(self._pool.imap_unordered(_predict_shard, shards),
+                                                       desc=f"Predicting with {self.num_workers} workers",
+                                                       total=len(shards)):
+            probabilities[shard_indices] = shard_probabilities
+
+        return get_results_by_language(probabilities=probabilities, df_by_language=df_by_language, conf_th=conf_th)
+
+    def close(self):
+        """
+        Terminates the worker processes.
+        """
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def predict_with_probabilities_parallel(model_path: str, tokenizer, df_by_language: dict[str, pd.DataFrame],
+                                        num_workers: int|None = None, threads_per_worker: int = 1,
+                                        batch_size: int = 32, conf_th: float = 0.5,
+                                        max_tokens_per_batch: int|None = None,
+                                        backend: str = FP32_BACKEND,
+                                        cache: TokenizationCache|None = None) -> dict[str, dict[str, list[int]]]:
+    """
+    Same as predict_with_probabilities, but sharding the texts across several CPU worker processes. Workers
+    are started (and load the model) at each call, use ShardedPredictor to keep them alive between calls.
+
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param tokenizer: callable. Tokenizer to use for tokenizing the data before feeding it to the model.
+    :param df_by_language: dict[str, pd.DataFrame]. A dictionary containing the dataframes for each language.
+    :param num_workers: int|None. Number of worker processes (each one loads a copy of the model). If None, one
+    per threads_per_worker cores of the machine.
+    :param threads_per_worker: int. Number of torch threads of each worker.
+    :param batch_size: int. Batch size to use for the predictions.
+    :param conf_th: float. Confidence threshold to use for the predictions if the probabilities are
+    above it, the prediction will be toxic, otherwise it will be non-toxic.
+    :param max_tokens_per_batch: int|None. If given, batch_size is ignored and the batches are packed so that
+    their padded size (longest text x number of texts) stays under this number of tokens.
+    :param backend: str. FP32_BACKEND or INT8_BACKEND (see predict_with_probabilities).
+    :param cache: TokenizationCache|None. Cache to read the tokens from. If None, texts are always tokenized.
+
+    :return: dict[str, dict[str, list[int]]]. A dictionary with the following structure:
+    {<language>: {'true_labels': list[int], 'pred_labels': list[int], 'pred_probs': list[float, float]}}
+    """
+    with ShardedPredictor(model_path=model_path, tokenizer=tokenizer, num_workers=num_workers,
+                          threads_per_worker=threads_per_worker, batch_size=batch_size,
+                          max_tokens_per_batch=max_tokens_per_batch, backend=backend, cache=cache) as predictor:
+        return predictor.predict(df_by_language=df_by_language, conf_th=conf_th)
+
+
+# ------------------------------- WORKER FUNCTIONS ---------------------------------------------
+
+def _init_worker(model_path: str, backend: str, threads_per_worker: int, pad_token_id: int,
+                 all_workers_ready: multiprocessing.synchronize.Barrier):
+    global _worker_model, _worker_pad_token_id, _worker_error, _all_workers_ready
+    # Pin the number of threads, so the workers don't compete for the same cores
+    torch.set_num_threads(threads_per_worker)
+    _worker_pad_token_id, _all_workers_ready = pad_token_id, all_workers_ready
+    # Errors are not raised here: the pool would replace the worker (that would fail again) forever. They are
+    # reported by _wait_until_ready instead
+    try:
+        _worker_model = MODEL_REGISTRY.get_model(model_path=model_path, device=torch.device('cpu'), backend=backend)
+    except Exception as error:
+        _worker_error = error
+
+
+def _wait_until_ready(timeout: float) -> Exception|None:
+    if _worker_error is not None:
+        # Release the workers that are waiting for this one
+        _all_workers_ready.abort()
+        return _worker_error
+    try:
+        _all_workers_ready.wait(timeout=timeout)
+    except threading.BrokenBarrierError as error:
+        return error
+    return None
+
+
+def _predict_shard(shard: tuple[np.ndarray, list[list[int]], list[np.ndarray]]) -> tuple[np.ndarray, np.ndarray]:
+    shard_indices, input_ids, batches = shard
+    return shard_indices, predict_batches(model=_worker_model, input_ids=input_ids, batches=batches,
+                                          pad_token_id=_worker_pad_token_id, device=torch.device('cpu'), desc=None)
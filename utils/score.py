@@ -0,0 +1,172 @@
+"""
+Headless batch scoring of a CSV with the project's schema (ID, TEXT, ORIGIN...) with a fine-tuned checkpoint,
+for scoring data outside the notebook. For example:
+
+    python -m utils.score --input data/dump.csv --model checkpoints/<experiment>/best_model.safetensors --output scores/
+
+The input is read and scored in shards of --shard-size rows, each one written to its own file in the output
+directory (part-00000.csv, part-00001.csv...) with the id, the toxic probability and the predicted label of each
+text. A progress file is updated after each finished shard, so running the same command again after a killed
+job resumes from the first unfinished shard instead of starting over.
+The tokenizer is read from the model's directory (where the training saves it) or from --tokenizer, so scoring
+works offline. The ONNX backend doesn't need it at all once the model is exported (it has its own tokenizer).
+"""
+import argparse
+import json
+import os
+from typing import TYPE_CHECKING
+
+import pandas as pd
+import torch
+
+from .constants import ID, TEXT, LABEL, PROBABILITY, PRED_PROBS, PRED_LABELS, MODEL_NAME, FP32_BACKEND, \
+    INT8_BACKEND, ONNX_BACKEND, SCORE_PROGRESS_FILE, SCORE_SHARD_NAME, TOKENIZER_CONFIG_FILE
+from .model_performance_analysis import predict_stream
+
+if TYPE_CHECKING:
+    from transformers import DistilBertTokenizer
+
+
+def score_csv(input_path: str, model_path: str, output_dir: str, shard_size: int = 10000, batch_size: int = 32,
+              conf_th: float = 0.5, max_tokens_per_batch: int|None = None, backend: str = FP32_BACKEND,
+              device: torch.device|None = None, tokenizer_path: str|None = None) -> int:
+    """
+    Scores all the texts of a CSV, writing the results in shards to output_dir and resuming from the last
+    finished shard if the output directory already contains the progress of a previous (killed) run.
+
+    :param input_path: str. Path to the CSV to score. It must contain (at least) the ID and TEXT columns.
+    :param model_path: str. Path to the model's state dict (.safetensors or .pt file).
+    :param output_dir: str. Directory where the shards and the progress file are written.
+    :param shard_size: int. Number of rows of each shard.
+    :param batch_size: int. Batch size to use for the predictions.
+    :param conf_th: float. Confidence threshold to use for the predictions if the probabilities are
+    above it, the prediction will be toxic, otherwise it will be non-toxic.
+    :param max_tokens_per_batch: int|None. If given, batch_size is ignored and the batches are packed so that
+    their padded size (longest text x number of texts) stays under this number of tokens.
+    :param backend: str. FP32_BACKEND, INT8_BACKEND or ONNX_BACKEND (see predict_with_probabilities).
+    :param device: torch.device|None. Device to use for the model. GPU if available by default.
+    :param tokenizer_path: str|None. Directory (or HuggingFace name) of the tokenizer. By default, the directory of
+    the model if it contains one, MODEL_NAME otherwise. Not loaded by ONNX_BACKEND if the model is already exported.
+
+    :return: int. Total number of texts scored, including the ones scored by previous runs.
+
+    :raises AssertionError: if the input or the model are not files, or if the output directory contains the
+    progress of a different job (other input, model or parameters, or the same input or model files modified).
+    """
+    assert os.path.isfile(input_path), f"Input path {input_path} is not a file"
+    assert os.path.isfile(model_path), f"Model path {model_path} is not a file"
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    os.makedirs(output_dir, exist_ok=True)
+    progress_path = os.path.join(output_dir, SCORE_PROGRESS_FILE)
+    # Everything that changes the content of the shards. Resuming is only allowed if they are all the same. The
+    # modification time and size of the input and the model detect if any of them was replaced at the same path
+    input_stats, model_stats = os.stat(input_path), os.stat(model_path)
+    job = {'input': os.path.abspath(input_path), 'input_version': [input_stats.st_mtime_ns, input_stats.st_size],
+           'model': os.path.abspath(model_path), 'model_version': [model_stats.st_mtime_ns, model_stats.st_size],
+           'shard_size': shard_size, 'conf_th': conf_th, 'backend': backend}
+    progress = {**job, 'finished_shards': 0, 'scored_rows': 0, 'done': False}
+
+    if os.path.isfile(progress_path):
+        with open(progress_path, 'r') as f:
+            progress = json.load(f)
+        assert all(progress.get(key) == value for key, value in job.items()), \
+            f"{output_dir} contains the output of a different job ({progress}). Use another output directory."
+        if progress['done']:
+            print(f"Already scored {progress['scored_rows']} rows in {progress['finished_shards']} shards")
+            return progress['scored_rows']
+        print(f"Resuming from shard {progress['finished_shards']} ({progress['scored_rows']} rows already scored)")
+
+    # Skip the rows of the finished shards (keeping the header), and read the rest shard by shard
+    chunks = pd.read_csv(input_path, encoding='utf-8', usecols=[ID, TEXT], dtype={ID: 'string', TEXT: 'string'},
+                         skiprows=range(1, progress['scored_rows'] + 1), chunksize=shard_size)
+    # Missing texts would break the tokenizer. Score them as empty texts, so the ids are kept in the output
+    chunks = (chunk.fillna({TEXT: ''}) for chunk in chunks)
+
+    tokenizer = _load_tokenizer(model_path=model_path, backend=backend, tokenizer_path=tokenizer_path)
+    # Each chunk fits in a single window, so each result of the stream is exactly one shard
+    for results in predict_stream(model_path=model_path, tokenizer=tokenizer, chunks=chunks, device=device,
+                                  batch_size=batch_size, conf_th=conf_th, max_tokens_per_batch=max_tokens_per_batch,
+                                  backend=backend, window_size=shard_size):
+        shard_path = os.path.join(output_dir, SCORE_SHARD_NAME.format(progress['finished_shards']))
+        shard = pd.DataFrame({ID: results[ID], PROBABILITY: [probs[1] for probs in results[PRED_PROBS]],
+                              LABEL: results[PRED_LABELS]})
+        # Write the shard before recording it as finished, both atomically, so a killed job never leaves
+        # a half-written shard nor a progress pointing to a missing one
+        shard.to_csv(f"{shard_path}.tmp", index=False, encoding='utf-8')
+        os.replace(f"{shard_path}.tmp", shard_path)
+
+        progress['finished_shards'] += 1
+        progress['scored_rows'] += len(shard)
+        _write_progress(progress=progress, progress_path=progress_path)
+
+    progress['done'] = True
+    _write_progress(progress=progress, progress_path=progress_path)
+    print(f"Scored {progress['scored_rows']} rows in {progress['finished_shards']} shards")
+    return progress['scored_rows']
+
+
+def _load_tokenizer(model_path: str, backend: str, tokenizer_path: str|None = None) -> 'DistilBertTokenizer|None':
+    """
+    Loads the tokenizer of the model, preferring local files to the HuggingFace hub.
+
+    :param model_path: str. Path to the model's state dict.
+    :param backend: str. FP32_BACKEND, INT8_BACKEND or ONNX_BACKEND.
+    :param tokenizer_path: str|None. Directory (or HuggingFace name) of the tokenizer. By default, the directory of
+    the model if it contains one (tokenizer_config.json), MODEL_NAME otherwise.
+
+    :return: DistilBertTokenizer|None. The tokenizer, or None if the backend is ONNX_BACKEND and the model is
+    already exported (its own tokenizer is used then).
+    """
+    if backend == ONNX_BACKEND:
+        from .onnx_backend import is_onnx_export_current
+        if is_onnx_export_current(model_path=model_path):
+            return None
+
+    if tokenizer_path is None:
+        model_dir = os.path.dirname(os.path.abspath(model_path))
+        tokenizer_path = model_dir if os.path.isfile(os.path.join(model_dir, TOKENIZER_CONFIG_FILE)) else MODEL_NAME
+    # Imported here, so `--help`, a finished job and the ONNX backend don't wait for transformers to load
+    from transformers import DistilBertTokenizer
+    return DistilBertTokenizer.from_pretrained(tokenizer_path)
+
+
+def _write_progress(progress: dict[str, str|int|float|bool], progress_path: str):
+    """
+    Atomically overwrites the progress file of a scoring job.
+
+    :param progress: dict[str, str|int|float|bool]. The progress of the job.
+    :param progress_path: str. Path to the progress file.
+    """
+    with open(f"{progress_path}.tmp", 'w') as f:
+        json.dump(progress, f, indent=4)
+    os.replace(f"{progress_path}.tmp", progress_path)
+
+
+def main(args: list[str]|None = None):
+    parser = argparse.ArgumentParser(description="Score the texts of a CSV with a fine-tuned toxicity model. "
+                                                 "Run it again with the same arguments to resume a killed job.")
+    parser.add_argument('--input', required=True, help=f"CSV to score, with (at least) {ID} and {TEXT} columns.")
+    parser.add_argument('--model', required=True, help="Checkpoint (.safetensors or .pt state dict) of the fine-tuned model.")
+    parser.add_argument('--output', required=True, help="Directory where the shards and the progress are written.")
+    parser.add_argument('--shard-size', type=int, default=10000, help="Number of rows of each output shard.")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-tokens-per-batch', type=int, default=None,
+                        help="Token budget of each batch. If given, --batch-size is ignored.")
+    parser.add_argument('--conf-th', type=float, default=0.5, help="Probability above which a text is toxic.")
+    parser.add_argument('--backend', choices=(FP32_BACKEND, INT8_BACKEND, ONNX_BACKEND), default=FP32_BACKEND)
+    parser.add_argument('--device', default=None, help="Torch device (cpu, cuda...). GPU if available by default.")
+    parser.add_argument('--tokenizer', default=None,
+                        help="Tokenizer directory. By default, the model's directory if it contains one, "
+                             f"{MODEL_NAME} otherwise. Not needed by an already exported {ONNX_BACKEND} model.")
+    args = parser.parse_args(args)
+
+    score_csv(input_path=args.input, model_path=args.model, output_dir=args.output, shard_size=args.shard_size,
+              batch_size=args.batch_size, conf_th=args.conf_th, max_tokens_per_batch=args.max_tokens_per_batch,
+              backend=args.backend, device=torch.device(args.device) if args.device is not None else None,
+              tokenizer_path=args.tokenizer)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+A tokenization engine built on the Rust-backed fast tokenizers. Texts are encoded many at a time (and, for big
+splits, across several worker processes), and returned as two contiguous arrays instead of one list per text:
+the concatenated token ids of all the texts and the offsets where each text starts. Both the training dataset
+and the prediction path use this format, and it's also the format stored by the tokenization cache.
+"""
+import os
+import multiprocessing
+from itertools import chain
+
+import numpy as np
+from tokenizers import Tokenizer
+
+from .constants import MODEL_MAX_LENGTH
+
+# Fast tokenizers already converted, keyed by (tokenizer name, class, max length), since converting a slow
+# tokenizer takes a while
+_fast_tokenizers = {}
+# Tokenizer of each worker process, loaded once by _init_worker
+_worker_tokenizer = None
+
+
+def get_fast_tokenizer(tokenizer, max_length: int = MODEL_MAX_LENGTH) -> Tokenizer:
+    """
+    Returns the Rust tokenizer equivalent to the given HuggingFace tokenizer (converting it if it's a slow
+    Python one), truncating to max_length and without padding.
+
+    :param tokenizer: callable. HuggingFace tokenizer (slow or fast).
+    :param max_length: int. Maximum number of tokens of each text.
+
+    :return: Tokenizer. The fast tokenizer, producing the same token ids as tokenizer(text, truncation=True).
+    """
+    key = (tokenizer.name_or_path, type(tokenizer).__name__, max_length)
+    if key not in _fast_tokenizers:
+        if getattr(tokenizer, 'is_fast', False):
+            # Copy it, to not change the truncation and padding of the given tokenizer
+            fast_tokenizer = Tokenizer.from_str(tokenizer.backend_tokenizer.to_str())
+        else:
+            # Only needed for the slow tokenizers
+            from transformers.convert_slow_tokenizer import convert_slow_tokenizer
+            fast_tokenizer = convert_slow_tokenizer(tokenizer)
+        fast_tokenizer.enable_truncation(max_length=max_length)
+        fast_tokenizer.no_padding()
+        _fast_tokenizers[key] = fast_tokenizer
+
+    return _fast_tokenizers[key]
+
+
+def tokenize_texts(texts: list[str], tokenizer, max_length: int = MODEL_MAX_LENGTH,
+                   num_workers: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Tokenizes (truncating and without padding) all the given texts with the fast version of the tokenizer.
+
+    :param texts: list[str]. The texts to tokenize.
+    :param tokenizer: callable. HuggingFace tokenizer (slow or fast).
+    :param max_length: int. Maximum number of tokens of each text.
+    :param num_workers: int. Number of worker processes. With 1 (the default), texts are encoded in this process,
+    which already uses all the cores for each batch. More workers only pay off for big splits, since starting
+    them takes a few seconds.
+
+    :return: tuple[np.ndarray, np.ndarray]. The token ids of all the texts concatenated (int32) and the offsets
+    (int64, len(texts) + 1) of each text in them. The tokens of text i are tokens[offsets[i]:offsets[i + 1]].
+
+    :raises AssertionError: if the number of workers is not positive.
+    """
+    assert num_workers > 0, f"Number of workers must be positive. Got {num_workers}."
+    fast_tokenizer = get_fast_tokenizer(tokenizer=tokenizer, max_length=max_length)
+
+    if num_workers == 1 or len(texts) < num_workers:
+        return _encode(fast_tokenizer=fast_tokenizer, texts=texts)
+
+    # A few chunks per worker, to balance the load between them
+    chunk_size = -(-len(texts) // (num_workers * 4))
+    chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+    # Spawn (instead of fork), since forking after the Rust tokenizer has been used can deadlock it
+    with multiprocessing.get_context('spawn').Pool(processes=num_workers, initializer=_init_worker,
+                                                    initargs=(fast_tokenizer.to_str(),)) as pool:
+        encoded_chunks = pool.map(_encode_chunk, chunks)
+
+    tokens = np.concatenate([chunk_tokens for chunk_tokens, _ in encoded_chunks])
+    # Offsets of each chunk start at 0, shift them by the tokens of the previous chunks
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate([np.diff(chunk_offsets) for _, chunk_offsets in encoded_chunks]), out=offsets[1:])
+    return tokens, offsets
+
+
+def get_sequences(tokens: np.ndarray, offsets: np.ndarray) -> list[np.ndarray]:
+    """
+    Splits the concatenated tokens into the token ids of each text (as views, nothing is copied).
+
+    :param tokens: np.ndarray. The token ids of all the texts concatenated.
+    :param offsets: np.ndarray. The offsets of each text in the tokens array, as returned by tokenize_texts.
+
+    :return: list[np.ndarray]. The token ids of each text.
+    """
+    return [tokens[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def pad_sequences(tokens: np.ndarray, offsets: np.ndarray, length: int,
+                  pad_token_id: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Same as batching.pad_batch with a fixed length, but directly from the concatenated tokens (without
+    a Python loop over the texts).
+
+    :param tokens: np.ndarray. The token ids of all the texts concatenated.
+    :param offsets: np.ndarray. The offsets of each text in the tokens array, as returned by tokenize_texts.
+    :param length: int. Length to pad each text to. No text can be longer than it.
+    :param pad_token_id: int. The token id used for padding.
+
+    :return: tuple[np.ndarray, np.ndarray]. The padded input ids and their attention mask (int64), both with
+    shape (number of texts, length).
+    """
+    attention_mask = np.arange(length) < np.diff(offsets)[:, None]
+    input_ids = np.full(attention_mask.shape, fill_value=pad_token_id, dtype=np.int64)
+    # Row-major order, so the real tokens of each text are filled in their original order
+    input_ids[attention_mask] = tokens
+    return input_ids, attention_mask.astype(np.int64)
+
+
+def _encode(fast_tokenizer: Tokenizer, texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    encodings = fast_tokenizer.encode_batch(texts)
+    offsets = np.zeros(len(encodings) + 1, dtype=np.int64)
+    np.cumsum([len(encoding.ids) for encoding in encodings], out=offsets[1:])
+
+    tokens = np.fromiter(chain.from_iterable(encoding.ids for encoding in encodings), dtype=np.int32,
+                         count=offsets[-1])
+    return tokens, offsets
+
+
+# ------------------------------- WORKER FUNCTIONS ---------------------------------------------
+
+def _init_worker(tokenizer_json: str):
+    global _worker_tokenizer
+    # One thread per worker, so the workers don't compete for the same cores (must be set before encoding)
+    os.environ['RAYON_NUM_THREADS'] = '1'
+    _worker_tokenizer = Tokenizer.from_str(tokenizer_json)
+
+
+def _encode_chunk(texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    return _encode(fast_tokenizer=_worker_tokenizer, texts=texts)
@@ -0,0 +1,201 @@
+"""
+A persistent on-disk cache of tokenized texts, shared by training (ToxicityDataset) and inference
+(predict_with_probabilities), so the same data is never tokenized twice, not even between sessions.
+Texts are keyed by the hash of their content and stored in compact memory-mapped arrays, in one directory per
+tokenizer name and maximum length, since both change the resulting tokens.
+"""
+import json
+import os
+import re
+import uuid
+from hashlib import blake2b
+from time import perf_counter
+
+import numpy as np
+
+from .constants import MODEL_MAX_LENGTH, TOKENIZATION_CACHE_DIR
+from .tokenization import tokenize_texts
+
+
+class TokenizationCache:
+    """
+    Each call to tokenize stores the texts that were not cached yet as a new shard of three .npy files: the
+    hashes of the texts (uint64), and the concatenated token ids (int32, memory-mapped when read) and offsets
+    (int64) of all of them, as returned by tokenization.tokenize_texts, plus a small JSON file with the time spent
+    tokenizing them. Shards are never modified and their hashes file is written last, so a shard only becomes
+    visible once it's complete (even if the process is killed while writing it) and several sessions can share
+    the same cache directory without any lock.
+    The cache is opt-in: functions that can use it take it as an argument, and don't use any cache by default.
+    """
+
+    def __init__(self, cache_dir: str = TOKENIZATION_CACHE_DIR):
+        """
+        :param cache_dir: str. Directory where the cached tokens are stored. It's created when first needed. A
+        relative path is resolved against the working directory when the cache is created, not at each call.
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+
+        # Cached texts of each namespace {namespace dir: {text hash: (shard name, start, end)}}, the
+        # (memory-mapped) tokens of each shard and the shards already read
+        self._index, self._tokens, self._loaded_shards = {}, {}, set()
+        # Number of texts and tokenization time of the shards read, by namespace {namespace dir: [texts, seconds]}
+        self._namespace_stats = {}
+
+        # Metrics to report
+        self.hits, self.misses = 0, 0
+        self.lookup_seconds, self.tokenization_seconds, self.time_saved_seconds = 0., 0., 0.
+
+    def tokenize(self, texts: list[str], tokenizer, max_length: int = MODEL_MAX_LENGTH,
+                 num_workers: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Same as tokenization.tokenize_texts, but only the texts that are not in the cache are tokenized (all at
+        once), and they are stored for the next calls.
+
+        :param texts: list[str]. The texts to tokenize.
+        :param tokenizer: callable. HuggingFace tokenizer. Its name_or_path is part of the cache key.
+        :param max_length: int. Maximum number of tokens of each text. It's also part of the cache key.
+        :param num_workers: int. Number of worker processes used for tokenizing the texts that are not cached.
+
+        :return: tuple[np.ndarray, np.ndarray]. The token ids of all the texts concatenated (int32) and the offsets
+        (int64, len(texts) + 1) of each text in them, in the same order as the texts.
+        """
+        start = perf_counter()
+        namespace_dir = os.path.join(self.cache_dir, _get_namespace(tokenizer=tokenizer, max_length=max_length))
+        index = self._load_new_shards(namespace_dir=namespace_dir)
+
+        hashes = [get_text_hash(text=text) for text in texts]
+        # Dictionary instead of a list, so repeated texts are tokenized only once
+        missing_texts = {text_hash: text for text_hash, text in zip(hashes, texts) if text_hash not in index}
+        hits = sum(text_hash in index for text_hash in hashes)
+        self.lookup_seconds += perf_counter() - start
+
+        if missing_texts:
+            tokenization_start = perf_counter()
+            tokens, offsets = tokenize_texts(texts=list(missing_texts.values()), tokenizer=tokenizer,
+                                             max_length=max_length, num_workers=num_workers)
+            tokenization_seconds = perf_counter() - tokenization_start
+            self.tokenization_seconds += tokenization_seconds
+
+            self._write_shard(namespace_dir=namespace_dir, hashes=list(missing_texts), tokens=tokens,
+                              offsets=offsets, seconds=tokenization_seconds)
+            index = self._load_new_shards(namespace_dir=namespace_dir)
+
+        # Estimate the time saved by the hits from the (historical) tokenization time of this namespace
+        self.hits, self.misses = self.hits + hits, self.misses + len(texts) - hits
+        self.time_saved_seconds += hits * self._get_seconds_per_text(namespace_dir=namespace_dir)
+
+        # Gather the tokens of each text (from any of the shards) into a single contiguous array
+        locations = [index[text_hash] for text_hash in hashes]
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([end - start for _, start, end in locations], out=offsets[1:])
+        tokens = np.empty(offsets[-1], dtype=np.int32)
+        for (shard, start, end), offset in zip(locations, offsets[:-1].tolist()):
+            tokens[offset:offset + end - start] = self._tokens[shard][start:end]
+
+        return tokens, offsets
+
+    def stats(self) -> dict[str, int|float]:
+        """
+        Returns the hit rate and the time saved by the cache since it was created.
+
+        :return: dict[str, int|float]. A dictionary with the following structure:
+        {'hits': int, 'misses': int, 'hit_rate': float, 'lookup_seconds': float, 'tokenization_seconds': float,
+         'time_saved_seconds': float, 'cached_texts': int, 'disk_bytes': int}
+        The time saved is the estimated tokenization time of the hits, minus the time spent looking them up.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / max(self.hits + self.misses, 1),
+            'lookup_seconds': self.lookup_seconds,
+            'tokenization_seconds': self.tokenization_seconds,
+            'time_saved_seconds': self.time_saved_seconds - self.lookup_seconds,
+            'cached_texts': sum(len(index) for index in self._index.values()),
+            'disk_bytes': sum(os.path.getsize(os.path.join(namespace_dir, file_name))
+                              for namespace_dir in self._index if os.path.isdir(namespace_dir)
+                              for file_name in os.listdir(namespace_dir))
+        }
+
+    def _load_new_shards(self, namespace_dir: str) -> dict[int, tuple[str, int, int]]:
+        """
+        Reads the shards of the namespace that were written (by this or other sessions) since the last call.
+
+        :param namespace_dir: str. Directory of the namespace (tokenizer name and maximum length).
+
+        :return: dict[int, tuple[str, int, int]]. The index of the namespace {text hash: (shard name, start, end)}.
+        """
+        index = self._index.setdefault(namespace_dir, {})
+        namespace_stats = self._namespace_stats.setdefault(namespace_dir, [0, 0.])
+        if not os.path.isdir(namespace_dir):
+            return index
+
+        for file_name in os.listdir(namespace_dir):
+            shard = os.path.join(namespace_dir, file_name[:-len('.hashes.npy')])
+            if not file_name.endswith('.hashes.npy') or shard in self._loaded_shards:
+                continue
+
+            hashes, offsets = np.load(f"{shard}.hashes.npy"), np.load(f"{shard}.offsets.npy")
+            # Only the hashes and the offsets are read, tokens stay in disk until they are needed
+            self._tokens[shard] = np.load(f"{shard}.tokens.npy", mmap_mode='r')
+            index.update(zip(hashes.tolist(), ((shard, start, end) for start, end
+                                               in zip(offsets[:-1].tolist(), offsets[1:].tolist()))))
+            if os.path.isfile(f"{shard}.stats.json"):
+                with open(f"{shard}.stats.json", 'r') as f:
+                    shard_stats = json.load(f)
+                namespace_stats[0], namespace_stats[1] = (namespace_stats[0] + shard_stats['texts'],
+                                                          namespace_stats[1] + shard_stats['seconds'])
+            self._loaded_shards.add(shard)
+
+        return index
+
+    def _write_shard(self, namespace_dir: str, hashes: list[int], tokens: np.ndarray, offsets: np.ndarray,
+                     seconds: float):
+        """
+        Stores a new shard with the given tokenized texts and its tokenization time. Each shard has its own stats
+        file (written once), so concurrent sessions never update the same file.
+
+        :param namespace_dir: str. Directory of the namespace (tokenizer name and maximum length).
+        :param hashes: list[int]. The hash of each text.
+        :param tokens: np.ndarray. The token ids of all the texts concatenated.
+        :param offsets: np.ndarray. The offsets of each text in the tokens array.
+        :param seconds: float. Time spent tokenizing the texts.
+        """
+        os.makedirs(namespace_dir, exist_ok=True)
+        # Random name, so concurrent sessions never write the same shard
+        shard = os.path.join(namespace_dir, uuid.uuid4().hex)
+
+        with open(f"{shard}.stats.json.tmp", 'w') as f:
+            json.dump({'texts': len(hashes), 'seconds': seconds}, f)
+        os.replace(f"{shard}.stats.json.tmp", f"{shard}.stats.json")
+
+        # Hashes go last, they mark the shard as complete
+        for suffix, array in (('tokens', tokens), ('offsets', offsets), ('hashes', np.array(hashes, dtype=np.uint64))):
+            with open(f"{shard}.{suffix}.npy.tmp", 'wb') as f:
+                np.save(f, array)
+            os.replace(f"{shard}.{suffix}.npy.tmp", f"{shard}.{suffix}.npy")
+
+    def _get_seconds_per_text(self, namespace_dir: str) -> float:
+        texts, seconds = self._namespace_stats.get(namespace_dir, (0, 0.))
+        return seconds / max(texts, 1)
+
+
+def get_text_hash(text: str) -> int:
+    """
+    Returns a 64 bits hash of the content of a text (stable between sessions, unlike Python's hash).
+
+    :param text: str. The text to hash.
+
+    :return: int. The hash, as an unsigned 64 bits integer.
+    """
+    return int.from_bytes(blake2b(text.encode('utf-8'), digest_size=8).digest(), byteorder='little')
+
+
+def _get_namespace(tokenizer, max_length: int) -> str:
+    # Tokenizer names are HuggingFace ids (user/model) or local paths, make them a valid directory name
+    tokenizer_name = re.sub(r'[^\w.-]+', '--', tokenizer.name_or_path).strip('-')
+    return f"{tokenizer_name}-{max_length}"
+
+
+# Process-wide cache, to pass to ToxicityDataset, predict_with_probabilities or ShardedPredictor (none of them
+# use a cache by default)
+TOKENIZATION_CACHE = TokenizationCache()
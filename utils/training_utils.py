@@ -0,0 +1,266 @@
+"""
+A set of classes and functions used during the fine-tuning of the model.
+Moved here to avoid cluttering the notebooks with code that is not relevant to the training analysis.
+"""
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset, DataLoader, Sampler
+from tqdm import tqdm
+
+from .batching import get_length_sorted_batches
+from .constants import TEXT, LABEL, MODEL_MAX_LENGTH
+from .tokenization import tokenize_texts, pad_sequences
+from .tokenization_cache import TokenizationCache
+
+
+class ToxicityDataset(Dataset):
+    """
+    Dataset of (text, label) pairs, tokenized at __init__ to save time at training. Texts are stored without
+    padding, it's added to each batch (only up to its longest text) by PaddingCollator, so short tweets don't
+    cost as much as full news articles.
+    Tokens can be read from a tokenization cache, so unchanged splits are not tokenized again between sessions.
+    """
+
+    def __init__(self, dataframe: pd.DataFrame, tokenizer, max_length: int = MODEL_MAX_LENGTH,
+                 cache: TokenizationCache|None = None, num_workers: int = 1):
+        """
+        :param dataframe: pd.DataFrame. Data split with "text" and "label" columns.
+        :param tokenizer: callable. Tokenizer to use for tokenizing the texts.
+        :param max_length: int. Maximum model length (tokens).
+        :param cache: TokenizationCache|None. Cache to read the tokens from (e.g. TOKENIZATION_CACHE). If None,
+        texts are always tokenized.
+        :param num_workers: int. Number of worker processes used for tokenizing (see tokenize_texts).
+        """
+        self._dataframe = dataframe
+        self.max_length = max_length
+
+        texts = dataframe[TEXT].tolist()
+        if cache is not None:
+            self.tokens, self.offsets = cache.tokenize(texts=texts, tokenizer=tokenizer, max_length=max_length,
+                                                       num_workers=num_workers)
+        else:
+            self.tokens, self.offsets = tokenize_texts(texts=texts, tokenizer=tokenizer, max_length=max_length,
+                                                       num_workers=num_workers)
+        # Number of tokens of each text, used by LengthGroupedSampler for building the batches
+        self.lengths = np.diff(self.offsets)
+
+        # Get labels of each entry for the loss function computation
+        self.labels = torch.tensor(dataframe[LABEL], dtype=torch.int64)
+
+        assert len(self.lengths) == len(self.labels) == len(self._dataframe), "Lengths mismatch."
+
+    def __len__(self):
+        # Needed for batching and epoch estimations
+        return len(self._dataframe)
+
+    def __getitem__(self, idx):
+        assert idx <= len(self._dataframe), f"Trying to access idx {idx} in a dataset of size {len(self._dataframe)}"
+
+        # Encoder-only models don't require decoder inputs (only input_ids and attention_masks). The attention
+        # mask is built by the collator, when padding the batch
+        return {
+            'input_ids': self.tokens[self.offsets[idx]:self.offsets[idx + 1]],
+            'labels': self.labels[idx]
+        }
+
+
+class PaddingCollator:
+    """
+    Collate function (collate_fn of the DataLoader) for ToxicityDataset, padding each batch up to its longest text
+    and building its attention mask. In HuggingFace models, inputs are provided as dictionaries.
+    """
+
+    def __init__(self, pad_token_id: int, length: int|None = None):
+        """
+        :param pad_token_id: int. The token id used for padding.
+        :param length: int|None. If given, every batch is padded to this fixed length (e.g. MODEL_MAX_LENGTH)
+        instead of to its longest text.
+        """
+        self.pad_token_id, self.length = pad_token_id, length
+
+    def __call__(self, items: list[dict[str, np.ndarray|torch.Tensor]]) -> dict[str, torch.Tensor]:
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        np.cumsum([len(item['input_ids']) for item in items], out=offsets[1:])
+        input_ids, attention_mask = pad_sequences(tokens=np.concatenate([item['input_ids'] for item in items]),
+                                                  offsets=offsets, pad_token_id=self.pad_token_id,
+                                                  length=self.length or int(np.diff(offsets).max()))
+        return {
+            'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': torch.from_numpy(attention_mask),
+            'labels': torch.stack([item['labels'] for item in items])
+        }
+
+
+class LengthGroupedSampler(Sampler[list[int]]):
+    """
+    Batch sampler (batch_sampler of the DataLoader) that groups texts of similar length in the same batch, so
+    the padding added by PaddingCollator is minimal, while keeping some randomness between epochs: texts are
+    shuffled and split into mega-batches of batch_size * mega_batch_factor texts, each mega-batch is sorted by
+    length and split into batches, and the order of the batches is shuffled too.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, mega_batch_factor: int = 50, shuffle: bool = True,
+                 seed: int|None = None):
+        """
+        :param lengths: np.ndarray. The length (in tokens) of each text of the dataset (ToxicityDataset.lengths).
+        :param batch_size: int. The maximum number of texts in each batch.
+        :param mega_batch_factor: int. Number of batches of each mega-batch. The bigger, the less padding but the
+        less randomness.
+        :param shuffle: bool. If False, batches are just sorted by length (e.g. for evaluation).
+        :param seed: int|None. Seed of the random generator, for reproducible epochs.
+
+        :raises AssertionError: if the batch size or the mega-batch factor are not positive.
+        """
+        assert batch_size > 0 and mega_batch_factor > 0, f"Batch size and mega-batch factor must be positive. " \
+                                                         f"Got {batch_size} and {mega_batch_factor}."
+        self.lengths, self.batch_size = np.asarray(lengths), batch_size
+        self.mega_batch_size, self.shuffle = batch_size * mega_batch_factor, shuffle
+        self._generator = np.random.default_rng(seed)
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from (batch.tolist() for batch in get_length_sorted_batches(lengths=self.lengths,
+                                                                              batch_size=self.batch_size))
+            return
+
+        indices, batches = self._generator.permutation(len(self.lengths)), []
+        for start in range(0, len(indices), self.mega_batch_size):
+            mega_batch = indices[start:start + self.mega_batch_size]
+            # Batches of the mega-batch refer to its positions, map them back to the dataset indices
+            batches.extend(mega_batch[batch] for batch in get_length_sorted_batches(lengths=self.lengths[mega_batch],
+                                                                                    batch_size=self.batch_size))
+
+        for batch_idx in self._generator.permutation(len(batches)):
+            yield batches[batch_idx].tolist()
+
+    def __len__(self):
+        if not self.shuffle:
+            return -(-len(self.lengths) // self.batch_size)
+        # Every mega-batch but the last one is full
+        full_mega_batches, remainder = divmod(len(self.lengths), self.mega_batch_size)
+        return full_mega_batches * (self.mega_batch_size // self.batch_size) + -(-remainder // self.batch_size)
+
+
+class MetricsAccumulator:
+    """
+    Running loss and accuracy of an epoch, kept in the device. Reading a value from the device (.item()) waits
+    for all the queued work to finish, so doing it at every step stalls the GPU. Instead, sums are only read
+    when the metrics are requested (every few steps and at the end of the epoch). Both metrics are weighted
+    by the real size of each batch, which may be smaller than the batch size (last batch, batch samplers...).
+    """
+
+    def __init__(self, device: torch.device):
+        """
+        :param device: torch.device. Device where the model outputs are.
+        """
+        self.loss_sum = torch.zeros((), dtype=torch.float32, device=device)
+        self.corrects = torch.zeros((), dtype=torch.int64, device=device)
+        self.seen = 0  # Known in the host without syncing, from the labels' shape
+
+    def update(self, loss: torch.Tensor, logits: torch.Tensor, labels: torch.Tensor):
+        """
+        Adds the metrics of a batch, without syncing with the device.
+
+        :param loss: torch.Tensor. Mean loss of the batch.
+        :param logits: torch.Tensor. Logits predicted for the batch.
+        :param labels: torch.Tensor. True labels of the batch.
+        """
+        self.loss_sum += loss.detach() * len(labels)
+        self.corrects += torch.sum(torch.argmax(logits.detach(), dim=1) == labels)
+        self.seen += len(labels)
+
+    def compute(self) -> tuple[float, float]:
+        """
+        Reads the metrics from the device (it's the only sync point).
+
+        :return: tuple[float, float]. The accuracy and the mean loss of the texts seen so far.
+        """
+        if self.seen == 0:
+            return 0., 0.
+        return self.corrects.item() / self.seen, self.loss_sum.item() / self.seen
+
+
+def get_trainable_parameters(model: torch.nn.Module) -> list[torch.nn.Parameter]:
+    """
+    Returns the parameters of the model that are not frozen, for building the optimizer only over them.
+
+    :param model: torch.nn.Module. The model, with its frozen layers already set.
+
+    :return: list[torch.nn.Parameter]. The parameters with requires_grad.
+    """
+    return [param for param in model.parameters() if param.requires_grad]
+
+
+def process_epoch(model: torch.nn.Module, data_loader: DataLoader, loss_fn: torch.nn.Module, device: torch.device,
+                  mode: str = 'train', optimizer: torch.optim.Optimizer|None = None,
+                  scheduler: torch.optim.lr_scheduler.LRScheduler|None = None,
+                  sync_every: int = 50) -> tuple[float, float]:
+    """
+    Training / validation process of each epoch (it has two modes).
+
+    :param model: torch.nn.Module. Model to train or evaluate, already in the device.
+    :param data_loader: DataLoader. Loader of the split, returning dictionaries with the labels and the inputs of
+    the model (input_ids and attention_mask, or the cached features for a ClassifierHead).
+    :param loss_fn: torch.nn.Module. Loss function.
+    :param device: torch.device. Device where the model is placed.
+    :param mode: str. 'train' or 'eval'.
+    :param optimizer: torch.optim.Optimizer|None. Optimizer (only for training).
+    :param scheduler: torch.optim.lr_scheduler.LRScheduler|None. Learning rate scheduler (only for training).
+    :param sync_every: int. Number of steps between each update of the loss and accuracy shown in the progress
+    bar. Each update waits for the device (see MetricsAccumulator), so don't set it too low.
+
+    :return: tuple[float, float]. The accuracy and the mean loss (weighted by the size of each batch) of the epoch.
+
+    :raises AssertionError: if the mode is unknown, if the optimizer or scheduler are missing during training or
+    if sync_every is not positive.
+    """
+    assert mode in ('train', 'eval'), f"Mode must be 'train' or 'eval', got {mode} mode."
+    assert sync_every > 0, f"sync_every must be positive. Got {sync_every}."
+
+    # Set the correct mode in the model, since during evaluation we don't need
+    # as much resources as during training
+    if mode == 'train':
+        assert optimizer is not None and scheduler is not None, f"Missing optimizer and/or scheduler during training."
+        model.train()
+    else:
+        model.eval()
+
+    metrics = MetricsAccumulator(device=device)  # Loss and accuracy metrics, kept in the device
+
+    # Using TQDM as a 'with' instead of a 'for' to see the progress of
+    # loss and accuracy metrics dynamically during training and evaluation
+    with tqdm(total=len(data_loader), desc=f"{mode.title()} progress") as progress:
+        for step, d in enumerate(data_loader, start=1):  # For each batch
+
+            # Get inputs (input_ids and attention_mask, or the cached activations of the frozen layers)
+            inputs = {key: value.to(device) for key, value in d.items() if key != 'labels'}
+            labels = d["labels"].to(device)
+
+            # Set no_grad when evaluating the model (don't compute gradients)
+            with torch.set_grad_enabled(mode=='train'):
+                outputs = model(**inputs)
+
+                # Compute loss for this batch
+                loss = loss_fn(outputs.logits, labels)
+
+                # Accumulate loss and accuracy for this batch (without waiting for the device)
+                metrics.update(loss=loss, logits=outputs.logits, labels=labels)
+
+                # Update loss optimizer and learning rate scheduler
+                if mode == 'train':
+                    optimizer.zero_grad()
+                    loss.backward()  # Backpropagation
+                    optimizer.step()
+                    scheduler.step()
+
+                progress.update(1)  # Update TQDM's loss and accuracy metrics (only every few steps)
+                if step % sync_every == 0 or step == len(data_loader):
+                    accuracy, mean_loss = metrics.compute()
+                    progress.set_description(f"{mode.title()}. Loss: {round(mean_loss, ndigits=4)}."\
+                                             f" Acc: {round(accuracy*100, ndigits=3)}%")
+
+    # Get final mean loss and accuracy metrics for this epoch
+    accuracy, mean_loss = metrics.compute()
+
+    return accuracy, mean_loss